@@ -0,0 +1,409 @@
+"""端到端吞吐压测：save_file_list → Request_Baidu_OCR → create_new_record
+
+百度和飞书接口都替换为本地模拟服务，在仓库根目录运行：
+
+    python -m benchmarks.e2e --sizes 1,10,100,1000 --baidu-latency 300 --baidu-qps 10
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import struct
+import tempfile
+import time
+import zlib
+from io import BytesIO
+from pathlib import Path
+
+import psutil
+from pypdf import PdfWriter
+from starlette.datastructures import UploadFile
+
+from .fake_servers import (
+    FakeBaidu,
+    FakeConfig,
+    FakeFeishu,
+    FakeS3,
+    ServerThread,
+)
+
+
+def make_pdf(pages: int, padding_kb: int) -> bytes:
+    """生成指定页数的空白 PDF，用元数据把文件撑到接近真实回单的大小"""
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    writer.add_metadata(
+        {"/Padding": os.urandom(padding_kb * 512).hex()}
+    )
+    with BytesIO() as stream:
+        writer.write(stream)
+        return stream.getvalue()
+
+
+def make_png(size_kb: int) -> bytes:
+    """生成一张随机噪点 PNG，噪点几乎无法压缩，文件大小约等于 size_kb"""
+    width = 256
+    height = max(1, size_kb * 1024 // (width * 3))
+    raw = b"".join(
+        b"\x00" + os.urandom(width * 3)
+        for _ in range(height)
+    )
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data))
+        )
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(
+            b"IHDR",
+            struct.pack(
+                ">IIBBBBB", width, height, 8, 2, 0, 0, 0
+            ),
+        )
+        + chunk(b"IDAT", zlib.compress(raw, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def make_upload_files(
+    count: int,
+    pdf_ratio: float,
+    pdf_pages: int,
+    file_kb: int,
+) -> list[UploadFile]:
+    """生成一批模拟用户上传的文件，PDF 和图片按 pdf_ratio 混合"""
+    pdf = make_pdf(pdf_pages, file_kb)
+    png = make_png(file_kb)
+    files = []
+    for i in range(count):
+        data, name = (
+            (pdf, f"slip-{i}.pdf")
+            if random.random() < pdf_ratio
+            else (png, f"slip-{i}.png")
+        )
+        files.append(
+            UploadFile(
+                file=BytesIO(data),
+                filename=name,
+                size=len(data),
+            )
+        )
+    return files
+
+
+def percentile(values: list[float], p: int) -> float:
+    if not values:
+        return 0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100)[p - 1]
+
+
+async def sample_rss(
+    stop: asyncio.Event, peak: list[int]
+) -> None:
+    """每 10 毫秒采样一次本进程的 RSS，记录峰值"""
+    process = psutil.Process()
+    while not stop.is_set():
+        peak[0] = max(peak[0], process.memory_info().rss)
+        await asyncio.sleep(0.01)
+
+
+async def timed(coro, latencies: list[float]):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        latencies.append(
+            (time.perf_counter() - start) * 1000
+        )
+
+
+async def run_batch(
+    size: int, args: argparse.Namespace
+) -> dict:
+    from easy_office.utils.file_process import (
+        save_file_list,
+    )
+    from easy_office.utils.request_api import (
+        Request_Baidu_OCR,
+        create_new_record,
+    )
+
+    files = make_upload_files(
+        size, args.pdf_ratio, args.pdf_pages, args.file_kb
+    )
+    stop = asyncio.Event()
+    peak = [psutil.Process().memory_info().rss]
+    sampler = asyncio.create_task(sample_rss(stop, peak))
+
+    ocr_latencies: list[float] = []
+    feishu_latencies: list[float] = []
+    start = time.perf_counter()
+
+    saved = await save_file_list(files)  # type:ignore
+    save_done = time.perf_counter()
+
+    ocr_results = await asyncio.gather(
+        *(
+            timed(
+                Request_Baidu_OCR(file=file).bank_slip(),
+                ocr_latencies,
+            )
+            for file in saved
+        ),
+        return_exceptions=True,
+    )
+    records = [
+        r for r in ocr_results if isinstance(r, dict)
+    ]
+    ocr_done = time.perf_counter()
+
+    feishu_results = await asyncio.gather(
+        *(
+            timed(
+                create_new_record(record=record),
+                feishu_latencies,
+            )
+            for record in records
+        ),
+        return_exceptions=True,
+    )
+    end = time.perf_counter()
+
+    stop.set()
+    await sampler
+
+    for path in saved:
+        path.unlink(missing_ok=True)
+
+    elapsed = end - start
+    return {
+        "batch_size": size,
+        "files": len(saved),
+        "elapsed_s": round(elapsed, 3),
+        "save_s": round(save_done - start, 3),
+        "ocr_s": round(ocr_done - save_done, 3),
+        "feishu_s": round(end - ocr_done, 3),
+        "slips_per_min": round(
+            len(records) / elapsed * 60, 1
+        ),
+        "ocr_p50_ms": round(
+            percentile(ocr_latencies, 50), 1
+        ),
+        "ocr_p95_ms": round(
+            percentile(ocr_latencies, 95), 1
+        ),
+        "feishu_p50_ms": round(
+            percentile(feishu_latencies, 50), 1
+        ),
+        "feishu_p95_ms": round(
+            percentile(feishu_latencies, 95), 1
+        ),
+        "ocr_errors": len(saved) - len(records),
+        "feishu_errors": sum(
+            isinstance(r, BaseException)
+            for r in feishu_results
+        ),
+        "peak_rss_mb": round(peak[0] / 1024 / 1024, 1),
+    }
+
+
+def print_table(results: list[dict]) -> None:
+    columns = list(results[0].keys())
+    widths = [
+        max(len(col), *(len(str(r[col])) for r in results))
+        for col in columns
+    ]
+    print(
+        "  ".join(
+            col.rjust(w) for col, w in zip(columns, widths)
+        )
+    )
+    for r in results:
+        print(
+            "  ".join(
+                str(r[col]).rjust(w)
+                for col, w in zip(columns, widths)
+            )
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1,10,100,1000")
+    parser.add_argument(
+        "--pdf-ratio", type=float, default=0.5
+    )
+    parser.add_argument("--pdf-pages", type=int, default=1)
+    parser.add_argument("--file-kb", type=int, default=200)
+    parser.add_argument(
+        "--baidu-latency", type=float, default=300
+    )
+    parser.add_argument(
+        "--baidu-jitter", type=float, default=100
+    )
+    parser.add_argument(
+        "--baidu-qps", type=float, default=0
+    )
+    parser.add_argument(
+        "--baidu-errors", type=float, default=0
+    )
+    parser.add_argument(
+        "--baidu-slow",
+        type=float,
+        default=0,
+        help="百度接口变成 10 倍延迟的慢请求的比例",
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="打开 OCR 对冲请求（OCR_HEDGE=1）",
+    )
+    parser.add_argument(
+        "--feishu-latency", type=float, default=80
+    )
+    parser.add_argument(
+        "--feishu-jitter", type=float, default=20
+    )
+    parser.add_argument(
+        "--feishu-qps", type=float, default=0
+    )
+    parser.add_argument(
+        "--feishu-errors", type=float, default=0
+    )
+    parser.add_argument(
+        "--s3",
+        action="store_true",
+        help="上传文件保存到模拟的 S3 存储，而不是本地目录",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--json", help="把结果另存为 JSON 文件", default=""
+    )
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    baidu = FakeBaidu(
+        FakeConfig(
+            args.baidu_latency,
+            args.baidu_jitter,
+            args.baidu_qps,
+            args.baidu_errors,
+            args.baidu_slow,
+        )
+    )
+    feishu = FakeFeishu(
+        FakeConfig(
+            args.feishu_latency,
+            args.feishu_jitter,
+            args.feishu_qps,
+            args.feishu_errors,
+        )
+    )
+    baidu_server = ServerThread(baidu.app()).start()
+    feishu_server = ServerThread(feishu.app()).start()
+    s3 = FakeS3(FakeConfig())
+    s3_server = ServerThread(s3.app()).start()
+
+    # 必须在导入 easy_office 之前设置，接口地址等参数在模块导入时读取
+    work_dir = Path(
+        tempfile.mkdtemp(prefix="easy-office-bench-")
+    )
+    os.environ.update(
+        {
+            "BAIDU_API_BASE": baidu_server.base_url,
+            "FEISHU_API_BASE": feishu_server.base_url,
+            "REFLEX_UPLOADED_FILES_DIR": str(
+                work_dir / "uploads"
+            ),
+            "LOG_FILE": str(work_dir / "bench.log"),
+            "LOG_LEVEL": "WARNING",
+            "TRACE_FILE": "",
+            "SEARCH_INDEX_DB": str(work_dir / "bench.db"),
+            "BLOB_INDEX_DB": str(work_dir / "bench.db"),
+            "SHARED_STORE_DB": str(work_dir / "bench.db"),
+            # 客户端限流和模拟服务的 QPS 一致，0 表示都不限制
+            "BAIDU_OCR_QPS": str(args.baidu_qps),
+            "FEISHU_WRITE_QPS": str(args.feishu_qps),
+            "OCR_HEDGE": "1" if args.hedge else "0",
+        }
+    )
+    os.environ.setdefault(
+        "BACK_END", "http://127.0.0.1:8000"
+    )
+    if args.s3:
+        os.environ.update(
+            {
+                "STORAGE_BACKEND": "s3",
+                "S3_ENDPOINT": s3_server.base_url,
+                "S3_BUCKET": "easy-office",
+                "S3_ACCESS_KEY": "fake",
+                "S3_SECRET_KEY": "fake",
+            }
+        )
+
+    try:
+        results = [
+            asyncio.run(run_batch(int(size), args))
+            for size in args.sizes.split(",")
+        ]
+    finally:
+        baidu_server.stop()
+        feishu_server.stop()
+        s3_server.stop()
+
+    print_table(results)
+    print(
+        f"fake baidu: {baidu.stats.requests} 次请求，"
+        f"{baidu.stats.throttled} 次限流，"
+        f"{baidu.stats.injected_errors} 次注入错误；"
+        f"fake feishu: {feishu.stats.requests} 次请求，"
+        f"{feishu.stats.throttled} 次限流，"
+        f"{feishu.stats.injected_errors} 次注入错误"
+    )
+    if args.hedge:
+        from easy_office.utils.hedging import (
+            HEDGE_SAVED,
+            HEDGES,
+        )
+
+        hedges: dict[str, float] = {}
+        for _, labels, value in HEDGES.samples():
+            hedges[labels["result"]] = (
+                hedges.get(labels["result"], 0) + value
+            )
+        saved = sum(
+            value for _, _, value in HEDGE_SAVED.samples()
+        )
+        print(
+            f"对冲请求：先返回 {hedges.get('won', 0):.0f} 次，"
+            f"落后 {hedges.get('lost', 0):.0f} 次，"
+            f"超出预算 {hedges.get('skipped', 0):.0f} 次，"
+            f"共节省 {saved:.1f} 秒"
+        )
+    if args.s3:
+        print(
+            f"fake s3: {s3.stats.requests} 次请求，"
+            f"保存了 {len(s3.objects)} 个文件，"
+            f"其中 {s3.completed_multipart} 个分片上传"
+        )
+    if args.json:
+        Path(args.json).write_text(
+            json.dumps(
+                results, ensure_ascii=False, indent=2
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
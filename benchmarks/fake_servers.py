@@ -0,0 +1,374 @@
+"""百度 OCR、飞书多维表格接口和 S3 对象存储的本地模拟服务，用于压测
+
+每个模拟服务都可以设置延迟、QPS 上限和错误注入，OCR 接口按顺序回放
+fixtures 目录下录制好的返回内容
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+@dataclass
+class FakeConfig:
+    """模拟服务的行为参数
+
+    Args:
+        latency_ms: 平均延迟，单位毫秒
+        jitter_ms: 延迟的随机波动范围，单位毫秒
+        qps: 每秒最多处理的请求数，0 表示不限制；超出时返回和真实接口相同的限流错误
+        error_rate: 随机返回 500 错误的比例，0~1
+        slow_rate: 随机变成慢请求的比例，0~1，慢请求的延迟是平均延迟的 10 倍
+    """
+
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    qps: float = 0
+    error_rate: float = 0
+    slow_rate: float = 0
+
+
+@dataclass
+class FakeStats:
+    requests: int = 0
+    throttled: int = 0
+    injected_errors: int = 0
+    by_path: dict[str, int] = field(default_factory=dict)
+
+
+class TokenBucket:
+    """单进程令牌桶，用来模拟接口的 QPS 限制"""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def acquire(self) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate,
+            self.tokens + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+def load_fixtures(name: str) -> list[dict]:
+    """读取 fixtures/<name>/ 下的全部录制结果"""
+    return [
+        json.loads(path.read_text(encoding="utf-8"))
+        for path in sorted(
+            (FIXTURES_DIR / name).glob("*.json")
+        )
+    ]
+
+
+class FakeService:
+    """一个模拟服务的公共逻辑：延迟、限流、错误注入和统计"""
+
+    def __init__(self, config: FakeConfig) -> None:
+        self.config = config
+        self.stats = FakeStats()
+        self.bucket = TokenBucket(config.qps)
+
+    async def gate(
+        self, request: Request, throttled_body: dict
+    ) -> JSONResponse | None:
+        """按配置模拟延迟、限流和错误，返回 None 表示正常处理"""
+        self.stats.requests += 1
+        path = request.url.path
+        self.stats.by_path[path] = (
+            self.stats.by_path.get(path, 0) + 1
+        )
+
+        # 读取完整请求体，模拟真实服务接收上传内容的开销
+        await request.body()
+
+        delay = self.config.latency_ms + random.uniform(
+            -self.config.jitter_ms, self.config.jitter_ms
+        )
+        if random.random() < self.config.slow_rate:
+            delay = self.config.latency_ms * 10
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if not self.bucket.acquire():
+            self.stats.throttled += 1
+            return JSONResponse(throttled_body)
+
+        if random.random() < self.config.error_rate:
+            self.stats.injected_errors += 1
+            return JSONResponse(
+                {"error": "injected error"}, status_code=500
+            )
+        return None
+
+
+class FakeBaidu(FakeService):
+    """模拟 aip.baidubce.com 的 token 和 OCR 接口"""
+
+    def __init__(self, config: FakeConfig) -> None:
+        super().__init__(config)
+        self.replay = {
+            name: itertools.cycle(load_fixtures(name))
+            for name in ("bank_receipt_new", "vat_invoice")
+        }
+
+    async def token(self, request: Request) -> JSONResponse:
+        return JSONResponse(
+            {
+                "access_token": "fake-baidu-token",
+                "expires_in": 2592000,
+            }
+        )
+
+    async def ocr(self, request: Request) -> JSONResponse:
+        # 百度限流时返回 HTTP 200 和 error_code 18
+        blocked = await self.gate(
+            request,
+            {
+                "error_code": 18,
+                "error_msg": "Open api qps request limit reached",
+            },
+        )
+        if blocked is not None:
+            return blocked
+        name = request.path_params["name"]
+        return JSONResponse(next(self.replay[name]))
+
+    def app(self) -> Starlette:
+        return Starlette(
+            routes=[
+                Route(
+                    "/oauth/2.0/token",
+                    self.token,
+                    methods=["POST"],
+                ),
+                Route(
+                    "/rest/2.0/ocr/v1/{name}",
+                    self.ocr,
+                    methods=["POST"],
+                ),
+            ]
+        )
+
+
+class FakeFeishu(FakeService):
+    """模拟 open.feishu.cn 的 tenant_access_token 和多维表格新增记录接口"""
+
+    async def token(self, request: Request) -> JSONResponse:
+        return JSONResponse(
+            {
+                "code": 0,
+                "msg": "ok",
+                "tenant_access_token": "fake-feishu-token",
+                "expire": 7200,
+            }
+        )
+
+    async def create_record(
+        self, request: Request
+    ) -> JSONResponse:
+        blocked = await self.gate(
+            request,
+            {
+                "code": 99991400,
+                "msg": "request trigger frequency limit",
+            },
+        )
+        if blocked is not None:
+            return blocked
+        body = await request.json()
+        return JSONResponse(
+            {
+                "code": 0,
+                "msg": "success",
+                "data": {
+                    "record": {
+                        "record_id": f"rec{self.stats.requests}",
+                        "fields": body.get("fields", {}),
+                    }
+                },
+            }
+        )
+
+    def app(self) -> Starlette:
+        return Starlette(
+            routes=[
+                Route(
+                    "/open-apis/auth/v3/tenant_access_token/internal",
+                    self.token,
+                    methods=["POST"],
+                ),
+                Route(
+                    "/open-apis/bitable/v1/apps/{app}/tables/{table}/records",
+                    self.create_record,
+                    methods=["POST"],
+                ),
+            ]
+        )
+
+
+class FakeS3(FakeService):
+    """模拟 MinIO 这类 S3 兼容存储的路径形式接口，对象保存在内存里
+
+    支持普通上传、分片上传、下载和删除；只检查请求带了签名，不校验签名内容
+    """
+
+    def __init__(self, config: FakeConfig) -> None:
+        super().__init__(config)
+        self.objects: dict[str, bytes] = {}
+        # 上传 ID → {分片号: 内容}
+        self.uploads: dict[str, dict[int, bytes]] = {}
+        self.completed_multipart = 0
+
+    def _error(self, status: int, code: str) -> Response:
+        return Response(
+            f"<Error><Code>{code}</Code></Error>",
+            status_code=status,
+            media_type="application/xml",
+        )
+
+    async def handle(self, request: Request) -> Response:
+        # S3 限流和出错时都返回 503 SlowDown
+        if await self.gate(request, {}) is not None:
+            return self._error(503, "SlowDown")
+        if (
+            "authorization" not in request.headers
+            and "X-Amz-Signature"
+            not in request.query_params
+        ):
+            return self._error(403, "AccessDenied")
+
+        name = "{bucket}/{key}".format(
+            **request.path_params
+        )
+        params = request.query_params
+        method = request.method
+
+        if method == "POST" and "uploads" in params:
+            upload_id = f"upload-{len(self.uploads) + 1}"
+            self.uploads[upload_id] = {}
+            return Response(
+                "<InitiateMultipartUploadResult>"
+                f"<UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>",
+                media_type="application/xml",
+            )
+        if "uploadId" in params:
+            parts = self.uploads.get(params["uploadId"])
+            if parts is None:
+                return self._error(404, "NoSuchUpload")
+            if method == "PUT":
+                data = await request.body()
+                parts[int(params["partNumber"])] = data
+                return Response(
+                    headers={
+                        "ETag": f'"{hashlib.md5(data).hexdigest()}"'
+                    }
+                )
+            del self.uploads[params["uploadId"]]
+            if method == "POST":
+                self.objects[name] = b"".join(
+                    parts[n] for n in sorted(parts)
+                )
+                self.completed_multipart += 1
+                return Response(
+                    "<CompleteMultipartUploadResult/>",
+                    media_type="application/xml",
+                )
+            return Response(status_code=204)
+
+        if method == "PUT":
+            self.objects[name] = await request.body()
+            return Response()
+        if method == "DELETE":
+            self.objects.pop(name, None)
+            return Response(status_code=204)
+        if name not in self.objects:
+            return self._error(404, "NoSuchKey")
+        return Response(
+            self.objects[name] if method == "GET" else b"",
+            headers={
+                "Content-Length": str(
+                    len(self.objects[name])
+                )
+            },
+        )
+
+    def app(self) -> Starlette:
+        return Starlette(
+            routes=[
+                Route(
+                    "/{bucket}/{key:path}",
+                    self.handle,
+                    methods=[
+                        "GET",
+                        "HEAD",
+                        "PUT",
+                        "POST",
+                        "DELETE",
+                    ],
+                ),
+            ]
+        )
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerThread:
+    """在后台线程里运行一个 uvicorn 服务"""
+
+    def __init__(self, app: Starlette) -> None:
+        self.port = _free_port()
+        self.server = uvicorn.Server(
+            uvicorn.Config(
+                app,
+                host="127.0.0.1",
+                port=self.port,
+                log_level="warning",
+                access_log=False,
+            )
+        )
+        self.thread = threading.Thread(
+            target=self.server.run, daemon=True
+        )
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self) -> "ServerThread":
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
@@ -0,0 +1,224 @@
+"""解析和文件处理热点函数的微基准测试
+
+语料来自 fixtures 目录下录制的百度返回结果和生成的样例 PDF。
+结果和 baselines.json 比较，慢于基线超过阈值时以非零状态退出：
+
+    python -m benchmarks.micro                 # 与基线比较
+    python -m benchmarks.micro --save          # 重新记录基线
+    python -m benchmarks.micro -k parse_date   # 只运行名字包含 parse_date 的用例
+
+基线和机器相关，换机器后需要先用 --save 重新记录
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+from io import BytesIO
+from pathlib import Path
+from typing import Callable
+
+from starlette.datastructures import UploadFile
+
+from .e2e import make_pdf
+from .fake_servers import load_fixtures
+
+BASELINE_FILE = Path(__file__).parent / "baselines.json"
+
+
+def build_cases() -> dict[str, Callable[[], object]]:
+    """返回 用例名 → 无参函数，每次调用执行一轮被测代码"""
+    from easy_office.utils.export import (
+        TITLES,
+        iter_csv,
+        iter_xlsx,
+    )
+    from easy_office.utils.file_process import (
+        process_pdf_file,
+        release_files,
+    )
+    from easy_office.utils.request_api import (
+        extract_amount,
+        parse_date,
+        process_bank_slip,
+    )
+
+    slips = [
+        r["words_result"]
+        for r in load_fixtures("bank_receipt_new")
+    ]
+    dates = [s["交易日期"][0]["word"] for s in slips] + [
+        "2024-01-02",
+        "2024/01/02 10:00:00",
+        "无法解析的日期",
+    ]
+    amounts = [s["小写金额"][0]["word"] for s in slips] + [
+        "¥1,234,567.89元",
+        "",
+    ]
+    invoice = load_fixtures("vat_invoice")[0][
+        "words_result"
+    ]
+    invoice_row = {
+        "file_name": "24117000000900910420.pdf",
+        "invoice_date": invoice["InvoiceDate"],
+        "invoice_num": invoice["InvoiceNum"],
+        "invoice_type": invoice["InvoiceType"],
+        "purchaser_name": invoice["PurchaserName"],
+        "purchaser_register_num": invoice[
+            "PurchaserRegisterNum"
+        ],
+        "seller_name": invoice["SellerName"],
+        "seller_register_num": invoice["SellerRegisterNum"],
+        "amount_in_figures": invoice["AmountInFiguers"],
+    }
+    export_rows = [list(invoice_row.values())] * 1000
+    pdf_1 = make_pdf(pages=1, padding_kb=50)
+    pdf_10 = make_pdf(pages=10, padding_kb=50)
+
+    def split_pdf(data: bytes) -> Callable[[], object]:
+        def run() -> object:
+            upload = UploadFile(
+                file=BytesIO(data), filename="sample.pdf"
+            )
+            saved = asyncio.run(
+                process_pdf_file(upload, keep=False)  # type:ignore
+            )
+            release_files(saved)
+            return saved
+
+        return run
+
+    return {
+        "parse_date": lambda: [
+            parse_date(d) for d in dates
+        ],
+        "extract_amount": lambda: [
+            extract_amount(a) for a in amounts
+        ],
+        "process_bank_slip": lambda: [
+            process_bank_slip(s) for s in slips
+        ],
+        "export_csv_1000_rows": lambda: b"".join(
+            iter_csv(TITLES["vat_invoice"], export_rows)
+        ),
+        "export_xlsx_1000_rows": lambda: b"".join(
+            iter_xlsx(TITLES["vat_invoice"], export_rows)
+        ),
+        "process_pdf_file_1_page": split_pdf(pdf_1),
+        "process_pdf_file_10_pages": split_pdf(pdf_10),
+    }
+
+
+def measure(
+    func: Callable[[], object], repeat: int
+) -> float:
+    """返回多轮测量中最快一轮的单次耗时，单位微秒"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1_000_000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help="把本次结果记录为基线",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="允许慢于基线的比例，默认 0.2 即 20%%",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "-k",
+        default="",
+        help="只运行名字包含该字符串的用例",
+    )
+    args = parser.parse_args()
+
+    # 必须在导入 easy_office 之前设置
+    work_dir = Path(
+        tempfile.mkdtemp(prefix="easy-office-micro-")
+    )
+    os.environ.update(
+        {
+            "REFLEX_UPLOADED_FILES_DIR": str(
+                work_dir / "uploads"
+            ),
+            "LOG_FILE": str(work_dir / "micro.log"),
+            "LOG_LEVEL": "CRITICAL",
+            "TRACE_FILE": "",
+            "SEARCH_INDEX_DB": str(work_dir / "micro.db"),
+            "BLOB_INDEX_DB": str(work_dir / "micro.db"),
+        }
+    )
+    os.environ.setdefault(
+        "BACK_END", "http://127.0.0.1:8000"
+    )
+
+    baselines: dict = (
+        json.loads(BASELINE_FILE.read_text())
+        if BASELINE_FILE.exists()
+        else {}
+    )
+    results: dict[str, float] = {}
+    regressions: list[str] = []
+
+    try:
+        for name, func in build_cases().items():
+            if args.k not in name:
+                continue
+            us = measure(func, args.repeat)
+            results[name] = round(us, 2)
+            base = baselines.get("results", {}).get(name)
+            if base:
+                change = us / base - 1
+                flag = ""
+                if change > args.threshold:
+                    flag = "  <-- 退化"
+                    regressions.append(name)
+                print(
+                    f"{name:<28}{us:>14.2f} µs"
+                    f"{base:>14.2f} µs{change:>+9.1%}{flag}"
+                )
+            else:
+                print(
+                    f"{name:<28}{us:>14.2f} µs{'(无基线)':>16}"
+                )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save:
+        merged = {**baselines.get("results", {}), **results}
+        BASELINE_FILE.write_text(
+            json.dumps(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": merged,
+                },
+                ensure_ascii=False,
+                indent=2,
+            )
+            + "\n"
+        )
+        print(f"基线已保存到 {BASELINE_FILE}")
+    elif regressions:
+        print(
+            f"以下用例慢于基线 {args.threshold:.0%} 以上：{regressions}"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
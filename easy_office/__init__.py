@@ -1 +1,6 @@
-from .pages import bank_slip, upload_files, vat_invoice
+from .pages import (
+    bank_slip,
+    search,
+    upload_files,
+    vat_invoice,
+)
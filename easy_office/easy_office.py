@@ -1,5 +1,9 @@
 import reflex as rx
 
+from . import routes
+from .utils.compaction import compaction_lifespan
+from .utils.executor import executor_lifespan
+
 """
 TODO:
 
@@ -23,3 +27,48 @@ app = rx.App(
         scaling="100%",
     )
 )
+
+app.api.add_route(
+    "/metrics",
+    routes.metrics.metrics_endpoint,
+    methods=["GET"],
+)
+app.api.add_route(
+    "/export/{batch_id}",
+    routes.export.export_endpoint,
+    methods=["GET"],
+)
+app.api.add_route(
+    "/files/{key:path}",
+    routes.files.files_endpoint,
+    methods=["GET", "HEAD"],
+)
+app.api.add_route(
+    "/thumbs/{key:path}",
+    routes.files.thumbnail_endpoint,
+    methods=["GET"],
+)
+app.api.add_route(
+    "/uploads",
+    routes.uploads.create_upload_endpoint,
+    methods=["POST", "OPTIONS"],
+)
+app.api.add_route(
+    "/uploads/{upload_id}",
+    routes.uploads.upload_endpoint,
+    methods=["GET", "HEAD", "PATCH", "DELETE"],
+)
+app.api.add_route(
+    "/grid/{kind}",
+    routes.grid.rows_endpoint,
+    methods=["GET"],
+)
+app.api.add_route(
+    "/admin/profile",
+    routes.profiling.profile_endpoint,
+    methods=["GET", "POST"],
+)
+
+# 启动事件循环卡顿监控，退出时关闭线程池和进程池
+app.register_lifespan_task(executor_lifespan)
+app.register_lifespan_task(compaction_lifespan)
@@ -1,127 +1,279 @@
 import asyncio
 from datetime import datetime, timedelta
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator
 
 import reflex as rx
 from reflex_ag_grid import ag_grid
 
+from ..utils.admission import admitted, watch_queue
+from ..utils.executor import run_io
 from ..utils.file_process import (
+    file_span,
+    generate_random_string,
+    release_files,
     save_file_list,
+    working_set,
 )
+from ..utils.metrics import gather_with_queue_depth
+from ..utils.profiling import profiled
+from ..utils.rate_limit import Priority, scheduling
 from ..utils.request_api import (
     Request_Baidu_OCR,
     create_new_record,
 )
+from ..utils.resumable_upload import (
+    UPLOAD_IMAGE_MAX_BYTES,
+    UPLOAD_MAX_BYTES,
+    ResumableUpload,
+    UploadError,
+    resumable_uploads,
+)
+from ..utils.row_store import row_store
+from ..utils.search_index import (
+    bank_slip_to_index_record,
+    index_records,
+)
+from ..utils.tracing import span
 from .components.check_password import check_password
+from .components.server_grid import (
+    PREVIEW_ROW_HEIGHT,
+    GridEditState,
+    bulk_edit_bar,
+    download_buttons,
+    preview_column_def,
+    server_grid,
+    with_pending_edits,
+)
 from .components.template import page_template
-from .components.upload_zone import upload_zone
+from .components.upload_zone import (
+    resumable_upload,
+    upload_zone,
+)
 
+GRID_ID = "ag_grid_for_bank_slip"
+
+
+async def ocr_bank_slips(
+    session: str,
+    files: list[rx.UploadFile] | list[ResumableUpload],
+    failed: dict[str, str],
+) -> list[dict]:
+    """保存并识别一批银行回单，每个文件先排队拿到内存预算再处理
+
+    Args:
+        session: 会话标识，用于排队
+        files: 用户上传的文件，或者分块上传完成的文件
+        failed: 无法处理的文件，原始文件名 → 原因
+
+    Returns:
+        list[dict]: 识别结果，顺序和上传顺序一致
+    """
+
+    async def _ocr_file(
+        file: rx.UploadFile | ResumableUpload,
+    ) -> list[dict]:
+        # 保存、分割和识别都挂在同一个 file span 下面
+        with file_span(file):
+            files_list = await save_file_list(
+                [file], failed
+            )
+            try:
+                return await asyncio.gather(
+                    *(
+                        Request_Baidu_OCR(
+                            file=path
+                        ).bank_slip()
+                        for path in files_list
+                    )
+                )
+            finally:
+                # 回单已经保存到长期存储，识别完成后释放本地工作副本
+                await run_io(release_files, files_list)
+
+    # 用户在网页上等结果，百度配额优先给这些请求，各会话之间公平分配
+    with (
+        scheduling(Priority.INTERACTIVE, session),
+        span(
+            "batch",
+            endpoint="bank_receipt_new",
+            batch_id=generate_random_string(),
+            file_count=len(files),
+        ),
+    ):
+        results = await gather_with_queue_depth(
+            "bank_receipt_new",
+            [
+                # 几十页的扫描件按页处理，不按整个文件的大小占用预算
+                admitted(
+                    session,
+                    working_set(file),
+                    _ocr_file(file),
+                )
+                for file in files
+            ],
+        )
+    return [
+        record for records in results for record in records
+    ]
 
-class BankSlipState(rx.State):
-    up_loading: bool = False
-    upload_data: list[dict] = []
 
-    @rx.var
-    def data(self) -> list[dict]:
-        """
-        Ag Grid 组件最好用 computed var 传输数据，用 state var 数据更新会有延迟
-        Returns: 用户上传的数据
+class BankSlipState(GridEditState, rx.State):
+    grid_kind = "bank_slip"
+    grid_id = GRID_ID
 
-        """
-        return self.upload_data
+    up_loading: bool = False
+    queue_status: str = ""
+
+    @rx.event
+    def show_upload_progress(self, percent: int):
+        """分块上传时显示上传进度"""
+        self.up_loading = True
+        self.queue_status = f"上传中：{percent}%"
 
     @rx.event
+    @profiled
     async def upload_for_bank_slip_ocr(
-        self, files: list[rx.UploadFile]
+        self, upload_ids: list[str], error: str
     ) -> AsyncGenerator:
         """
-        调用百度云的api，上传用户传入的文件，将返回的数据赋值给 self.upload_data
+        调用百度云的api，识别分块上传完成的文件，将返回的数据追加到当前批次
         Args:
-            files: 用户上传的文件
+            upload_ids: 分块上传的 ID，识别后删除上传的文件；来自浏览器，
+                不存在、属于其他会话或者没有传完的跳过
+            error: 上传中断时的错误信息，已经传完的文件照常识别
 
         """
         self.up_loading = True  # 显示加载状态
+        self.queue_status = ""
 
         yield
 
+        # 无法处理的文件，其余文件照常识别
+        failed: dict[str, str] = {}
+        session = self.router.session.client_token
+
         try:
-            files_list = await save_file_list(files)
-            tasks = [
-                Request_Baidu_OCR(file=file).bank_slip()
-                for file in files_list
-            ]
+            if error:
+                yield rx.toast.error(
+                    f"上传中断：{error}", close_button=True
+                )
+            files: list[ResumableUpload] = []
+            for upload_id in upload_ids:
+                try:
+                    files.append(
+                        await run_io(
+                            resumable_uploads.get_complete,
+                            upload_id,
+                            session,
+                        )
+                    )
+                except UploadError as e:
+                    failed[upload_id] = str(e)
+            batch = asyncio.create_task(
+                ocr_bank_slips(session, files, failed)
+            )
+            # 超出内存预算时排队，期间刷新排队位置
+            async for status in watch_queue(session, batch):
+                self.queue_status = str(status)
+                yield
+            self.queue_status = ""
 
-            resp_list = await asyncio.gather(*tasks)
+            await self._add_records(batch.result())
+            yield self._refresh_grid()
 
-            self.upload_data.extend(resp_list)  # type:ignore
+            for reason in failed.values():
+                yield rx.toast.error(
+                    reason, close_button=True
+                )
 
         except Exception as e:
             yield rx.toast.error(f"{e}", close_button=True)
 
         finally:
             self.up_loading = False
+            self.queue_status = ""
 
-    @rx.event
-    def cell_value_changed(
-        self, row, col_field, new_value
-    ) -> None:
+    def _normalize_edit(
+        self, field: str, value: Any
+    ) -> Any:
         """
-        同步更新表格
+        日期编辑器返回的是 ISO 格式，转换为 YYYY-MM-DD 格式再保存
         Args:
-            row: 更新表格的行数
-            col_field:  更新表格的字段
-            new_value: 用户输入的新值
+            field:  更新表格的字段
+            value: 用户输入的新值
 
         """
 
-        if col_field == "trade_date":
-            try:
-                # 将 ISO 格式转换为 YYYY-MM-DD 格式
-                utc_date = datetime.fromisoformat(
-                    new_value.replace("Z", "+00:00")
-                )
-                local_date = utc_date + timedelta(hours=8)
-                formatted_date = local_date.strftime(
-                    "%Y-%m-%d"
-                )
-                self.upload_data[row][col_field] = (
-                    formatted_date
-                )
-
-            except (
-                ValueError,
-                AttributeError,
-            ):  # 如果没有收入值
-                formatted_date = ""
-                self.upload_data[row][col_field] = (
-                    formatted_date
-                )
+        if field != "trade_date":
+            return value
 
-        else:
-            self.upload_data[row][col_field] = new_value
+        try:
+            utc_date = datetime.fromisoformat(
+                value.replace("Z", "+00:00")
+            )
+            local_date = utc_date + timedelta(hours=8)
+            return local_date.strftime("%Y-%m-%d")
+
+        except (
+            ValueError,
+            AttributeError,
+        ):  # 如果没有收入值
+            return ""
 
     @rx.event
+    @profiled
     async def send_to_database(self):
         """
-        将数据上传到数据库,刷新 upload_data，清空前端表格
+        将数据上传到数据库,删除当前批次，清空前端表格
         如果用户上传空数据会警告
         """
         try:
-            if self.upload_data:
+            records = await run_io(
+                row_store.records, self.batch_id
+            )
+            if records:
                 self.up_loading = True
 
                 yield
 
-                tasks = [
-                    create_new_record(record=record)
-                    for record in self.upload_data
-                ]
-
-                await asyncio.gather(*tasks)
+                with (
+                    scheduling(
+                        Priority.INTERACTIVE,
+                        self.router.session.client_token,
+                    ),
+                    span(
+                        "batch",
+                        endpoint="bitable_records",
+                        batch_id=self.batch_id,
+                        record_count=len(records),
+                    ),
+                ):
+                    tasks = [
+                        create_new_record(record=record)
+                        for record in records
+                    ]
+
+                    await gather_with_queue_depth(
+                        "bitable_records", tasks
+                    )
+
+                # 发送成功的记录写入本地搜索索引
+                await index_records(
+                    "bank_slip",
+                    [
+                        bank_slip_to_index_record(record)
+                        for record in records
+                    ],
+                )
 
-                # JournalAccount.create_records(records=self.upload_data)
+                # JournalAccount.create_records(records=records)
                 self.up_loading = False
-                self.upload_data = []
+                await run_io(
+                    row_store.delete, self.batch_id
+                )
+                self.batch_id = ""
+                self.selected_rows = []
+                yield self._refresh_grid()
 
             else:
                 yield rx.toast.error(
@@ -138,7 +290,7 @@ bank_slip_column_defs = [
         header_name="交易日期",
         cell_data_type="date",
         editable=True,
-        sortable=False,  # type:ignore
+        sortable=True,  # type:ignore
         filter=None,
         cell_editor=ag_grid.editors.date,
     ),
@@ -147,18 +299,18 @@ bank_slip_column_defs = [
         header_name="项目描述",
         cell_data_type="text",
         editable=True,
-        filter=None,
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
-        sortable=False,  # type:ignore
+        sortable=True,  # type:ignore
     ),
     ag_grid.column_def(
         field="additional_info",
         header_name="备注",
         cell_data_type="text",
         editable=True,
-        filter=None,
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
-        sortable=False,  # type:ignore
+        sortable=True,  # type:ignore
     ),
     ag_grid.column_def(
         field="amount",
@@ -167,14 +319,14 @@ bank_slip_column_defs = [
         editable=True,
         filter=None,
         cell_editor=ag_grid.editors.number,
-        sortable=False,  # type:ignore
+        sortable=True,  # type:ignore
     ),
     ag_grid.column_def(
         field="category",
         header_name="分类",
         cell_data_type="text",
         editable=True,
-        filter=None,
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
         cell_editor_params={
             "values": [
@@ -187,53 +339,57 @@ bank_slip_column_defs = [
                 "其他支出",
             ]
         },
-        sortable=False,  # type:ignore
+        sortable=True,  # type:ignore
     ),
     ag_grid.column_def(
         field="payer",
         header_name="付款方",
         cell_data_type="text",
         editable=True,
-        filter=None,
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
-        sortable=False,  # type:ignore
+        sortable=True,  # type:ignore
     ),
     ag_grid.column_def(
         field="receiver",
         header_name="收款方",
         cell_data_type="text",
         editable=True,
-        filter=None,
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
-        sortable=False,  # type:ignore
+        sortable=True,  # type:ignore
     ),
+    preview_column_def("bank_slip_url"),
     ag_grid.column_def(
         field="bank_slip_url",
         header_name="银行回单",
         cell_data_type="text",
         editable=True,
-        filter=None,
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
-        sortable=False,  # type:ignore
+        sortable=True,  # type:ignore
     ),
 ]
 
 
 def ag_grid_zone() -> rx.Component:
-    return ag_grid(
-        id="ag_grid_for_bank_slip",
-        row_data=BankSlipState.data,
-        column_defs=bank_slip_column_defs,
-        on_cell_value_changed=BankSlipState.cell_value_changed,
-        width="90vw",
-        height="60vh",
+    return rx.fragment(
+        bulk_edit_bar(BankSlipState, bank_slip_column_defs),
+        server_grid(
+            BankSlipState,
+            bank_slip_column_defs,
+            row_height=PREVIEW_ROW_HEIGHT,
+        ),
     )
 
 
 def send_records_button() -> rx.Component:
     return rx.button(
         "发送数据",
-        on_click=BankSlipState.send_to_database,
+        # 先提交表格里还没提交的编辑，发送的是用户最后看到的数据
+        on_click=with_pending_edits(
+            BankSlipState, BankSlipState.send_to_database()
+        ),
         color=rx.color("slate", 2),
         bg=rx.color("slate", 12),
         loading=BankSlipState.up_loading,
@@ -244,12 +400,20 @@ def bank_slip_ocr_page() -> rx.Component:
     return rx.el.div(
         upload_zone(
             loading=BankSlipState.up_loading,
-            upload_handler=BankSlipState.upload_for_bank_slip_ocr(
-                rx.upload_files(upload_id="upload1")  # type:ignore
+            status=BankSlipState.queue_status,
+            # 几十页的扫描件也能上传，断线后从断开的位置续传
+            upload_handler=resumable_upload(
+                BankSlipState.upload_for_bank_slip_ocr,
+                BankSlipState.show_upload_progress,
             ),
+            max_size=UPLOAD_IMAGE_MAX_BYTES,
+            pdf_max_size=UPLOAD_MAX_BYTES,
         ),
         ag_grid_zone(),
-        send_records_button(),
+        rx.hstack(
+            send_records_button(),
+            download_buttons(BankSlipState),
+        ),
         class_name="flex flex-col items-center justify-center w-full space-y-2",
     )
 
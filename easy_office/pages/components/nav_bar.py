@@ -40,6 +40,7 @@ class NavBarState(rx.State):
         NavItem(name="快捷记账", path="/"),
         NavItem(name="文件上传", path="/upload-files"),
         NavItem(name="发票识别", path="/invoice-ocr"),
+        NavItem(name="历史搜索", path="/search"),
         NavItem(
             name="账目一览",
             path="https://yuanwang.feishu.cn/base/MFoQbIqCNaujgzsn7vOcTfpBnjb?table=tblrtFGd80L0Z0Hk&view=vewfVnLasa",
@@ -0,0 +1,458 @@
+from typing import Any, ClassVar
+
+import reflex as rx
+from reflex.config import get_config
+from reflex.event import (
+    EventChain,
+    EventSpec,
+    call_event_handler,
+)
+from reflex.utils.imports import ImportVar
+from reflex.vars import VarData
+from reflex_ag_grid import Datasource, ag_grid
+from reflex_ag_grid.ag_grid import ColumnDef, WrappedAgGrid
+
+from ...utils.executor import run_io
+from ...utils.row_store import row_store
+
+GRID_BLOCK_SIZE = 100  # 表格每次向后端读取的行数
+# 浏览器里最多缓存的块数，超出后丢弃最久没有显示的块
+GRID_MAX_BLOCKS = 10
+# 最后一次编辑之后等多久把攒下的编辑一起提交，单位毫秒
+GRID_EDIT_DEBOUNCE = 500
+# 带缩略图的表格的行高，单位像素
+PREVIEW_ROW_HEIGHT = 72
+
+
+def _on_selection_changed(event: rx.Var) -> list[rx.Var]:
+    """选中行的 row_id，按显示顺序排列，向下填充时第一行就是最上面的一行"""
+    return [
+        rx.Var(
+            f"{event}.api.getSelectedNodes()"
+            ".sort((a, b) => a.rowIndex - b.rowIndex)"
+            ".map((node) => node.data.row_id)"
+        )
+    ]
+
+
+def _edits_spec(edits: rx.Var) -> list[rx.Var]:
+    return [edits]
+
+
+class ServerGrid(WrappedAgGrid):
+    """从 /grid 接口按块读取行数据的 AG Grid"""
+
+    on_selection_changed: rx.EventHandler[
+        _on_selection_changed
+    ]
+
+    row_height: rx.Var[int]
+
+
+class GridEditState(rx.State, mixin=True):
+    """行数据保存在 row_store 里的表格的公共状态：当前批次、提交编辑和批量操作
+
+    子类设置 grid_kind 为批次类型，grid_id 为表格的 id
+    """
+
+    grid_kind: ClassVar[str]
+    grid_id: ClassVar[str]
+
+    # 识别结果保存在 row_store 里，表格通过 /grid 接口按块读取，会话状态只保存批次 ID
+    batch_id: str = ""
+    # 表格里选中的行的 row_id，按显示顺序排列
+    selected_rows: list[str] = []
+    # 批量操作的字段和新值
+    bulk_field: str = ""
+    bulk_value: str = ""
+
+    async def _add_records(
+        self, records: list[dict]
+    ) -> None:
+        # row_store 共享时要访问 Redis 或 SQLite，还可能等其他进程的锁，都放到线程池里
+        try:
+            await run_io(
+                row_store.extend, self.batch_id, records
+            )
+        except KeyError:  # 还没有批次，或者批次已经过期
+            self.batch_id = await run_io(
+                row_store.create,
+                self.grid_kind,
+                self.router.session.client_token,
+            )
+            self.selected_rows = []
+            await run_io(
+                row_store.extend, self.batch_id, records
+            )
+
+    def _refresh_grid(self) -> rx.event.EventSpec:
+        """让表格重新读取已经加载的块"""
+        return ag_grid.api(
+            id=self.grid_id
+        ).refresh_infinite_cache()
+
+    def _normalize_edit(
+        self, field: str, value: Any
+    ) -> Any:
+        """保存前转换用户输入的值，子类按字段覆盖"""
+        return value
+
+    @rx.event
+    async def apply_edits(self, edits: list[dict]):
+        """
+        保存前端攒下来的一批编辑，一次事件、一次加锁
+        Args:
+            edits: 按编辑顺序排列，每条为 {"row_id", "field", "value"}
+
+        """
+        if not edits:
+            return
+        try:
+            await run_io(
+                row_store.update_cells,
+                self.batch_id,
+                [
+                    (
+                        int(edit["row_id"]),
+                        edit["field"],
+                        self._normalize_edit(
+                            edit["field"], edit["value"]
+                        ),
+                    )
+                    for edit in edits
+                ],
+            )
+        except (
+            KeyError,
+            IndexError,
+            ValueError,
+            TimeoutError,
+        ) as e:
+            # 一条都没有保存，重新读取表格，不让前端显示没有保存的值
+            yield rx.toast.error(
+                f"保存失败：{e}", close_button=True
+            )
+            yield self._refresh_grid()
+
+    @rx.event
+    def select_rows(self, row_ids: list[str]) -> None:
+        self.selected_rows = row_ids
+
+    @rx.event
+    async def set_column_for_selection(self):
+        """把选中行的 bulk_field 都改成 bulk_value"""
+        if not self.bulk_field or not self.selected_rows:
+            return rx.toast.error(
+                "请先选择列和行", close_button=True
+            )
+        value = self._normalize_edit(
+            self.bulk_field, self.bulk_value
+        )
+        try:
+            await run_io(
+                row_store.update_cells,
+                self.batch_id,
+                [
+                    (int(row), self.bulk_field, value)
+                    for row in self.selected_rows
+                ],
+            )
+        except (KeyError, IndexError, TimeoutError) as e:
+            return rx.toast.error(
+                f"保存失败：{e}", close_button=True
+            )
+        return self._refresh_grid()
+
+    @rx.event
+    async def fill_down(self):
+        """把选中的第一行的 bulk_field 填到其余选中行"""
+        if not self.bulk_field or not self.selected_rows:
+            return rx.toast.error(
+                "请先选择列和行", close_button=True
+            )
+        try:
+            await run_io(
+                row_store.fill_down,
+                self.batch_id,
+                [int(row) for row in self.selected_rows],
+                self.bulk_field,
+            )
+        except (KeyError, IndexError, TimeoutError) as e:
+            return rx.toast.error(
+                f"保存失败：{e}", close_button=True
+            )
+        return self._refresh_grid()
+
+
+def _get_rows(kind: str) -> rx.Var:
+    """AG Grid 无限滚动模式的 getRows
+
+    ag_grid 自带的实现依赖 state.js 里没有导出的 token，这里改用 getToken()，
+    并使用接口返回的总行数，滚动条一开始就是准确的长度
+    """
+    url = (
+        f"{get_config().api_url}/grid/{kind}"
+        "?start=${params.startRow}&end=${params.endRow}"
+        "&sort_model=${encodeURIComponent(JSON.stringify(params.sortModel))}"
+        "&filter_model=${encodeURIComponent(JSON.stringify(params.filterModel))}"
+    )
+    return rx.Var(
+        f"""(params) => {{
+    fetch(getBackendURL(`{url}`), {{
+        headers: {{"X-Reflex-Client-Token": getToken()}},
+    }})
+    .then((response) => response.ok ? response.json() : Promise.reject(response.status))
+    .then((data) => params.successCallback(data.rows, data.row_count))
+    .catch(() => params.failCallback())
+}}""",
+        _var_data=VarData(
+            imports={
+                "$/utils/state": [
+                    ImportVar(tag="getBackendURL"),
+                    ImportVar(tag="getToken"),
+                ],
+            }
+        ),
+    )
+
+
+def _on_cell_value_changed(
+    id: str, state: type[GridEditState]
+) -> rx.Var:
+    """编辑单元格时先把编辑攒在浏览器里，停止编辑 GRID_EDIT_DEBOUNCE 毫秒后一起提交
+
+    编辑是按行的 row_id 记录的，排序、筛选之后 rowIndex 只是显示位置；
+    关闭或刷新页面时立即提交还没提交的编辑，并提示用户等提交完成再离开
+    """
+    submit = rx.Var.create(
+        EventChain(
+            events=[
+                call_event_handler(
+                    state.apply_edits, _edits_spec
+                )
+            ],
+            args_spec=_edits_spec,
+        )
+    )
+    return rx.Var(
+        f"""(event) => {{
+    const buffer = ((window.__gridEdits ??= {{}})["{id}"] ??= {{edits: [], timer: null}});
+    buffer.edits.push({{row_id: event.data.row_id, field: event.colDef.field, value: event.newValue}});
+    clearTimeout(buffer.timer);
+    buffer.submit = (edits) => ({submit})(edits);
+    buffer.timer = setTimeout(() => buffer.submit(buffer.edits.splice(0)), {GRID_EDIT_DEBOUNCE});
+    window.__gridEditsUnload ??= window.addEventListener("beforeunload", (e) => {{
+        for (const pending of Object.values(window.__gridEdits)) {{
+            if (!pending.edits.length) continue;
+            clearTimeout(pending.timer);
+            pending.submit(pending.edits.splice(0));
+            e.preventDefault();
+            e.returnValue = "";
+        }}
+    }}) ?? true;
+}}""",
+        _var_type=EventChain,
+        _var_data=VarData.merge(submit._get_all_var_data()),
+    )
+
+
+def _pending_edits(id: str) -> rx.Var:
+    """取出表格攒着还没提交的编辑，并取消定时提交"""
+    return rx.Var(
+        f"""((buffer) => buffer ? (clearTimeout(buffer.timer), buffer.edits.splice(0)) : [])(window.__gridEdits?.["{id}"])""",
+        _var_type=list,
+    )
+
+
+def with_pending_edits(
+    state: type[GridEditState], *events: EventSpec
+) -> EventChain:
+    """先提交表格里还没提交的编辑，再执行 events
+
+    编辑要等 GRID_EDIT_DEBOUNCE 毫秒才提交，这期间点击发送、下载时读到的是旧数据；
+    同一个页面的事件按顺序处理，编辑作为第一个事件提交，后面的事件一定能读到
+    """
+    return EventChain(
+        events=[
+            call_event_handler(
+                state.apply_edits,
+                lambda: [_pending_edits(state.grid_id)],
+            ),
+            *events,
+        ],
+        args_spec=lambda: [],
+    )
+
+
+def server_grid(
+    state: type[GridEditState],
+    column_defs: list[ColumnDef],
+    **props: Any,
+) -> rx.Component:
+    """行数据保存在服务端的表格，滚动到哪里就读取哪一块
+
+    加载时间和浏览器内存只和块大小有关，和批次有多少行无关；
+    排序、筛选也交给后端处理。按住 Ctrl 或 Shift 可以选中多行
+
+    Args:
+        state: 表格对应的状态，提供批次类型、表格 id 和编辑事件
+        column_defs: 列定义
+        props: 其余 AG Grid 属性，例如 row_height
+    """
+    return ServerGrid.create(
+        id=state.grid_id,
+        row_model_type="infinite",
+        datasource=Datasource(
+            getRows=_get_rows(state.grid_kind)
+        ),
+        row_id_key="row_id",
+        row_selection="multiple",
+        cache_block_size=GRID_BLOCK_SIZE,
+        max_blocks_in_cache=GRID_MAX_BLOCKS,
+        column_defs=column_defs,
+        on_cell_value_changed=_on_cell_value_changed(
+            state.grid_id, state
+        ),
+        on_selection_changed=state.select_rows,
+        width="90vw",
+        height="60vh",
+        **props,
+    )
+
+
+def _preview_renderer() -> rx.Var:
+    """从文件链接里取出 blobs/... 路径，显示 /thumbs 的缩略图，点击打开原文件
+
+    链接可能是本地的 /files 链接，也可能是对象存储的链接，路径部分都相同
+    """
+    key = rx.Var(
+        "(params.value ?? '').match("
+        r"/blobs\/[0-9a-f]{2}\/[0-9a-f]{2}\/[0-9a-f]{64}\.[a-z0-9]{1,8}/"
+        ")?.[0]",
+        _var_type=str,
+    )
+    src = rx.Var(
+        f"getBackendURL(`{get_config().api_url}/thumbs/${{{key}}}`)",
+        _var_type=str,
+        _var_data=VarData(
+            imports={
+                "$/utils/state": [
+                    ImportVar(tag="getBackendURL")
+                ],
+            }
+        ),
+    )
+    cell = rx.cond(
+        key,
+        rx.el.a(
+            rx.el.img(
+                src=src,
+                loading="lazy",
+                alt="",
+                height="64px",
+                # 无法生成缩略图时隐藏，只剩下旁边的链接列
+                custom_attrs={
+                    "onError": rx.Var(
+                        "(e) => { e.currentTarget.style.display = 'none' }"
+                    )
+                },
+            ),
+            href=rx.Var("params.value", _var_type=str),
+            target="_blank",
+        ),
+    )
+    renderer = (
+        rx.vars.function.ArgsFunctionOperation.create(
+            ("params",), cell
+        )
+    )
+    # 函数 Var 不会带上组件用到的 import（jsx、getBackendURL 等），这里手动补上
+    return rx.Var(
+        str(renderer),
+        _var_data=rx.Var.create(cell)._get_all_var_data(),
+    ).to(dict)
+
+
+def preview_column_def(
+    field: str, header_name: str = "预览"
+) -> ColumnDef:
+    """显示 field 里文件链接的缩略图的列，缩略图按需生成，逐行核对时不用下载原文件"""
+    return ag_grid.column_def(
+        field=field,
+        col_id=f"{field}_preview",
+        header_name=header_name,
+        cell_renderer=_preview_renderer(),
+    )  # type:ignore
+
+
+def bulk_edit_bar(
+    state: type[GridEditState],
+    column_defs: list[ColumnDef],
+) -> rx.Component:
+    """批量操作：把选中行的某一列改成同一个值，或者向下填充第一行的值"""
+    return rx.hstack(
+        rx.select.root(
+            rx.select.trigger(placeholder="选择列"),
+            rx.select.content(
+                *(
+                    rx.select.item(
+                        column.header_name,
+                        value=column.field,
+                    )
+                    for column in column_defs
+                    if column.editable
+                )
+            ),
+            value=state.bulk_field,
+            on_change=state.set_bulk_field,
+        ),
+        rx.input(
+            placeholder="新值",
+            value=state.bulk_value,
+            on_change=state.set_bulk_value,
+        ),
+        rx.button(
+            "填入选中行",
+            on_click=state.set_column_for_selection,
+            variant="outline",
+        ),
+        rx.button(
+            "向下填充",
+            on_click=state.fill_down,
+            variant="outline",
+        ),
+        rx.text(
+            f"已选中 {state.selected_rows.length()} 行",
+            size="1",
+        ),
+        align="center",
+        width="90vw",
+    )
+
+
+def download_buttons(
+    state: type[GridEditState],
+) -> rx.Component:
+    """下载当前批次，浏览器直接从 /export 接口流式下载，不经过 websocket
+
+    先提交还没提交的编辑，提交完成后再跳转到下载链接
+    """
+
+    def _button(label: str, fmt: str) -> rx.Component:
+        return rx.button(
+            label,
+            on_click=with_pending_edits(
+                state,
+                rx.call_script(
+                    f"window.location.assign('{get_config().api_url}/export/{state.batch_id}?format={fmt}')"
+                ),
+            ),
+            color=rx.color("slate", 2),
+            bg=rx.color("slate", 12),
+            disabled=~state.batch_id.bool(),
+        )
+
+    return rx.hstack(
+        _button("下载 CSV", "csv"),
+        _button("下载 Excel", "xlsx"),
+    )
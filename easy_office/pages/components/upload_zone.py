@@ -1,15 +1,157 @@
 import reflex as rx
-from reflex.event import EventCallback
+from reflex.config import get_config
+from reflex.event import (
+    EventCallback,
+    EventChain,
+    call_event_handler,
+)
+from reflex.utils.imports import ImportVar
+from reflex.vars import VarData
+
+from ...utils.resumable_upload import UPLOAD_CHUNK_BYTES
+
+# 一个分块连续失败多少次后放弃，每次重试前等待的时间翻倍
+UPLOAD_RETRIES = 5
+
+
+def _uploaded_spec(
+    upload_ids: rx.Var, error: rx.Var
+) -> list[rx.Var]:
+    return [upload_ids, error]
+
+
+def _progress_spec(percent: rx.Var) -> list[rx.Var]:
+    return [percent]
+
+
+def resumable_upload(
+    on_uploaded: EventCallback, on_progress: EventCallback
+) -> rx.Var:
+    """分块上传拖入的文件，作为 upload_zone 的 upload_handler
+
+    每个文件先在 /uploads 创建上传，再按 UPLOAD_CHUNK_BYTES 分块 PATCH。
+    断线时查询服务端已经收到的字节数，从断开的位置续传；
+    同一个页面会话里重新拖入没有传完的文件，也会接着上次的位置上传
+
+    Args:
+        on_uploaded: 全部上传完后调用，参数为上传 ID 列表和错误信息（没有错误时为空）
+        on_progress: 每传完一个分块调用，参数为总进度百分比
+    """
+    uploaded = rx.Var.create(
+        EventChain(
+            events=[
+                call_event_handler(
+                    on_uploaded, _uploaded_spec
+                )
+            ],
+            args_spec=_uploaded_spec,
+        )
+    )
+    progress = rx.Var.create(
+        EventChain(
+            events=[
+                call_event_handler(
+                    on_progress, _progress_spec
+                )
+            ],
+            args_spec=_progress_spec,
+        )
+    )
+    endpoint = f"{get_config().api_url}/uploads"
+    return rx.Var(
+        f"""async (files) => {{
+    const endpoint = getBackendURL(`{endpoint}`);
+    const headers = {{"Tus-Resumable": "1.0.0", "X-Reflex-Client-Token": getToken()}};
+    const query = (url) => fetch(url, {{headers}})
+        .then((response) => response.ok ? response.json() : Promise.reject(response.status))
+        .then((body) => body.offset);
+    const total = files.reduce((sum, file) => sum + file.size, 0);
+    const uploadIds = [];
+    let done = 0;
+    try {{
+        for (const file of files) {{
+            const key = `resumable-upload:${{getToken()}}:${{file.name}}:${{file.size}}:${{file.lastModified}}`;
+            let url = localStorage.getItem(key);
+            let offset = url ? await query(url).catch(() => null) : null;
+            if (offset === null) {{
+                const name = btoa(String.fromCharCode(...new TextEncoder().encode(file.name)));
+                const response = await fetch(endpoint, {{
+                    method: "POST",
+                    headers: {{...headers, "Upload-Length": String(file.size), "Upload-Metadata": `filename ${{name}}`}},
+                }});
+                const body = await response.json();
+                if (!response.ok) throw new Error(`${{file.name}}：${{body.error}}`);
+                url = `${{endpoint}}/${{body.id}}`;
+                offset = 0;
+                localStorage.setItem(key, url);
+            }}
+            for (let retries = 0; offset < file.size; ) {{
+                try {{
+                    const response = await fetch(url, {{
+                        method: "PATCH",
+                        headers: {{...headers, "Content-Type": "application/offset+octet-stream", "Upload-Offset": String(offset)}},
+                        body: file.slice(offset, offset + {UPLOAD_CHUNK_BYTES}),
+                    }});
+                    const body = await response.json();
+                    if (!response.ok) throw new Error(`${{file.name}}：${{body.error}}`);
+                    offset = body.offset;
+                    retries = 0;
+                    ({progress})(Math.floor(((done + offset) * 100) / total));
+                }} catch (error) {{
+                    if (++retries > {UPLOAD_RETRIES}) throw error;
+                    await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** retries));
+                    // 断线时服务端可能已经收到了一部分，从服务端记录的位置续传
+                    offset = await query(url).catch(() => offset);
+                }}
+            }}
+            localStorage.removeItem(key);
+            done += file.size;
+            uploadIds.push(url.split("/").pop());
+        }}
+    }} catch (error) {{
+        return ({uploaded})(uploadIds, String(error.message ?? error));
+    }}
+    ({uploaded})(uploadIds, "");
+}}""",
+        _var_type=EventChain,
+        _var_data=VarData.merge(
+            uploaded._get_all_var_data(),
+            progress._get_all_var_data(),
+            VarData(
+                imports={
+                    "$/utils/state": [
+                        ImportVar(tag="getBackendURL"),
+                        ImportVar(tag="getToken"),
+                    ],
+                }
+            ),
+        ),
+    )
 
 
 def upload_zone(
-    loading: bool, upload_handler: EventCallback
+    loading: bool,
+    upload_handler: EventCallback | rx.Var,
+    status: str = "",
+    max_size: int = 5000000,
+    pdf_max_size: int | None = None,
 ) -> rx.Component:
+    """上传区域
+
+    Args:
+        loading: 是否正在处理，处理时显示加载动画
+        upload_handler: 处理上传文件的事件，或者 resumable_upload 返回的分块上传
+        status: 显示在加载动画旁边的文字，例如排队位置、上传进度
+        max_size: 单个文件的大小上限，默认是百度 api 的限制
+        pdf_max_size: PDF 的大小上限，分块上传的 PDF 按页识别，可以放宽到
+            UPLOAD_MAX_BYTES；浏览器分不出文件类型，图片的上限由后端检查
+    """
     return rx.upload(
         rx.cond(
             loading,
             rx.hstack(
                 rx.spinner(size="3"),
+                rx.text(status, size="1"),
                 align="center",
                 justify="center",
                 height="100%",
@@ -23,7 +165,12 @@ def upload_zone(
                     size="1",
                 ),
                 rx.text(
-                    "不建议单次上传过多文件，单文件最大5mb",
+                    f"不建议单次上传过多文件，单文件最大{max_size // 1000000}mb"
+                    + (
+                        f"，PDF 最大{pdf_max_size // 1000000}mb"
+                        if pdf_max_size
+                        else ""
+                    ),
                     size="1",
                 ),
                 spacing="1",
@@ -35,7 +182,7 @@ def upload_zone(
         id="upload1",
         multiple=True,
         # max_files=5, # Reflex 给的这个参数似乎不能限制前端上传的文件数量，所以我采用了后端验证的方式
-        max_size=5000000,  # 百度api最大文件限制 8mb
+        max_size=pdf_max_size or max_size,
         border="1px dotted",
         class_name="rounded-md",
         width="90vw",
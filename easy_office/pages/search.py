@@ -0,0 +1,148 @@
+import time
+from typing import Any, AsyncGenerator
+
+import reflex as rx
+
+from ..utils.executor import run_io
+from ..utils.profiling import profiled
+from ..utils.search_index import search_index
+from .components.check_password import check_password
+from .components.template import page_template
+
+
+class SearchState(rx.State):
+    """历史识别结果搜索
+    results：查询结果
+    elapsed_ms：本次查询耗时，单位毫秒
+    """
+
+    searching: bool = False
+    results: list[dict] = []
+    elapsed_ms: float = 0
+
+    @rx.event
+    @profiled
+    async def search(
+        self, form_data: dict[str, Any]
+    ) -> AsyncGenerator:
+        """按关键字和日期范围查询历史记录
+
+        Args:
+            form_data: 前端提交的表单值，包含 query、start_date、end_date
+
+        """
+        self.searching = True
+
+        yield
+
+        try:
+            start = time.perf_counter()
+            self.results = await run_io(
+                search_index.search,
+                query=form_data.get("query", ""),
+                start_date=form_data.get("start_date", ""),
+                end_date=form_data.get("end_date", ""),
+            )
+            self.elapsed_ms = round(
+                (time.perf_counter() - start) * 1000, 1
+            )
+
+        except Exception as e:
+            yield rx.toast.error(f"{e}", close_button=True)
+
+        finally:
+            self.searching = False
+
+
+def search_form() -> rx.Component:
+    return rx.form(
+        rx.hstack(
+            rx.input(
+                name="query",
+                placeholder="输入付款方、收款方、描述等关键字，多个关键字用空格分隔",
+                width="40vw",
+            ),
+            rx.input(name="start_date", type="date"),
+            rx.text("至", size="2"),
+            rx.input(name="end_date", type="date"),
+            rx.button(
+                "搜索",
+                type="submit",
+                color=rx.color("slate", 2),
+                bg=rx.color("slate", 12),
+                loading=SearchState.searching,
+            ),
+            spacing="2",
+            align="center",
+        ),
+        on_submit=SearchState.search,
+    )
+
+
+def table_header() -> rx.Component:
+    """表头"""
+    return rx.table.header(
+        rx.table.row(
+            rx.table.column_header_cell("日期"),
+            rx.table.column_header_cell("付款方"),
+            rx.table.column_header_cell("收款方"),
+            rx.table.column_header_cell("描述"),
+            rx.table.column_header_cell("备注"),
+            rx.table.column_header_cell("金额"),
+            rx.table.column_header_cell("分类"),
+            rx.table.column_header_cell("文件"),
+        )
+    )
+
+
+def render_record(record: dict) -> rx.Component:
+    """渲染一条查询结果"""
+    return rx.table.row(
+        rx.table.cell(record["trade_date"]),
+        rx.table.cell(record["payer"]),
+        rx.table.cell(record["receiver"]),
+        rx.table.cell(record["description"]),
+        rx.table.cell(record["additional_info"]),
+        rx.table.cell(record["amount"]),
+        rx.table.cell(record["category"]),
+        rx.table.cell(
+            rx.cond(
+                record["file_url"],
+                rx.link(
+                    "查看",
+                    href=record["file_url"].to(str),
+                    is_external=True,
+                ),
+                rx.text("-"),
+            )
+        ),
+    )
+
+
+def result_table() -> rx.Component:
+    return rx.vstack(
+        rx.text(
+            f"共 {SearchState.results.length()} 条，耗时 {SearchState.elapsed_ms} 毫秒",
+            size="1",
+        ),
+        rx.table.root(
+            table_header(),
+            rx.table.body(
+                rx.foreach(
+                    iterable=SearchState.results,
+                    render_fn=render_record,
+                ),
+            ),
+            width="90vw",
+        ),
+        align="center",
+    )
+
+
+@rx.page(route="/search", title="历史搜索-EasyOffice")
+@check_password
+def search_page() -> rx.Component:
+    return page_template(
+        search_form(),
+        result_table(),
+    )
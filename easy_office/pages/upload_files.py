@@ -2,7 +2,13 @@ from typing import AsyncGenerator
 
 import reflex as rx
 
-from ..utils.file_process import save_file_list
+from ..utils.blob_store import blob_url
+from ..utils.executor import run_io
+from ..utils.file_process import (
+    release_files,
+    save_file_list,
+)
+from ..utils.profiling import profiled
 from .components.check_password import check_password
 from .components.template import page_template
 from .components.upload_zone import upload_zone
@@ -11,13 +17,14 @@ from .components.upload_zone import upload_zone
 class UploadFileState(rx.State):
     """管理上传文件的 state
     up_loading：目前是否有文件正在上传
-    data：上传文件的信息；list[tuple[str, str]] 第一个 str 是原始文件名，第二个 str 是上传后的文件名
+    data：上传文件的信息；list[tuple[str, str]] 第一个 str 是原始文件名，第二个 str 是文件的下载链接
     """
 
     up_loading: bool = False
     data: rx.Field[list[tuple[str, str]]] = rx.field([])
 
     @rx.event
+    @profiled
     async def upload_file(
         self, files: list[rx.UploadFile]
     ) -> AsyncGenerator:
@@ -30,32 +37,32 @@ class UploadFileState(rx.State):
 
         self.up_loading = True
 
+        # 无法处理的文件，其余文件照常上传
+        failed: dict[str, str] = {}
+
         try:
-            # 上传文件
-            file_list = await save_file_list(files)
-
-            # 原始文件名列表
-            origin_file_name_list: list[str] = [
-                file.filename.strip("./")
-                for file in files
-                if file.filename
-            ]
-
-            # 新文件名列表
-            new_file_name_list: list[str] = [
-                file.name for file in file_list
-            ]
-
-            self.data.extend(
-                list(
-                    zip(
-                        origin_file_name_list,
-                        new_file_name_list,
+            # 逐个保存，多页 PDF 分割出的每一页都对应到原始文件名
+            for file in files:
+                paths = await save_file_list([file], failed)
+                name = (file.filename or "").strip("./")
+                self.data.extend(
+                    (
+                        f"{name} 第 {i} 页"
+                        if len(paths) > 1
+                        else name,
+                        blob_url(path),
                     )
+                    for i, path in enumerate(paths, start=1)
                 )
-            )
+                # 文件已经保存到长期存储，不再需要本地工作副本
+                await run_io(release_files, paths)
 
             yield
+
+            for reason in failed.values():
+                yield rx.toast.error(
+                    reason, close_button=True
+                )
         except Exception as e:
             yield rx.toast.error(f"{e}", close_button=True)
 
@@ -94,10 +101,10 @@ def render_file_data(
     """渲染数据行
 
     Args:
-        file_data (tuple[str, str]): 上传文件的数据，第一个 str 是原始文件名，第二个 str 是上传后的文件名
+        file_data (tuple[str, str]): 上传文件的数据，第一个 str 是原始文件名，第二个 str 是文件的下载链接
 
     """
-    file_url = rx.get_upload_url(file_data[1])
+    file_url = file_data[1]
     return rx.table.row(
         rx.table.cell(file_data[0]),  # 文件名
         rx.table.cell(file_url),  # 文件链接
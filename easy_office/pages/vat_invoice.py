@@ -1,52 +1,116 @@
 import asyncio
-import csv
-from io import StringIO
-from pathlib import Path
 
 import httpx
 import reflex as rx
 from reflex_ag_grid import ag_grid
 
+from ..utils.admission import admitted, watch_queue
+from ..utils.executor import run_io
 from ..utils.file_process import (
-    generate_filename,
+    file_span,
+    generate_random_string,
+    release_files,
     save_file_list,
 )
+from ..utils.metrics import gather_with_queue_depth
+from ..utils.profiling import profiled
+from ..utils.rate_limit import Priority, scheduling
 from ..utils.request_api import Request_Baidu_OCR
+from ..utils.search_index import (
+    index_records,
+    vat_invoice_to_index_record,
+)
+from ..utils.tracing import span
 from .components.check_password import check_password
+from .components.server_grid import (
+    GridEditState,
+    bulk_edit_bar,
+    download_buttons,
+    server_grid,
+)
 from .components.template import page_template
 from .components.upload_zone import upload_zone
 
-CSV_HEADER = [
-    "文件名",
-    "开票日期",
-    "发票号码",
-    "发票种类",
-    "购买方名称",
-    "购买方税号",
-    "销售方名称",
-    "销售方税号",
-    "价税合计",
-]
+GRID_ID = "ag_grid_for_vat_invoice"
 
 
-class VatInvoiceState(rx.State):
-    up_loading: bool = False
-    upload_data: list[dict] = []
+async def ocr_vat_invoices(
+    session: str,
+    files: list[rx.UploadFile],
+    failed: dict[str, str],
+) -> list[dict]:
+    """保存并识别一批发票，每个文件先排队拿到内存预算再处理
 
-    @rx.var
-    def data(self) -> list[dict]:
-        """
-        Ag Grid 组件最好用 computed var 传输数据，用 state var 数据更新会有延迟
-        Returns: 用户上传的数据
+    Args:
+        session: 会话标识，用于排队
+        files: 用户上传的文件
+        failed: 无法处理的文件，原始文件名 → 原因
 
-        """
-        return self.upload_data
+    Returns:
+        list[dict]: 识别结果，带上原始文件名，顺序和上传顺序一致
+    """
+
+    async def _ocr_file(file: rx.UploadFile) -> list[dict]:
+        # 保存、分割和识别都挂在同一个 file span 下面
+        with file_span(file):
+            files_list = await save_file_list(
+                [file], failed, keep=False
+            )
+            try:
+                resp_list = await asyncio.gather(
+                    *(
+                        Request_Baidu_OCR(
+                            file=path
+                        ).vat_invoice()
+                        for path in files_list
+                    )
+                )
+            finally:
+                # 发票文件识别后就不再需要，别的请求没有在用同样的文件时删除
+                await run_io(release_files, files_list)
+
+        # 将原始文件名插入数据中，多页 PDF 的每一页都用原始文件名
+        file_name = (file.filename or "").strip("./")
+        return [
+            {"file_name": file_name, **data}
+            for data in resp_list
+        ]
+
+    # 用户在网页上等结果，百度配额优先给这些请求，各会话之间公平分配
+    with (
+        scheduling(Priority.INTERACTIVE, session),
+        span(
+            "batch",
+            endpoint="vat_invoice",
+            batch_id=generate_random_string(),
+            file_count=len(files),
+        ),
+    ):
+        results = await gather_with_queue_depth(
+            "vat_invoice",
+            [
+                admitted(
+                    session, file.size or 0, _ocr_file(file)
+                )
+                for file in files
+            ],
+        )
+    return [row for rows in results for row in rows]
+
+
+class VatInvoiceState(GridEditState, rx.State):
+    grid_kind = "vat_invoice"
+    grid_id = GRID_ID
 
+    up_loading: bool = False
+    queue_status: str = ""
+
+    @profiled
     async def upload_for_vat_invoice(
         self, files: list[rx.UploadFile]
     ):
         """
-        调用百度云的api，上传用户传入的文件，将返回的数据赋值给 self.upload_data
+        调用百度云的api，上传用户传入的文件，将返回的数据追加到当前批次
         Args:
             files: 用户上传的文件
 
@@ -55,36 +119,38 @@ class VatInvoiceState(rx.State):
 
         yield
 
-        try:
-            files_list = await save_file_list(files)
+        # 无法处理的文件，其余文件照常识别
+        failed: dict[str, str] = {}
+        session = self.router.session.client_token
 
-            tasks = [
-                Request_Baidu_OCR(file=file).vat_invoice()
-                for file in files_list
-            ]
+        try:
+            batch = asyncio.create_task(
+                ocr_vat_invoices(session, files, failed)
+            )
+            # 超出内存预算时排队，期间刷新排队位置
+            async for status in watch_queue(session, batch):
+                self.queue_status = str(status)
+                yield
+            self.queue_status = ""
 
-            resp_list = await asyncio.gather(*tasks)
+            invoice_data = batch.result()
+            await self._add_records(invoice_data)
 
-            # 生成原始的文件名
-            file_name_list = [
-                file.filename for file in files
-            ]
+            yield self._refresh_grid()
 
-            # 将原始文件名插入数据中
-            invoice_data = [
-                {"file_name": file_name.strip("./"), **data}  # type:ignore
-                for data, file_name in zip(
-                    resp_list, file_name_list
+            for reason in failed.values():
+                yield rx.toast.error(
+                    reason, close_button=True
                 )
-            ]
-
-            self.upload_data.extend(invoice_data)  # type:ignore
-
-            yield
 
-            # 识别完成后，删除所有上传的文件
-            # map 返回的是一个生成器，不会立即执行删除，所以需要 list()
-            list(map(Path.unlink, files_list))
+            # 识别结果写入本地搜索索引，发票文件识别后会被删除，所以不保存文件链接
+            await index_records(
+                "vat_invoice",
+                [
+                    vat_invoice_to_index_record(data)
+                    for data in invoice_data
+                ],
+            )
 
         except httpx.ConnectError as e:
             yield rx.toast.error(f"{e}", close_button=True)
@@ -96,38 +162,7 @@ class VatInvoiceState(rx.State):
             self.up_loading = (
                 False  # 提示用户，运行状态结束
             )
-
-    @rx.event
-    def cell_value_changed(
-        self, row, col_field, new_value
-    ) -> None:
-        """
-        同步更新表格
-        Args:
-            row: 更新表格的行数
-            col_field:  更新表格的字段
-            new_value: 用户输入的新值
-
-        """
-
-        self.upload_data[row][col_field] = new_value
-
-    @rx.event
-    def download_result(self):
-        self.up_loading = True
-
-        yield
-
-        csv_io = StringIO()
-        writer = csv.writer(csv_io)
-        writer.writerow(CSV_HEADER)
-        rows = [row.values() for row in self.upload_data]
-        writer.writerows(rows)
-        csv_data = csv_io.getvalue()
-        filename = generate_filename(file_extension=".csv")
-        self.up_loading = False
-        yield
-        yield rx.download(data=csv_data, filename=filename)
+            self.queue_status = ""
 
 
 vat_invoice_column_defs = [
@@ -136,8 +171,8 @@ vat_invoice_column_defs = [
         header_name="文件名",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
     ag_grid.column_def(
@@ -145,8 +180,8 @@ vat_invoice_column_defs = [
         header_name="开票日期",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
     ag_grid.column_def(
@@ -154,8 +189,8 @@ vat_invoice_column_defs = [
         header_name="发票号码",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
     ag_grid.column_def(
@@ -163,8 +198,8 @@ vat_invoice_column_defs = [
         header_name="发票种类",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
     ag_grid.column_def(
@@ -172,8 +207,8 @@ vat_invoice_column_defs = [
         header_name="购买方名称",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
     ag_grid.column_def(
@@ -181,8 +216,8 @@ vat_invoice_column_defs = [
         header_name="购买方税号",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
     ag_grid.column_def(
@@ -190,8 +225,8 @@ vat_invoice_column_defs = [
         header_name="销售方名称",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
     ag_grid.column_def(
@@ -199,8 +234,8 @@ vat_invoice_column_defs = [
         header_name="销售方税号",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
     ag_grid.column_def(
@@ -208,31 +243,21 @@ vat_invoice_column_defs = [
         header_name="价税合计",
         cell_data_type="text",
         editable=True,
-        sortable=False,  # type:ignore
-        filter=None,
+        sortable=True,  # type:ignore
+        filter=ag_grid.filters.text,
         cell_editor=ag_grid.editors.text,
     ),
 ]
 
 
 def ag_grid_zone() -> rx.Component:
-    return ag_grid(
-        id="ag_grid_for_vat_invoice",
-        row_data=VatInvoiceState.data,
-        column_defs=vat_invoice_column_defs,
-        on_cell_value_changed=VatInvoiceState.cell_value_changed,
-        width="90vw",
-        height="60vh",
-    )
-
-
-def download_result_button() -> rx.Component:
-    return rx.button(
-        "下载表格",
-        on_click=VatInvoiceState.download_result,
-        color=rx.color("slate", 2),
-        bg=rx.color("slate", 12),
-        loading=VatInvoiceState.up_loading,
+    return rx.fragment(
+        bulk_edit_bar(
+            VatInvoiceState, vat_invoice_column_defs
+        ),
+        server_grid(
+            VatInvoiceState, vat_invoice_column_defs
+        ),
     )
 
 
@@ -243,12 +268,13 @@ def upload_files_page() -> rx.Component:
         rx.el.div(
             upload_zone(
                 loading=VatInvoiceState.up_loading,
+                status=VatInvoiceState.queue_status,
                 upload_handler=VatInvoiceState.upload_for_vat_invoice(
                     rx.upload_files(upload_id="upload1")  # type:ignore
                 ),
             ),
             ag_grid_zone(),
-            download_result_button(),
+            download_buttons(VatInvoiceState),
             class_name="flex flex-col items-center justify-center w-full space-y-2",
         )
     )
@@ -0,0 +1,8 @@
+from . import (
+    export,
+    files,
+    grid,
+    metrics,
+    profiling,
+    uploads,
+)
@@ -0,0 +1,45 @@
+from starlette.requests import Request
+from starlette.responses import (
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
+
+from ..utils.executor import run_io
+from ..utils.export import FORMATS, TITLES
+from ..utils.file_process import generate_filename
+from ..utils.row_store import row_store
+
+
+async def export_endpoint(request: Request) -> Response:
+    """下载一个批次的识别结果
+
+    路径参数 batch_id 为批次 ID，查询参数 format 为 csv（默认）或 xlsx。
+    按固定的列顺序逐段生成文件，一边生成一边发送，内存占用和行数无关
+    """
+    batch_id = request.path_params["batch_id"]
+    kind = await run_io(row_store.kind, batch_id)
+    if kind is None:
+        return JSONResponse(
+            {"error": "批次不存在或已过期"},
+            status_code=404,
+        )
+
+    fmt = request.query_params.get("format", "csv")
+    if fmt not in FORMATS:
+        return JSONResponse(
+            {"error": f"不支持的格式：{fmt}"},
+            status_code=400,
+        )
+    writer, extension, media_type = FORMATS[fmt]
+    filename = f"{kind}-{generate_filename(extension)}"
+
+    # 同步生成器，Starlette 会放到线程池里迭代，读取 row_store 时不阻塞事件循环
+    return StreamingResponse(
+        writer(TITLES[kind], row_store.iter_rows(batch_id)),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "no-store",
+        },
+    )
@@ -0,0 +1,185 @@
+import mimetypes
+import os
+import re
+from email.utils import formatdate
+from urllib.parse import quote
+
+from starlette.requests import Request
+from starlette.responses import (
+    FileResponse,
+    JSONResponse,
+    RedirectResponse,
+    Response,
+)
+
+from ..utils.blob_store import blob_store, digest_of
+from ..utils.executor import run_io
+from ..utils.metrics import Counter
+from ..utils.storage import storage, upload_dir
+from ..utils.thumbnails import (
+    THUMBNAIL_SIZE,
+    ThumbnailError,
+    thumbnails,
+)
+
+# 只提供按内容哈希命名的文件，路径里不可能出现 .. 之类的跳转
+BLOB_KEY = re.compile(
+    r"blobs/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]{1,8}"
+)
+# 文件名就是内容哈希，内容永远不会变，浏览器和 CDN 可以缓存一年
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+FILES_SERVED = Counter(
+    "easy_office_files_served_total",
+    "/files 接口的响应次数，status 为 200、206、302 或 304",
+    ("status",),
+)
+
+
+class BlobFileResponse(FileResponse):
+    """用内容哈希作为 ETag 的 FileResponse
+
+    Starlette 默认用修改时间和大小生成 ETag，If-Range 也只认这个值，这里改成认哈希
+    """
+
+    # 大 PDF 分块少一些，线程切换也少一些
+    chunk_size = 256 * 1024
+
+    def _should_use_range(  # type:ignore
+        self,
+        http_if_range: str,
+        stat_result: os.stat_result,
+    ) -> bool:
+        return http_if_range in (
+            self.headers["etag"],
+            formatdate(stat_result.st_mtime, usegmt=True),
+        )
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 使用弱比较，忽略 W/ 前缀"""
+    return any(
+        tag.strip() in ("*", etag)
+        or tag.strip().removeprefix("W/") == etag
+        for tag in if_none_match.split(",")
+    )
+
+
+def _lookup(
+    key: str,
+) -> tuple[os.stat_result, str] | None:
+    """读取文件信息和原始文件名，在线程池里执行"""
+    try:
+        stat_result = (upload_dir() / key).stat()
+    except FileNotFoundError:
+        return None
+    record = blob_store.get(digest_of(upload_dir() / key))
+    return stat_result, (
+        record["original_name"] if record else ""
+    )
+
+
+async def _packed_response(
+    key: str, headers: dict[str, str]
+) -> Response:
+    """已经归档的文件从归档包里读出后整个返回，不支持 Range"""
+    digest = digest_of(upload_dir() / key)
+    data = await run_io(blob_store.read_packed, digest)
+    if data is None:
+        return JSONResponse(
+            {"error": "文件不存在"}, status_code=404
+        )
+    record = await run_io(blob_store.get, digest)
+    if record and record["original_name"]:
+        headers = {
+            **headers,
+            "Content-Disposition": f"inline; filename*=utf-8''{quote(record['original_name'])}",
+        }
+    FILES_SERVED.labels(status="200").inc()
+    return Response(
+        data,
+        headers=headers,
+        media_type=mimetypes.guess_type(key)[0],
+    )
+
+
+async def files_endpoint(request: Request) -> Response:
+    """下载保存在本地的上传文件
+
+    路径参数 key 为 blobs/ab/cd/<哈希>.<扩展名>。ETag 就是内容哈希，
+    浏览器带 If-None-Match 再次打开时直接返回 304；支持 Range，
+    大 PDF 可以边下载边显示；文件名带哈希，缓存头设置为 immutable。
+    工作副本已经归档时从归档包里读取，链接不变；保存在对象存储、
+    本地没有工作副本的文件跳转到新生成的预签名链接
+    """
+    key = request.path_params["key"]
+    if not BLOB_KEY.fullmatch(key):
+        return JSONResponse(
+            {"error": "文件不存在"}, status_code=404
+        )
+
+    etag = f'"{digest_of(upload_dir() / key)}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    # 内容由文件名决定，不需要读磁盘就能判断浏览器缓存是否有效
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        FILES_SERVED.labels(status="304").inc()
+        return Response(status_code=304, headers=headers)
+
+    found = await run_io(_lookup, key)
+    if found is None:
+        redirect = storage.redirect_url(key)
+        if redirect is not None:
+            FILES_SERVED.labels(status="302").inc()
+            # 预签名链接会过期，跳转本身不能缓存
+            return RedirectResponse(
+                redirect,
+                status_code=302,
+                headers={"Cache-Control": "no-store"},
+            )
+        return await _packed_response(key, headers)
+    stat_result, original_name = found
+
+    ranged = "range" in request.headers and (
+        request.headers.get("if-range", etag) == etag
+    )
+    FILES_SERVED.labels(
+        status="206" if ranged else "200"
+    ).inc()
+    return BlobFileResponse(
+        upload_dir() / key,
+        headers=headers,
+        media_type=mimetypes.guess_type(key)[0],
+        filename=original_name or None,
+        stat_result=stat_result,
+        content_disposition_type="inline",
+    )
+
+
+async def thumbnail_endpoint(request: Request) -> Response:
+    """上传文件的缩略图，第一次请求时生成并缓存在磁盘上
+
+    路径参数 key 和 /files 相同。表格里逐行核对时只下载几十 KB 的缩略图，
+    不用打开完整的 PDF；缓存头和 ETag 的处理也和 /files 相同
+    """
+    key = request.path_params["key"]
+    if not BLOB_KEY.fullmatch(key):
+        return JSONResponse(
+            {"error": "文件不存在"}, status_code=404
+        )
+
+    etag = f'"{digest_of(upload_dir() / key)}-{THUMBNAIL_SIZE}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        path = await thumbnails.get(key)
+    except ThumbnailError as e:
+        return JSONResponse(
+            {"error": str(e)}, status_code=404
+        )
+    return FileResponse(
+        path, headers=headers, media_type="image/jpeg"
+    )
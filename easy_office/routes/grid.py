@@ -0,0 +1,63 @@
+import json
+import os
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from ..utils.executor import run_io
+from ..utils.row_store import COLUMNS, row_store
+
+GRID_MAX_BLOCK: int = int(
+    os.getenv("GRID_MAX_BLOCK", "500")
+)  # 表格一次最多读取的行数
+
+
+async def rows_endpoint(request: Request) -> JSONResponse:
+    """表格按块读取当前会话的识别结果
+
+    路径参数 kind 为 bank_slip 或 vat_invoice；查询参数 start、end 为行范围，
+    sort_model、filter_model 为 AG Grid 的排序和筛选条件（JSON）。
+    会话通过请求头 X-Reflex-Client-Token 识别，只能读到自己的批次
+    """
+    kind = request.path_params["kind"]
+    if kind not in COLUMNS:
+        return JSONResponse(
+            {"error": f"不支持的类型：{kind}"},
+            status_code=404,
+        )
+
+    params = request.query_params
+    try:
+        start = max(int(params.get("start", 0)), 0)
+        end = min(
+            max(int(params.get("end", start)), start),
+            start + GRID_MAX_BLOCK,
+        )
+        sort_model = json.loads(
+            params.get("sort_model") or "[]"
+        )
+        filter_model = json.loads(
+            params.get("filter_model") or "{}"
+        )
+    except ValueError as e:
+        return JSONResponse(
+            {"error": str(e)}, status_code=400
+        )
+
+    owner = request.headers.get("X-Reflex-Client-Token", "")
+    batch_id = await run_io(row_store.find, owner, kind)
+    if not owner or batch_id is None:
+        return JSONResponse({"rows": [], "row_count": 0})
+
+    # 有排序、筛选时第一次要遍历整个批次，放到线程池里执行
+    rows, row_count = await run_io(
+        row_store.page,
+        batch_id,
+        start,
+        end,
+        sort_model,
+        filter_model,
+    )
+    return JSONResponse(
+        {"rows": rows, "row_count": row_count}
+    )
@@ -0,0 +1,15 @@
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+from ..utils.metrics import render_metrics
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+async def metrics_endpoint(
+    request: Request,
+) -> PlainTextResponse:
+    """Prometheus 抓取指标用的接口"""
+    return PlainTextResponse(
+        render_metrics(), media_type=CONTENT_TYPE
+    )
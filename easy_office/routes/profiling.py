@@ -0,0 +1,58 @@
+import hmac
+import os
+from dataclasses import asdict
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from ..utils.profiling import PROFILABLE, arm, armed
+
+# 管理员口令，未设置时分析接口不可用
+ADMIN_TOKEN: str | None = os.getenv("ADMIN_TOKEN")
+
+
+def is_admin(request: Request) -> bool:
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(
+        token,
+        ADMIN_TOKEN,  # type:ignore
+    )
+
+
+async def profile_endpoint(
+    request: Request,
+) -> JSONResponse:
+    """查看或开启事件处理函数的性能分析
+
+    GET 返回可分析的函数和正在等待分析的任务；
+    POST 的 JSON 参数：handler 函数名，calls 分析次数（0 表示取消），
+    mode 为 sampling 或 cprofile，memory 是否记录内存分配
+    """
+    if not is_admin(request):
+        return JSONResponse(
+            {"error": "forbidden"}, status_code=403
+        )
+
+    if request.method == "POST":
+        body = await request.json()
+        try:
+            arm(
+                name=body["handler"],
+                calls=int(body.get("calls", 1)),
+                mode=body.get("mode", "sampling"),
+                memory=bool(body.get("memory", False)),
+            )
+        except (KeyError, ValueError) as e:
+            return JSONResponse(
+                {"error": str(e)}, status_code=400
+            )
+
+    return JSONResponse(
+        {
+            "profilable": sorted(PROFILABLE),
+            "armed": {
+                name: asdict(request)
+                for name, request in armed().items()
+            },
+        }
+    )
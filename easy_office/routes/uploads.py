@@ -0,0 +1,157 @@
+import base64
+import binascii
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from ..utils.executor import run_io
+from ..utils.resumable_upload import (
+    UPLOAD_MAX_BYTES,
+    ResumableUpload,
+    UploadError,
+    resumable_uploads,
+)
+
+TUS_VERSION = "1.0.0"
+TUS_HEADERS = {
+    "Tus-Resumable": TUS_VERSION,
+    "Cache-Control": "no-store",
+}
+
+
+def _upload_response(
+    upload: ResumableUpload,
+    offset: int,
+    status_code: int = 200,
+    headers: dict[str, str] | None = None,
+) -> JSONResponse:
+    """tus 的头部之外，把偏移也放在正文里
+
+    跨域请求时浏览器读不到没有在 Access-Control-Expose-Headers 里声明的头部
+    """
+    return JSONResponse(
+        {
+            "id": upload.id,
+            "offset": offset,
+            "size": upload.size,
+        },
+        status_code=status_code,
+        headers={
+            **TUS_HEADERS,
+            "Upload-Offset": str(offset),
+            "Upload-Length": str(upload.size),
+            **(headers or {}),
+        },
+    )
+
+
+def _error(e: UploadError) -> JSONResponse:
+    return JSONResponse(
+        {"error": str(e)},
+        status_code=e.status,
+        headers=TUS_HEADERS,
+    )
+
+
+def _filename(metadata: str) -> str:
+    """从 Upload-Metadata 里取出文件名，格式为 key base64值,key base64值"""
+    for item in metadata.split(","):
+        key, _, value = item.strip().partition(" ")
+        if key == "filename":
+            try:
+                return base64.b64decode(value).decode()
+            except (binascii.Error, UnicodeDecodeError):
+                raise UploadError(
+                    "文件名格式不正确"
+                ) from None
+    return ""
+
+
+async def create_upload_endpoint(
+    request: Request,
+) -> Response:
+    """创建分块上传，tus 协议的 creation 扩展
+
+    请求头 Upload-Length 为文件大小，Upload-Metadata 带上 base64 编码的 filename；
+    会话通过请求头 X-Reflex-Client-Token 识别。返回 201，Location 为续传地址
+    """
+    if request.method == "OPTIONS":
+        return Response(
+            status_code=204,
+            headers={
+                **TUS_HEADERS,
+                "Tus-Version": TUS_VERSION,
+                "Tus-Extension": "creation,termination",
+                "Tus-Max-Size": str(UPLOAD_MAX_BYTES),
+            },
+        )
+
+    owner = request.headers.get("X-Reflex-Client-Token", "")
+    try:
+        filename = _filename(
+            request.headers.get("Upload-Metadata", "")
+        )
+        try:
+            size = int(request.headers["Upload-Length"])
+        except (KeyError, ValueError):
+            raise UploadError(
+                "缺少 Upload-Length"
+            ) from None
+        upload = await run_io(
+            resumable_uploads.create, owner, filename, size
+        )
+    except UploadError as e:
+        return _error(e)
+    return _upload_response(
+        upload,
+        0,
+        status_code=201,
+        headers={
+            "Location": f"{request.url.replace(query='')}/{upload.id}"
+        },
+    )
+
+
+async def upload_endpoint(request: Request) -> Response:
+    """续传一个分块上传
+
+    HEAD、GET 返回已经收到的字节数；PATCH 从请求头 Upload-Offset 开始写入请求体，
+    请求体边收边写入磁盘；DELETE 取消上传。Upload-Offset 和服务端不一致时返回 409，
+    浏览器重新查询偏移后续传
+    """
+    owner = request.headers.get("X-Reflex-Client-Token", "")
+    try:
+        upload = await run_io(
+            resumable_uploads.get,
+            request.path_params["upload_id"],
+            owner,
+        )
+        if request.method == "DELETE":
+            await run_io(resumable_uploads.remove, upload)
+            return Response(
+                status_code=204, headers=TUS_HEADERS
+            )
+        if request.method in ("GET", "HEAD"):
+            offset = await run_io(lambda: upload.offset)
+            return _upload_response(upload, offset)
+
+        if (
+            request.headers.get("Content-Type")
+            != "application/offset+octet-stream"
+        ):
+            raise UploadError(
+                "Content-Type 必须是 application/offset+octet-stream",
+                status=415,
+            )
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            raise UploadError(
+                "缺少 Upload-Offset"
+            ) from None
+        offset = await resumable_uploads.append(
+            upload, offset, request.stream()
+        )
+    except UploadError as e:
+        return _error(e)
+    return _upload_response(upload, offset)
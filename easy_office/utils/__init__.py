@@ -1 +1,22 @@
-from . import file_process, log, request_api
+from . import (
+    admission,
+    blob_store,
+    compaction,
+    executor,
+    export,
+    file_process,
+    hedging,
+    log,
+    metrics,
+    profiling,
+    rate_limit,
+    request_api,
+    resumable_upload,
+    row_store,
+    sandbox,
+    search_index,
+    shared_store,
+    storage,
+    thumbnails,
+    tracing,
+)
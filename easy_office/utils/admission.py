@@ -0,0 +1,227 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Coroutine,
+    TypeVar,
+)
+
+from .metrics import Gauge, Histogram
+
+T = TypeVar("T")
+
+ADMISSION_MAX_BYTES: int = (
+    int(os.getenv("ADMISSION_MAX_MB", "256")) * 1024 * 1024
+)  # 全进程同时处理的文件总大小上限
+ADMISSION_MAX_FILES: int = int(
+    os.getenv("ADMISSION_MAX_FILES", "32")
+)  # 全进程同时处理的文件数上限
+ADMISSION_POLL_INTERVAL: float = float(
+    os.getenv("ADMISSION_POLL_INTERVAL", "0.5")
+)  # 排队时刷新前端排队位置的间隔，单位秒
+
+ADMITTED_BYTES = Gauge(
+    "easy_office_admission_in_flight_bytes",
+    "已放行、正在处理的文件总大小（字节）",
+)
+ADMITTED_FILES = Gauge(
+    "easy_office_admission_in_flight_files",
+    "已放行、正在处理的文件数",
+)
+WAITING_FILES = Gauge(
+    "easy_office_admission_waiting_files",
+    "因超出内存预算正在排队的文件数",
+)
+WAIT_SECONDS = Histogram(
+    "easy_office_admission_wait_seconds",
+    "文件从排队到放行的等待时间（秒）",
+)
+
+
+@dataclass
+class _Waiter:
+    size: int
+    future: asyncio.Future = field(repr=False)
+
+
+@dataclass
+class QueueStatus:
+    """一个会话当前的排队情况
+
+    Args:
+        position: 这个会话的下一个文件在轮转中排第几位，0 表示没有排队
+        waiting: 这个会话还在排队的文件数
+    """
+
+    position: int = 0
+    waiting: int = 0
+
+    def __str__(self) -> str:
+        if not self.waiting:
+            return ""
+        return f"排队中：第 {self.position} 位，还有 {self.waiting} 个文件等待处理"
+
+
+class AdmissionController:
+    """全进程的内存预算和准入控制
+
+    同时处理的文件总大小和文件数都有上限，超出的文件按会话排队，
+    各会话轮流放行，一个会话一次上传很多文件也不会让其他会话一直等待。
+    只在事件循环里使用，不需要加锁
+
+    Args:
+        max_bytes: 同时处理的文件总大小上限
+        max_files: 同时处理的文件数上限
+    """
+
+    def __init__(
+        self, max_bytes: int, max_files: int
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.in_flight_bytes = 0
+        self.in_flight_files = 0
+        # 会话 → 排队的文件；字典顺序就是轮转顺序
+        self._queues: OrderedDict[str, deque[_Waiter]] = (
+            OrderedDict()
+        )
+
+    def _fits(self, size: int) -> bool:
+        if self.in_flight_files >= self.max_files:
+            return False
+        # 单个文件超过整个预算时，等其他文件都处理完再单独放行，避免永远等待
+        return (
+            self.in_flight_bytes + size <= self.max_bytes
+            or self.in_flight_files == 0
+        )
+
+    def _acquire(self, size: int) -> None:
+        self.in_flight_bytes += size
+        self.in_flight_files += 1
+        ADMITTED_BYTES.labels().set(self.in_flight_bytes)
+        ADMITTED_FILES.labels().set(self.in_flight_files)
+
+    def _release(self, size: int) -> None:
+        self.in_flight_bytes -= size
+        self.in_flight_files -= 1
+        ADMITTED_BYTES.labels().set(self.in_flight_bytes)
+        ADMITTED_FILES.labels().set(self.in_flight_files)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """按轮转顺序放行排队的文件，直到预算用完"""
+        while self._queues:
+            session, queue = next(
+                iter(self._queues.items())
+            )
+            waiter = queue[0]
+            if waiter.future.cancelled():
+                queue.popleft()
+                if not queue:
+                    del self._queues[session]
+                continue
+            if not self._fits(waiter.size):
+                # 轮到的文件放不下时不跳过它，否则大文件可能永远排不上
+                break
+            queue.popleft()
+            self._acquire(waiter.size)
+            waiter.future.set_result(None)
+            # 这个会话放行一个文件后排到队尾，轮到下一个会话
+            del self._queues[session]
+            if queue:
+                self._queues[session] = queue
+        WAITING_FILES.labels().set(
+            sum(len(q) for q in self._queues.values())
+        )
+
+    @asynccontextmanager
+    async def admit(
+        self, session: str, size: int
+    ) -> AsyncIterator[None]:
+        """排队等待预算，拿到后执行 with 里的代码，结束时归还
+
+        Args:
+            session: 会话标识，同一个会话的文件按顺序放行
+            size: 文件大小，单位字节
+        """
+        waiter = _Waiter(
+            size, asyncio.get_running_loop().create_future()
+        )
+        self._queues.setdefault(session, deque()).append(
+            waiter
+        )
+        start = time.perf_counter()
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if (
+                waiter.future.done()
+                and not waiter.future.cancelled()
+            ):
+                # 放行的同时被取消，要把预算还回去
+                self._release(size)
+            else:
+                self._dispatch()  # 清理已取消的排队
+            raise
+        WAIT_SECONDS.labels().observe(
+            time.perf_counter() - start
+        )
+        try:
+            yield
+        finally:
+            self._release(size)
+
+    def status(self, session: str) -> QueueStatus:
+        queue = self._queues.get(session)
+        if not queue:
+            return QueueStatus()
+        position = list(self._queues).index(session) + 1
+        return QueueStatus(position, len(queue))
+
+
+admission = AdmissionController(
+    ADMISSION_MAX_BYTES, ADMISSION_MAX_FILES
+)
+
+
+async def watch_queue(
+    session: str, task: Awaitable[T]
+) -> AsyncIterator[QueueStatus]:
+    """等待 task 完成，期间定时产出这个会话的排队情况，用于刷新前端
+
+    Args:
+        session: 会话标识
+        task: 要等待的任务
+    """
+    future = asyncio.ensure_future(task)
+    while True:
+        done, _ = await asyncio.wait(
+            {future}, timeout=ADMISSION_POLL_INTERVAL
+        )
+        if done:
+            return
+        yield admission.status(session)
+
+
+async def admitted(
+    session: str, size: int, task: Coroutine[Any, Any, T]
+) -> T:
+    """先排队拿到内存预算，再执行 task
+
+    Args:
+        session: 会话标识
+        size: 文件大小，单位字节
+        task: 处理这个文件的协程
+    """
+    try:
+        async with admission.admit(session, size):
+            return await task
+    finally:
+        task.close()  # 排队时被取消，task 没有执行过，关闭以免告警
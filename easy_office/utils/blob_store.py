@@ -0,0 +1,335 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+from .metrics import Counter
+from .storage import storage, upload_dir, write_atomic
+
+BLOB_INDEX_DB: str = os.getenv(
+    "BLOB_INDEX_DB", "./EasyFinance.db"
+)
+
+# 工作副本保存在上传目录下的这个子目录里，长期存储里的 key 也是同样的相对路径
+BLOB_PREFIX = "blobs"
+# 归档后的旧文件打包保存在上传目录下的这个子目录里
+PACK_PREFIX = "packs"
+
+BLOB_PUTS = Counter(
+    "easy_office_blob_puts_total",
+    "保存上传文件的次数，deduplicated 表示内容已经存在、没有重复写入",
+    ("deduplicated",),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    ext TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    original_name TEXT NOT NULL,
+    upload_count INTEGER NOT NULL DEFAULT 1,
+    refs INTEGER NOT NULL DEFAULT 0,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    last_seen_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS packed (
+    digest TEXT PRIMARY KEY,
+    pack TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    compressed INTEGER NOT NULL,
+    packed_at TEXT NOT NULL
+);
+"""
+
+
+@dataclass(frozen=True)
+class Blob:
+    """按内容哈希命名的文件
+
+    Args:
+        digest: 文件内容的 SHA-256
+        ext: 扩展名，例如 .pdf，取第一次上传时的扩展名
+        size: 文件大小，单位字节
+    """
+
+    digest: str
+    ext: str
+    size: int
+
+    @property
+    def key(self) -> str:
+        """相对上传目录的路径，按哈希的前两级分目录，每级最多 256 个子目录"""
+        d = self.digest
+        return (
+            f"{BLOB_PREFIX}/{d[:2]}/{d[2:4]}/{d}{self.ext}"
+        )
+
+    @property
+    def path(self) -> Path:
+        return upload_dir() / self.key
+
+
+def digest_of(path: Path) -> str:
+    """从文件路径取出内容哈希"""
+    return path.stem
+
+
+def blob_key(path: Path) -> str:
+    """文件在长期存储里的 key，即相对上传目录的路径"""
+    return path.relative_to(upload_dir()).as_posix()
+
+
+def blob_url(path: Path) -> str:
+    """文件的下载链接，写入飞书等外部系统，由 STORAGE_BACKEND 决定链接形式"""
+    return storage.url(blob_key(path))
+
+
+class BlobStore:
+    """内容寻址的上传文件存储
+
+    同样的内容只保存一份。索引记录每个哈希第一次上传时的文件名、大小和上传次数。
+    每个文件在上传目录里有一份识别用的工作副本，用 refs 记录正在使用的请求数，
+    最后一个使用者释放后才删除，不会删掉别人还在用、内容相同的文件。
+    需要长期访问的文件（回单链接、/upload-files 的链接）另外保存到 storage，
+    标记为 pinned，永远不删除；本地存储时工作副本就是保存的文件，同样保留
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.db_path, check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def put(
+        self,
+        data: bytes,
+        ext: str,
+        original_name: str = "",
+        keep: bool = True,
+    ) -> Blob:
+        """保存文件内容，内容已经存在时不重复写入，在线程池里执行
+
+        调用方用完工作副本后必须调用 release
+
+        Args:
+            data: 文件内容
+            ext: 扩展名，例如 .pdf
+            original_name: 用户上传时的文件名，只在第一次保存时记录
+            keep: 是否保存到长期存储，之后可以用 blob_url 取得链接
+
+        Returns:
+            Blob: 保存后的文件
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        now = datetime.now().isoformat(timespec="seconds")
+
+        # 先在索引里登记引用再写文件：释放和删除都在锁里进行，
+        # 登记之后这个文件就不会被别的请求删掉
+        with self._lock, self.conn:
+            # _lock 只管当前进程；IMMEDIATE 事务一开始就拿到写锁，
+            # 其他进程同时保存同样的内容时等这里提交后再查，不会重复 INSERT
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT ext, pinned FROM blobs WHERE digest = ?",
+                (digest,),
+            ).fetchone()
+            if row is None:
+                self.conn.execute(
+                    "INSERT INTO blobs (digest, ext, size, original_name, refs, created_at, last_seen_at)"
+                    " VALUES (?, ?, ?, ?, 1, ?, ?)",
+                    (
+                        digest,
+                        ext.lower(),
+                        len(data),
+                        original_name,
+                        now,
+                        now,
+                    ),
+                )
+                pinned = False
+            else:
+                self.conn.execute(
+                    "UPDATE blobs SET upload_count = upload_count + 1,"
+                    " refs = refs + 1, last_seen_at = ?"
+                    " WHERE digest = ?",
+                    (now, digest),
+                )
+                ext, pinned = (
+                    row["ext"],
+                    bool(row["pinned"]),
+                )
+
+        blob = Blob(digest, ext.lower(), len(data))
+        deduplicated = blob.path.exists()
+        if not deduplicated:
+            write_atomic(blob.path, data)
+        if keep and not pinned:
+            # 上传成功后才标记，同时上传同样内容的请求最多重复上传一次
+            try:
+                storage.save(blob.key, blob.path)
+            except BaseException:
+                # 调用方拿不到 blob，不会再 release，这里释放刚登记的引用
+                self.release(blob.path)
+                raise
+            with self._lock, self.conn:
+                self.conn.execute(
+                    "UPDATE blobs SET pinned = 1 WHERE digest = ?",
+                    (digest,),
+                )
+        BLOB_PUTS.labels(
+            deduplicated=str(deduplicated).lower()
+        ).inc()
+        return blob
+
+    def retain(self, path: Path) -> bool:
+        """给工作副本再加一次引用，用完后同样调用 release
+
+        Returns:
+            bool: 不是 put 保存的文件时返回 False，不要 release，否则会删掉它
+        """
+        with self._lock, self.conn:
+            return (
+                self.conn.execute(
+                    "UPDATE blobs SET refs = refs + 1 WHERE digest = ?",
+                    (digest_of(path),),
+                ).rowcount
+                > 0
+            )
+
+    def release(self, path: Path) -> None:
+        """释放一次工作副本的引用
+
+        没有其他引用时删除工作副本，除非本地存储要用它提供下载；
+        没有 pinned 的文件同时删除索引记录
+        """
+        digest = digest_of(path)
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE blobs SET refs = MAX(refs - 1, 0) WHERE digest = ?",
+                (digest,),
+            )
+            row = self.conn.execute(
+                "SELECT refs, pinned FROM blobs WHERE digest = ?",
+                (digest,),
+            ).fetchone()
+            if row is not None and row["refs"] > 0:
+                return
+            if row is None or not row["pinned"]:
+                self.conn.execute(
+                    "DELETE FROM blobs WHERE digest = ?",
+                    (digest,),
+                )
+                path.unlink(missing_ok=True)
+            elif not storage.keeps_local_copy:
+                path.unlink(missing_ok=True)
+
+    def read(self, key: str) -> bytes:
+        """读取文件内容，已经归档的文件从归档包里读取，在线程池里执行
+
+        Raises:
+            FileNotFoundError: 文件不存在
+        """
+        try:
+            return storage.read(key)
+        except FileNotFoundError:
+            data = self.read_packed(digest_of(Path(key)))
+            if data is None:
+                raise
+            return data
+
+    def read_packed(self, digest: str) -> bytes | None:
+        """从归档包里读取文件内容，没有归档时返回 None"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT * FROM packed WHERE digest = ?",
+                (digest,),
+            ).fetchone()
+        if row is None:
+            return None
+        with (
+            upload_dir() / PACK_PREFIX / row["pack"]
+        ).open("rb") as f:
+            f.seek(row["offset"])
+            data = f.read(row["length"])
+        return (
+            zlib.decompress(data)
+            if row["compressed"]
+            else data
+        )
+
+    def archive_candidates(self, before: str) -> list[dict]:
+        """需要长期保存、当前没有人在用、在 before 之前上传的文件，带上是否已经归档"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT blobs.*, packed.digest IS NOT NULL AS archived"
+                " FROM blobs LEFT JOIN packed USING (digest)"
+                " WHERE pinned = 1 AND refs = 0 AND created_at < ?"
+                " ORDER BY created_at",
+                (before,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def record_packed(
+        self, entries: list[tuple[str, str, int, int, bool]]
+    ) -> None:
+        """登记归档位置，调用前归档包必须已经写入磁盘
+
+        Args:
+            entries: (哈希, 归档包, 偏移, 长度, 是否 zlib 压缩) 的列表
+        """
+        now = datetime.now().isoformat(timespec="seconds")
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO packed (digest, pack, offset, length, compressed, packed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(*entry, now) for entry in entries],
+            )
+
+    def drop_local(self, path: Path) -> bool:
+        """删除已经归档、当前没有人在用的工作副本，返回是否删除
+
+        检查引用和删除文件在同一个写事务里：其他进程的 put 登记引用要等这里结束，
+        登记之后会发现工作副本不存在，重新写入
+        """
+        with self._lock, self.conn:
+            # IMMEDIATE 事务一开始就拿到写锁，检查之后不会再有新的引用
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT refs FROM blobs JOIN packed USING (digest)"
+                " WHERE digest = ?",
+                (digest_of(path),),
+            ).fetchone()
+            if row is None or row["refs"] > 0:
+                return False
+            path.unlink(missing_ok=True)
+            return True
+
+    def get(self, digest: str) -> dict | None:
+        """返回索引里的记录：文件名、大小、上传次数等"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT * FROM blobs WHERE digest = ?",
+                (digest,),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+
+blob_store = BlobStore(BLOB_INDEX_DB)
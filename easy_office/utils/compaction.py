@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import contextlib
+import fcntl
+import os
+import zlib
+from collections import Counter as TallyCounter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import AsyncIterator
+
+from .blob_store import PACK_PREFIX, Blob, blob_store
+from .executor import run_io
+from .log import logger
+from .metrics import Counter
+from .storage import storage, upload_dir
+
+COMPACTION_AGE_DAYS: int = int(
+    os.getenv("COMPACTION_AGE_DAYS", "90")
+)  # 上传多少天之后归档
+COMPACTION_INTERVAL: float = float(
+    os.getenv("COMPACTION_INTERVAL", "0")
+)  # 后端每隔多少秒自动归档一次，0 表示不自动归档，可以用 cron 执行本模块
+PACK_MAX_BYTES: int = int(
+    os.getenv("PACK_MAX_BYTES", str(256 * 1024 * 1024))
+)  # 单个归档包的大小上限
+# 每归档这么多个文件写一次磁盘、登记一次索引、删除一批工作副本
+PACK_BATCH = 100
+# zlib 压缩至少省下这个比例才压缩，否则原样保存，读取时不用解压
+PACK_MIN_SAVING = 0.1
+# 这些格式本身已经压缩过，zlib 省不下空间，不用试，直接原样保存
+PACK_STORED_EXTS = frozenset((".jpg", ".jpeg", ".png"))
+
+COMPACTION_RECLAIMED = Counter(
+    "easy_office_compaction_reclaimed_bytes_total",
+    "归档释放的磁盘空间",
+)
+
+
+def encode(data: bytes, ext: str) -> tuple[bytes, bool]:
+    """归档包里保存的内容，返回 (内容, 是否 zlib 压缩)，在线程池里执行
+
+    只用 zlib 压缩，解压后和原文件逐字节相同：/files 仍然用内容哈希作为强 ETag
+    并允许永久缓存，缩略图也从同样的内容生成。不重新编码 JPEG、PNG、PDF，
+    重新编码即使画面不变，字节也会变。所以归档省下的主要是小文件占用的磁盘块，
+    以及 BMP、内容流没有压缩的 PDF 这类还能压缩的文件
+    """
+    if ext.lower() in PACK_STORED_EXTS:
+        return data, False
+    compressed = zlib.compress(data, 6)
+    if len(compressed) < len(data) * (1 - PACK_MIN_SAVING):
+        return compressed, True
+    return data, False
+
+
+@dataclass
+class CompactionReport:
+    """一次归档的结果
+
+    Args:
+        files: 归档的文件数，按扩展名统计
+        removed: 之前已经归档、这次只删除了重新出现的工作副本的文件数
+        bytes_before: 处理前占用的磁盘空间
+        bytes_after: 处理后占用的磁盘空间
+    """
+
+    files: TallyCounter = field(
+        default_factory=TallyCounter
+    )
+    removed: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+
+    @property
+    def reclaimed(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+    def __str__(self) -> str:
+        by_ext = "，".join(
+            f"{ext or '无扩展名'} {count} 个"
+            for ext, count in self.files.most_common()
+        )
+        return (
+            f"归档 {sum(self.files.values())} 个文件（{by_ext or '无'}），"
+            f"清理 {self.removed} 个重复的工作副本；"
+            f"{_format_size(self.bytes_before)} → {_format_size(self.bytes_after)}，"
+            f"释放 {_format_size(self.reclaimed)}"
+        )
+
+
+def _format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024  # type:ignore
+    return f"{size:.1f}GB"
+
+
+class PackWriter:
+    """往归档包末尾追加文件，超过 PACK_MAX_BYTES 时换一个新的归档包"""
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self._file = None
+        self._name = ""
+
+    def _open(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        packs = sorted(self.root.glob("*.pack"))
+        if (
+            packs
+            and packs[-1].stat().st_size < self.max_bytes
+        ):
+            path = packs[-1]
+        else:
+            path = (
+                self.root
+                / f"{datetime.now():%Y%m%d%H%M%S}-{len(packs):04d}.pack"
+            )
+        self._file = path.open("ab")
+        self._name = path.name
+
+    def append(self, data: bytes) -> tuple[str, int]:
+        """追加一个文件，返回 (归档包, 偏移)"""
+        if (
+            self._file is not None
+            and self._file.tell() + len(data)
+            > self.max_bytes
+        ):
+            self.close()
+        if self._file is None:
+            self._open()
+        assert self._file is not None
+        offset = self._file.tell()
+        self._file.write(data)
+        return self._name, offset
+
+    def sync(self) -> None:
+        """确保已经追加的内容写入磁盘，之后才能登记索引、删除工作副本"""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+@contextlib.contextmanager
+def _exclusive(path: Path):
+    """多个后端进程共用上传目录时，同一时间只有一个进程在归档"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+async def _pack_blob(
+    row: dict, writer: PackWriter, dry_run: bool
+) -> tuple[tuple[str, str, int, int, bool], int] | None:
+    """压缩并追加一个文件，返回 (归档位置, 占用的字节数)"""
+    path = Blob(row["digest"], row["ext"], row["size"]).path
+    try:
+        data = await run_io(path.read_bytes)
+    except FileNotFoundError:
+        return None
+    stored, use_zlib = await run_io(
+        encode, data, row["ext"]
+    )
+    if dry_run:
+        return ("", "", 0, 0, use_zlib), len(stored)
+    pack, offset = await run_io(writer.append, stored)
+    return (
+        row["digest"],
+        pack,
+        offset,
+        len(stored),
+        use_zlib,
+    ), len(stored)
+
+
+async def _flush(
+    writer: PackWriter,
+    entries: list[tuple[str, str, int, int, bool]],
+    paths: list[Path],
+) -> None:
+    await run_io(writer.sync)
+    await run_io(blob_store.record_packed, entries)
+    for path in paths:
+        # 正在被识别的文件这次先不删除，下次归档时再删除
+        await run_io(blob_store.drop_local, path)
+    entries.clear()
+    paths.clear()
+
+
+async def compact(
+    older_than_days: int = COMPACTION_AGE_DAYS,
+    dry_run: bool = False,
+) -> CompactionReport:
+    """把上传超过 older_than_days 天的文件打包归档，能压缩的用 zlib 压缩
+
+    归档包是直接拼接的文件内容，位置登记在 blob_store 的 packed 表里，
+    /files 和缩略图在工作副本不存在时从归档包读取，原来的链接不受影响。
+    只处理本地存储，对象存储请使用存储自身的生命周期规则
+
+    Args:
+        older_than_days: 上传多少天之后归档
+        dry_run: 只统计能释放多少空间，不修改任何文件
+    """
+    report = CompactionReport()
+    if not storage.keeps_local_copy:
+        logger.info("文件保存在对象存储里，跳过归档")
+        return report
+
+    root = upload_dir() / PACK_PREFIX
+    with _exclusive(root / ".lock") as acquired:
+        if not acquired:
+            logger.info("另一个进程正在归档，跳过")
+            return report
+
+        before = (
+            datetime.now() - timedelta(days=older_than_days)
+        ).isoformat(timespec="seconds")
+        rows = await run_io(
+            blob_store.archive_candidates, before
+        )
+        writer = PackWriter(root, PACK_MAX_BYTES)
+        entries: list[tuple[str, str, int, int, bool]] = []
+        paths: list[Path] = []
+        try:
+            for row in rows:
+                path = Blob(
+                    row["digest"], row["ext"], row["size"]
+                ).path
+                try:
+                    size = (await run_io(path.stat)).st_size
+                except FileNotFoundError:
+                    continue
+                if row["archived"]:
+                    # 归档之后又有人上传了同样的内容，留下了新的工作副本
+                    if dry_run or await run_io(
+                        blob_store.drop_local, path
+                    ):
+                        report.removed += 1
+                        report.bytes_before += size
+                    continue
+
+                packed = await _pack_blob(
+                    row, writer, dry_run
+                )
+                if packed is None:
+                    continue
+                entry, stored = packed
+                report.files[row["ext"]] += 1
+                report.bytes_before += size
+                report.bytes_after += stored
+                if not dry_run:
+                    entries.append(entry)
+                    paths.append(path)
+                    if len(entries) >= PACK_BATCH:
+                        await _flush(writer, entries, paths)
+            if entries:
+                await _flush(writer, entries, paths)
+        finally:
+            await run_io(writer.close)
+
+    if not dry_run:
+        COMPACTION_RECLAIMED.labels().inc(
+            max(report.reclaimed, 0)
+        )
+    logger.info(f"归档完成：{report}")
+    return report
+
+
+@contextlib.asynccontextmanager
+async def compaction_lifespan() -> AsyncIterator[None]:
+    """设置了 COMPACTION_INTERVAL 时，后端运行期间定时归档旧文件"""
+    if COMPACTION_INTERVAL <= 0:
+        yield
+        return
+
+    async def _loop() -> None:
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL)
+            try:
+                await compact()
+            except Exception:
+                logger.exception("归档失败")
+
+    task = asyncio.create_task(_loop())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="归档上传超过一定天数的文件，输出释放的磁盘空间"
+    )
+    parser.add_argument(
+        "--days", type=int, default=COMPACTION_AGE_DAYS
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="只统计，不修改文件",
+    )
+    args = parser.parse_args()
+    print(asyncio.run(compact(args.days, args.dry_run)))
@@ -0,0 +1,128 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, TypeVar
+
+from .log import logger
+from .metrics import Counter, Histogram
+from .sandbox import SandboxPool
+
+T = TypeVar("T")
+
+IO_WORKERS: int = int(os.getenv("IO_WORKERS", "16"))
+CPU_WORKERS: int = int(
+    os.getenv(
+        "CPU_WORKERS", str(min(4, os.cpu_count() or 1))
+    )
+)
+LOOP_LAG_INTERVAL: float = float(
+    os.getenv("LOOP_LAG_INTERVAL", "0.5")
+)  # 事件循环检测间隔，单位秒
+LOOP_LAG_THRESHOLD: float = float(
+    os.getenv("LOOP_LAG_THRESHOLD", "0.1")
+)  # 事件循环卡顿超过这个时间就记录告警，单位秒
+
+LOOP_LAG_SECONDS = Histogram(
+    "easy_office_event_loop_lag_seconds",
+    "事件循环实际唤醒时间与预期的差值（秒）",
+    buckets=(
+        0.001,
+        0.005,
+        0.01,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+    ),
+)
+LOOP_STALLS = Counter(
+    "easy_office_event_loop_stalls_total",
+    "事件循环卡顿超过阈值的次数",
+)
+
+_io_pool: ThreadPoolExecutor | None = None
+_cpu_pool: SandboxPool | None = None
+
+
+def io_pool() -> ThreadPoolExecutor:
+    global _io_pool
+    if _io_pool is None:
+        _io_pool = ThreadPoolExecutor(
+            max_workers=IO_WORKERS, thread_name_prefix="io"
+        )
+    return _io_pool
+
+
+def cpu_pool() -> SandboxPool:
+    global _cpu_pool
+    if _cpu_pool is None:
+        _cpu_pool = SandboxPool(max_workers=CPU_WORKERS)
+    return _cpu_pool
+
+
+async def run_io(
+    func: Callable[..., T], *args: Any, **kwargs: Any
+) -> T:
+    """在线程池里执行阻塞的 I/O 操作，例如读写文件、同步 HTTP 请求
+
+    contextvars 会一起带到线程里，日志和 span 仍然能关联到当前任务
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(
+        contextvars.copy_context().run,
+        func,
+        *args,
+        **kwargs,
+    )
+    return await loop.run_in_executor(io_pool(), call)
+
+
+async def run_cpu(
+    func: Callable[..., T], *args: Any, **kwargs: Any
+) -> T:
+    """在带资源限制的进程池里执行 CPU 密集的操作，例如解析和分割 PDF
+
+    func 和参数都必须可以 pickle，所以 func 只能是模块顶层函数；
+    超时、超出 CPU 时间或内存上限、工作进程崩溃时抛出 sandbox.WorkerError
+    """
+    return await cpu_pool().run(func, *args, **kwargs)
+
+
+async def monitor_loop_lag() -> None:
+    """定时睡眠，根据实际唤醒时间和预期的差值判断事件循环是否被阻塞"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = (
+            time.perf_counter() - start - LOOP_LAG_INTERVAL
+        )
+        LOOP_LAG_SECONDS.labels().observe(max(lag, 0))
+        if lag > LOOP_LAG_THRESHOLD:
+            LOOP_STALLS.labels().inc()
+            logger.warning(
+                f"事件循环被阻塞 {lag * 1000:.0f}ms，超过阈值 {LOOP_LAG_THRESHOLD * 1000:.0f}ms"
+            )
+
+
+@contextlib.asynccontextmanager
+async def executor_lifespan() -> AsyncIterator[None]:
+    """随应用启动事件循环监控，应用退出时关闭线程池和进程池"""
+    monitor = asyncio.create_task(monitor_loop_lag())
+    try:
+        yield
+    finally:
+        monitor.cancel()
+        if _io_pool is not None:
+            _io_pool.shutdown(
+                wait=False, cancel_futures=True
+            )
+        if _cpu_pool is not None:
+            _cpu_pool.shutdown()
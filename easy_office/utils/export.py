@@ -0,0 +1,187 @@
+import csv
+import io
+import itertools
+import re
+import zipfile
+from typing import Any, Iterable, Iterator
+from xml.sax.saxutils import escape
+
+# 每种批次导出时的表头，和 row_store.COLUMNS 一一对应
+TITLES: dict[str, tuple[str, ...]] = {
+    "bank_slip": (
+        "交易日期",
+        "项目描述",
+        "备注",
+        "金额",
+        "分类",
+        "付款方",
+        "收款方",
+        "银行回单",
+        "任务 ID",
+    ),
+    "vat_invoice": (
+        "文件名",
+        "开票日期",
+        "发票号码",
+        "发票种类",
+        "购买方名称",
+        "购买方税号",
+        "销售方名称",
+        "销售方税号",
+        "价税合计",
+    ),
+}
+
+# 攒到这么多字节或者行再交给响应，避免每一行都是一次网络写入
+FLUSH_BYTES = 64 * 1024
+FLUSH_ROWS = 500
+
+
+class _Buffer(io.RawIOBase):
+    """只能追加写入、不能 seek 的缓冲区，写满一段就取走，内存占用和总行数无关"""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:  # type:ignore
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def iter_csv(
+    titles: Iterable[str], rows: Iterable[list[Any]]
+) -> Iterator[bytes]:
+    """逐段生成 CSV，带 BOM，Excel 直接打开不会乱码
+
+    Args:
+        titles: 表头
+        rows: 按表头顺序排列的行
+    """
+    text = io.StringIO()
+    writer = csv.writer(text)
+    text.write("\ufeff")
+    writer.writerow(titles)
+
+    rows = iter(rows)
+    # 每次写一批行，比逐行检查缓冲区大小快
+    while chunk := list(itertools.islice(rows, FLUSH_ROWS)):
+        writer.writerows(chunk)
+        yield text.getvalue().encode()
+        text.seek(0)
+        text.truncate()
+    if text.tell():  # 没有数据时只有表头
+        yield text.getvalue().encode()
+
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>"""
+
+_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+</Relationships>"""
+
+_SHEET_HEAD = b"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>"""
+
+_SHEET_TAIL = b"</sheetData></worksheet>"
+
+# XML 1.0 不允许的控制字符，OCR 结果里偶尔会出现
+_ILLEGAL_XML_CHARS = re.compile(
+    r"[\x00-\x08\x0b\x0c\x0e-\x1f]"
+)
+
+
+def _xlsx_cell(value: Any) -> str:
+    if isinstance(value, (int, float)) and not isinstance(
+        value, bool
+    ):
+        return f"<c><v>{value}</v></c>"
+    text = _ILLEGAL_XML_CHARS.sub(
+        "", "" if value is None else str(value)
+    )
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+
+def _xlsx_row(values: Iterable[Any]) -> bytes:
+    return (
+        "<row>"
+        + "".join(_xlsx_cell(v) for v in values)
+        + "</row>"
+    ).encode()
+
+
+def iter_xlsx(
+    titles: Iterable[str], rows: Iterable[list[Any]]
+) -> Iterator[bytes]:
+    """逐段生成只有一个工作表的 XLSX
+
+    XLSX 是 zip 包，工作表用内联字符串逐行写入压缩流，不需要共享字符串表，
+    也不需要先把整个文件放进内存
+
+    Args:
+        titles: 表头
+        rows: 按表头顺序排列的行
+    """
+    buffer = _Buffer()
+    with zipfile.ZipFile(
+        buffer, "w", compression=zipfile.ZIP_DEFLATED
+    ) as archive:
+        archive.writestr(
+            "[Content_Types].xml", _CONTENT_TYPES
+        )
+        archive.writestr("_rels/.rels", _RELS)
+        archive.writestr("xl/workbook.xml", _WORKBOOK)
+        archive.writestr(
+            "xl/_rels/workbook.xml.rels", _WORKBOOK_RELS
+        )
+        with archive.open(
+            "xl/worksheets/sheet1.xml",
+            "w",
+            force_zip64=True,
+        ) as sheet:
+            sheet.write(_SHEET_HEAD)
+            sheet.write(_xlsx_row(titles))
+            for row in rows:
+                sheet.write(_xlsx_row(row))
+                if buffer.size >= FLUSH_BYTES:
+                    yield buffer.drain()
+            sheet.write(_SHEET_TAIL)
+    yield buffer.drain()
+
+
+# 导出格式 → (生成函数, 扩展名, Content-Type)
+FORMATS = {
+    "csv": (iter_csv, ".csv", "text/csv; charset=utf-8"),
+    "xlsx": (
+        iter_xlsx,
+        ".xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ),
+}
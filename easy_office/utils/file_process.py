@@ -1,12 +1,40 @@
+import os
 import random
 import string
+from contextlib import contextmanager
 from datetime import datetime
 from io import BytesIO
 from pathlib import Path
+from typing import Iterator
 
 import reflex as rx
 from pypdf import PdfReader, PdfWriter
 
+from .blob_store import blob_store
+from .executor import run_cpu, run_io
+from .log import logger
+from .metrics import track_stage
+from .resumable_upload import (
+    UPLOAD_IMAGE_MAX_BYTES,
+    ResumableUpload,
+    resumable_uploads,
+    size_limit,
+)
+from .tracing import Span, current_span, span
+
+PDF_SPLIT_BATCH: int = int(
+    os.getenv("PDF_SPLIT_BATCH", "8")
+)  # 分块上传的 PDF 每次分割多少页，内存占用只和这么多页有关
+
+
+class FileProcessError(Exception):
+    """单个上传文件无法处理，例如 PDF 损坏、解析超时或超出资源限制"""
+
+
+def _reason(e: Exception) -> str:
+    """工作进程里抛出的异常的说明，有的异常没有消息，用类型名"""
+    return str(e) or type(e).__name__
+
 
 def generate_random_string(length: int = 12) -> str:
     """生成指定长度的随机字符串"""
@@ -33,73 +61,308 @@ def generate_filename(file_extension: str, length=6) -> str:
     return new_file_name
 
 
-async def save_file(file: rx.UploadFile) -> Path:
+async def save_bytes(
+    upload_data: bytes,
+    file_extension: str,
+    original_name: str = "",
+    keep: bool = True,
+) -> Path:
+    """把文件内容保存到上传目录，按内容哈希命名，同样的内容只保存一份，写文件在线程池里执行
+
+    keep 为 True 时同时保存到 STORAGE_BACKEND 指定的长期存储
+
+    Args:
+        upload_data: 文件内容
+        file_extension: 文件扩展名，例如：.pdf
+        original_name: 用户上传时的文件名，记录在索引里
+        keep: 是否保存到长期存储，需要链接的文件（回单、文件上传页）为 True
+
+    Returns:
+        Path: 本地工作副本的路径，用完后调用 release_files
+    """
+    with track_stage("save_file", endpoint="upload"):
+        blob = await run_io(
+            blob_store.put,
+            upload_data,
+            file_extension,
+            original_name,
+            keep,
+        )
+
+    return blob.path
+
+
+async def save_file(
+    file: rx.UploadFile, keep: bool = True
+) -> Path:
     file_name = file.filename.lower()  # type: ignore
     ext = "." + file_name.split(".")[-1]
-    new_filename = generate_filename(
-        ext, length=6
-    )  # 用时间和随机字符串给文件重新命名
-    upload_file: Path = (
-        rx.get_upload_dir() / new_filename
-    )  # 创建一个保存上传文件的地址,默认保存文件的目录是 upload_files
     upload_data: bytes = await file.read()
+    return await save_bytes(
+        upload_data, ext, file.filename or "", keep
+    )
+
+
+def split_pdf_pages(pdf_data: bytes) -> list[bytes]:
+    """解析PDF，多页则分割成单页，在进程池里执行
+
+    Args:
+        pdf_data: PDF 文件内容
+
+    Returns:
+        list[bytes]: 每一页的 PDF 内容；单页 PDF 返回空列表，表示不需要分割
+    """
+    reader = PdfReader(BytesIO(pdf_data))
+    if len(reader.pages) <= 1:
+        return []
+
+    pages: list[bytes] = []
+    for page in reader.pages:
+        writer = PdfWriter()
+        writer.add_page(page)
+        with BytesIO() as bytes_stream:
+            writer.write(bytes_stream)
+            pages.append(bytes_stream.getvalue())
+    return pages
+
+
+def count_pdf_pages(path: str) -> int:
+    """PDF 的页数，在进程池里执行"""
+    with open(path, "rb") as f:
+        return len(PdfReader(f).pages)
+
+
+def split_pdf_range(
+    path: str, start: int, stop: int
+) -> list[bytes]:
+    """把 PDF 的第 start 到 stop - 1 页分割成单页，在进程池里执行
+
+    传入打开的文件而不是路径，pypdf 按需读取对象，不会把整个文件读进内存
+    """
+    pages: list[bytes] = []
+    with open(path, "rb") as f:
+        reader = PdfReader(f)
+        for page in reader.pages[start:stop]:
+            writer = PdfWriter()
+            writer.add_page(page)
+            with BytesIO() as bytes_stream:
+                writer.write(bytes_stream)
+                pages.append(bytes_stream.getvalue())
+    return pages
+
+
+async def process_pdf_upload(
+    upload: ResumableUpload, keep: bool = True
+) -> list[Path]:
+    """处理分块上传的 PDF，直接从磁盘按页分割，每次只分割 PDF_SPLIT_BATCH 页
 
-    with upload_file.open("wb") as file_object:
-        file_object.write(
-            upload_data
-        )  # 把文件保存到指定目录
+    几十页的扫描件也不会整个读进内存，每批分割都是单独的进程池任务，
+    受同样的超时和资源限制
+    """
+    path = str(upload.path)
+    name = upload.filename
+    try:
+        with track_stage("pdf_split", endpoint="upload"):
+            count = await run_cpu(count_pdf_pages, path)
+    except Exception as e:
+        # 工作进程原样抛出子进程里的异常：损坏的 PDF 除了 PyPdfError，
+        # 还可能让 pypdf 抛出 TypeError、KeyError 等，都只算这一个文件失败
+        raise FileProcessError(
+            f"{name} 无法处理：{_reason(e)}"
+        ) from e
+
+    # 单页 PDF 直接保存
+    if count <= 1:
+        data = await run_io(upload.path.read_bytes)
+        return [await save_bytes(data, ".pdf", name, keep)]
 
-    return upload_file
+    files: list[Path] = []
+    try:
+        for start in range(0, count, PDF_SPLIT_BATCH):
+            try:
+                with track_stage(
+                    "pdf_split", endpoint="upload"
+                ):
+                    pages = await run_cpu(
+                        split_pdf_range,
+                        path,
+                        start,
+                        start + PDF_SPLIT_BATCH,
+                    )
+            except Exception as e:
+                raise FileProcessError(
+                    f"{name} 第 {start + 1} 页之后无法处理：{_reason(e)}"
+                ) from e
+            for i, page in enumerate(
+                pages, start=start + 1
+            ):
+                files.append(
+                    await save_bytes(
+                        page, ".pdf", f"{name}#{i}", keep
+                    )
+                )
+    except BaseException:
+        # 已经保存的页面没有人会再用到，释放工作副本
+        await run_io(release_files, files)
+        raise
+    return files
 
 
 async def process_pdf_file(
-    pdf_file: rx.UploadFile,
+    pdf_file: rx.UploadFile, keep: bool = True
 ) -> list[Path]:
     """处理PDF文件，如果是多页则分割成单页"""
-    pdf_file.file.seek(0)  # 确保从文件开始读取
-    reader = PdfReader(pdf_file.file)
+    await pdf_file.seek(0)  # 确保从文件开始读取
+    pdf_data: bytes = await pdf_file.read()
+
+    # 解析和分割 PDF 是 CPU 密集操作，放到带资源限制的进程池里，
+    # 不阻塞事件循环，损坏或恶意构造的 PDF 也不会拖垮整个后端
+    try:
+        with track_stage("pdf_split", endpoint="upload"):
+            pages = await run_cpu(split_pdf_pages, pdf_data)
+    except Exception as e:
+        # 同 process_pdf_upload，工作进程里的任何异常都只算这一个文件失败
+        raise FileProcessError(
+            f"{pdf_file.filename} 无法处理：{_reason(e)}"
+        ) from e
+
+    name = pdf_file.filename or ""
 
     # 单页PDF直接保存
-    if len(reader.pages) <= 1:
-        pdf_file.file.seek(0)  # 重置文件指针
-        saved_file = await save_file(pdf_file)
-        return [saved_file]
+    if not pages:
+        return [
+            await save_bytes(pdf_data, ".pdf", name, keep)
+        ]
 
-    # 多页PDF进行分割
-    saved_files: list[Path] = []
-    for i, page in enumerate(reader.pages):
-        writer = PdfWriter()
-        writer.add_page(page)
+    # 多页PDF保存分割后的每一页
+    return [
+        await save_bytes(page, ".pdf", f"{name}#{i}", keep)
+        for i, page in enumerate(pages, start=1)
+    ]
 
-        with BytesIO() as bytes_stream:
-            writer.write(bytes_stream)
-            bytes_stream.seek(0)
 
-            split_pdf = rx.UploadFile(
-                file=bytes_stream,
-                filename=f"{pdf_file.filename.rsplit('.', 1)[0]}-page{i+1}.pdf",  # type:ignore
-            )
-            saved_file = await save_file(split_pdf)
-            saved_files.append(saved_file)
+async def save_upload(
+    upload: ResumableUpload, keep: bool = True
+) -> Path:
+    """保存分块上传的图片文件"""
+    if upload.size > size_limit(upload.filename):
+        # 创建上传时已经检查过，这里防止配置改小之前创建的上传
+        raise FileProcessError(
+            f"{upload.filename} 超过 {size_limit(upload.filename) / 1024 / 1024:.0f}MB"
+        )
+    file_name = upload.filename.lower()
+    ext = "." + file_name.split(".")[-1]
+    data = await run_io(upload.path.read_bytes)
+    return await save_bytes(
+        data, ext, upload.filename, keep
+    )
 
-    return saved_files
+
+def working_set(
+    file: rx.UploadFile | ResumableUpload,
+) -> int:
+    """处理一个上传文件大约占用的内存，用来申请 admission 的内存预算
+
+    分块上传的 PDF 从磁盘按页分割、逐页识别，内存占用和整个文件的大小无关，
+    最多按一张图片的上限计算；其他文件整个读进内存，按文件大小计算
+    """
+    size = file.size or 0
+    if isinstance(
+        file, ResumableUpload
+    ) and file.filename.lower().endswith(".pdf"):
+        return min(size, UPLOAD_IMAGE_MAX_BYTES)
+    return size
+
+
+@contextmanager
+def file_span(
+    file: rx.UploadFile | ResumableUpload,
+) -> Iterator[Span]:
+    """一个上传文件的 span，保存、分割和识别都挂在它下面
+
+    已经在 file span 里时直接沿用，save_file_list 不会再嵌套一层
+    """
+    parent = current_span()
+    if parent is not None and parent.name == "file":
+        yield parent
+        return
+    with span(
+        "file", file_name=file.filename, size=file.size
+    ) as file_trace:
+        yield file_trace
 
 
 async def save_file_list(
-    files: list[rx.UploadFile],
+    files: list[rx.UploadFile] | list[ResumableUpload],
+    failed: dict[str, str] | None = None,
+    keep: bool = True,
 ) -> list[Path]:
+    """保存上传的文件，多页 PDF 会被分割成单页
+
+    Args:
+        files: 用户上传的文件，或者分块上传完成的文件
+        failed: 传入时，无法处理的文件会被跳过，原始文件名和原因记录在这里；
+            不传时遇到无法处理的文件直接抛出 FileProcessError
+        keep: 是否保存到长期存储，需要链接的文件为 True
+
+    Returns:
+        list[Path]: 本地工作副本的路径，用完后调用 release_files
+    """
     files_list: list[Path] = []
 
     for file in files:
         file_name = file.filename.lower()  # type: ignore
         file_suffix = "." + file_name.split(".")[-1]
 
-        if file_suffix == ".pdf":
-            pdf_list = await process_pdf_file(file)
-
-            files_list.extend(pdf_list)
+        saved_from = len(files_list)
+        with file_span(file) as file_trace:
+            try:
+                try:
+                    if file_suffix == ".pdf":
+                        saved = await (
+                            process_pdf_upload(file, keep)
+                            if isinstance(
+                                file, ResumableUpload
+                            )
+                            else process_pdf_file(
+                                file, keep
+                            )
+                        )
+                    elif isinstance(file, ResumableUpload):
+                        saved = [
+                            await save_upload(file, keep)
+                        ]
+                    else:
+                        saved = [
+                            await save_file(file, keep)
+                        ]
+                except FileProcessError as e:
+                    if failed is None:
+                        raise
+                    logger.error(str(e))
+                    failed[file.filename or ""] = str(e)
+                    continue
 
-        else:
-            files_list.append(await save_file(file))
+                files_list.extend(saved)
+            finally:
+                if isinstance(file, ResumableUpload):
+                    # 分块上传的原文件已经按页保存，不再需要
+                    await run_io(
+                        resumable_uploads.remove, file
+                    )
+            # 保存后的文件名，和识别 span 的 blob 属性对应
+            file_trace.set_attribute(
+                "blobs",
+                [
+                    path.name
+                    for path in files_list[saved_from:]
+                ],
+            )
 
     return files_list
+
+
+def release_files(files: list[Path]) -> None:
+    """识别完成后释放工作副本，内容相同的文件没有其他人在用时才删除，在线程池里执行"""
+    for file in files:
+        blob_store.release(file)
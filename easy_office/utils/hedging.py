@@ -0,0 +1,235 @@
+import asyncio
+import functools
+import math
+import os
+import time
+from collections import deque
+from contextlib import AbstractAsyncContextManager
+from typing import Awaitable, Callable, TypeVar
+
+from .metrics import Counter
+
+T = TypeVar("T")
+
+OCR_HEDGE: bool = (
+    os.getenv("OCR_HEDGE", "0") == "1"
+)  # 是否对慢的 OCR 请求发送对冲请求，默认关闭
+OCR_HEDGE_BUDGET: float = float(
+    os.getenv("OCR_HEDGE_BUDGET", "0.05")
+)  # 对冲请求最多占请求数的比例，对冲请求同样计费
+OCR_HEDGE_BURST: float = float(
+    os.getenv("OCR_HEDGE_BURST", "5")
+)  # 预算最多攒下这么多次对冲，请求变慢时可以连续对冲几次
+OCR_HEDGE_QUANTILE: float = float(
+    os.getenv("OCR_HEDGE_QUANTILE", "0.95")
+)  # 请求耗时超过最近请求的这个分位数时发送对冲请求
+# 每个接口保留最近这么多次请求的耗时，用来估算分位数
+HEDGE_WINDOW = 200
+# 至少有这么多次耗时记录才开始对冲，刚启动时没有可靠的分位数
+HEDGE_MIN_SAMPLES = 20
+
+HEDGES = Counter(
+    "easy_office_ocr_hedges_total",
+    "对冲请求次数，result 为 won（对冲请求先返回）、lost（原请求先返回）"
+    "或 skipped（超过预算没有发送）",
+    ("endpoint", "result"),
+)
+HEDGE_SAVED = Counter(
+    "easy_office_ocr_hedge_saved_seconds_total",
+    "对冲请求先返回时，比等原请求成功返回少等的时间（秒），原请求失败的不计",
+    ("endpoint",),
+)
+
+
+class LatencyWindow:
+    """每个接口最近 HEDGE_WINDOW 次请求的耗时，用来估算分位数"""
+
+    def __init__(self, size: int = HEDGE_WINDOW) -> None:
+        self.size = size
+        self._samples: dict[str, deque[float]] = {}
+
+    def observe(
+        self, endpoint: str, seconds: float
+    ) -> None:
+        self._samples.setdefault(
+            endpoint, deque(maxlen=self.size)
+        ).append(seconds)
+
+    def quantile(
+        self, endpoint: str, q: float
+    ) -> float | None:
+        """最近请求耗时的 q 分位数，记录太少时返回 None"""
+        samples = self._samples.get(endpoint)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[
+            min(
+                len(ordered) - 1,
+                math.ceil(q * len(ordered)) - 1,
+            )
+        ]
+
+
+class HedgeBudget:
+    """限制对冲请求的比例
+
+    每个请求攒下 ratio 次对冲的额度，最多攒 burst 次，发送一次对冲用掉一次，
+    长期来看对冲请求不会超过请求数的 ratio
+    """
+
+    def __init__(self, ratio: float, burst: float) -> None:
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+
+    def deposit(self) -> None:
+        self.tokens = min(
+            self.burst, self.tokens + self.ratio
+        )
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+latencies = LatencyWindow()
+budget = HedgeBudget(OCR_HEDGE_BUDGET, OCR_HEDGE_BURST)
+# 输掉的请求在后台跑完，只用来统计节省的时间，这里保留引用以免任务被回收；
+# 它们结束后释放 keep 的任务也放在这里
+_losers: set[asyncio.Task] = set()
+
+
+async def _timed(
+    endpoint: str, send: Callable[[], Awaitable[T]]
+) -> T:
+    start = time.perf_counter()
+    result = await send()
+    latencies.observe(endpoint, time.perf_counter() - start)
+    return result
+
+
+def _finish_loser(
+    loser: asyncio.Task,
+    endpoint: str,
+    won_at: float | None,
+    held: AbstractAsyncContextManager | None,
+) -> None:
+    """输掉的请求结束时调用，won_at 不为 None 时表示对冲请求在这个时间先返回"""
+    _losers.discard(loser)
+    if held is not None:
+        # 回调里不能 await，在后台释放
+        release = asyncio.ensure_future(
+            held.__aexit__(None, None, None)
+        )
+        _losers.add(release)
+        release.add_done_callback(_losers.discard)
+    # 取走异常，避免 "exception was never retrieved" 告警；
+    # 原请求失败时不知道要等多久才能拿到结果，不算节省的时间
+    succeeded = (
+        not loser.cancelled() and loser.exception() is None
+    )
+    if won_at is not None and succeeded:
+        HEDGE_SAVED.labels(endpoint=endpoint).inc(
+            time.perf_counter() - won_at
+        )
+
+
+async def hedged(
+    endpoint: str,
+    send: Callable[[], Awaitable[T]],
+    acquire: Callable[[], Awaitable[None]] | None = None,
+    keep: Callable[[], AbstractAsyncContextManager]
+    | None = None,
+) -> T:
+    """发送请求，超过这个接口最近请求耗时的 OCR_HEDGE_QUANTILE 分位数还没返回时，
+    再发送一个同样的请求，用先成功返回的结果；send 抛出异常才算失败
+
+    对冲请求受 OCR_HEDGE_BUDGET 限制；输掉的请求不取消，在后台跑完，
+    用来统计对冲节省的时间。两个请求都失败时抛出原请求的异常
+
+    Args:
+        endpoint: 接口名，各接口分别统计耗时
+        send: 发送一次请求，每次调用都要从头构造请求体
+        acquire: 发送对冲请求之前调用，例如等待限流配额
+        keep: 输掉的请求转到后台之前进入，它结束后退出；调用方拿到结果后
+            会释放请求用到的资源，例如删除要上传的文件，用它替后台的请求留着
+    """
+    if not OCR_HEDGE:
+        return await send()
+    delay = latencies.quantile(endpoint, OCR_HEDGE_QUANTILE)
+    budget.deposit()
+    primary = asyncio.ensure_future(_timed(endpoint, send))
+    if delay is None:
+        return await primary
+
+    try:
+        done, _ = await asyncio.wait(
+            {primary}, timeout=delay
+        )
+        if done:
+            return primary.result()
+        if not budget.withdraw():
+            HEDGES.labels(
+                endpoint=endpoint, result="skipped"
+            ).inc()
+            return await primary
+        if acquire is not None:
+            await acquire()
+    except BaseException:
+        primary.cancel()
+        raise
+    if primary.done():
+        # 等待限流配额的时候原请求已经返回，不需要对冲了
+        return primary.result()
+
+    hedge = asyncio.ensure_future(_timed(endpoint, send))
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            # 每个结束的任务都取一次异常，失败的那个不会再告警
+            succeeded = [
+                task
+                for task in done
+                if task.exception() is None
+            ]
+            if succeeded:
+                winner = succeeded[0]
+                break
+        else:
+            # 两个请求都失败了
+            return primary.result()
+    except BaseException:
+        primary.cancel()
+        hedge.cancel()
+        raise
+
+    won = winner is hedge
+    HEDGES.labels(
+        endpoint=endpoint, result="won" if won else "lost"
+    ).inc()
+    won_at = time.perf_counter() if won else None
+    held = keep() if pending and keep is not None else None
+    if held is not None:
+        try:
+            await held.__aenter__()
+        except BaseException:
+            for loser in pending:
+                loser.cancel()
+            raise
+    for loser in pending:
+        _losers.add(loser)
+        loser.add_done_callback(
+            functools.partial(
+                _finish_loser,
+                endpoint=endpoint,
+                won_at=won_at,
+                held=held,
+            )
+        )
+    return winner.result()
@@ -1,13 +1,142 @@
+import atexit
+import json
 import logging
+import os
+import queue
+from datetime import datetime
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+)
+
+from .tracing import current_span
+
+# 日志参数，均可通过环境变量修改
+LOG_FILE: str = os.getenv("LOG_FILE", "./EasyFinance.log")
+LOG_LEVEL: str = os.getenv(
+    "LOG_LEVEL", "INFO"
+)  # DEBUG 会输出百度接口的完整返回，格式化发生在调用方线程，只在排查问题时打开
+LOG_ROTATION: str = os.getenv(
+    "LOG_ROTATION", "size"
+)  # size：按大小切分；time：按时间切分
+LOG_MAX_BYTES: int = int(
+    os.getenv("LOG_MAX_BYTES", str(20 * 1024 * 1024))
+)
+LOG_ROTATE_WHEN: str = os.getenv(
+    "LOG_ROTATE_WHEN", "midnight"
+)
+LOG_BACKUP_COUNT: int = int(
+    os.getenv("LOG_BACKUP_COUNT", "10")
+)
+LOG_MAX_MESSAGE_LENGTH: int = int(
+    os.getenv("LOG_MAX_MESSAGE_LENGTH", "2000")
+)  # 单条日志的最大长度，超出部分截断，0 表示不截断
+
+CONSOLE_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(filename)s:%(lineno)d - %(funcName)s() - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class ContextFilter(logging.Filter):
+    """在调用日志的线程里补充 task_id、trace_id，并截断过长的消息
+
+    必须挂在 QueueHandler 上：contextvars 只在调用方的上下文里可见，
+    到了后台写日志的线程就取不到了
+    """
+
+    def __init__(self, max_length: int) -> None:
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = current_span()
+        if not getattr(record, "task_id", ""):
+            record.task_id = span.task_id if span else ""
+        record.trace_id = span.trace_id if span else ""
+
+        if self.max_length:
+            message = record.getMessage()
+            if len(message) > self.max_length:
+                record.msg = (
+                    f"{message[: self.max_length]}"
+                    f"...(已截断，原长度 {len(message)})"
+                )
+                record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(
+                record.created
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}:{record.lineno}",
+            "func": record.funcName,
+            "message": record.getMessage(),
+            "task_id": getattr(record, "task_id", ""),
+            "trace_id": getattr(record, "trace_id", ""),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(
+                record.exc_info
+            )
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def build_file_handler() -> logging.Handler:
+    """按 LOG_ROTATION 创建按大小或按时间切分的文件 handler"""
+    if LOG_ROTATION == "time":
+        handler: logging.Handler = TimedRotatingFileHandler(
+            LOG_FILE,
+            when=LOG_ROTATE_WHEN,
+            backupCount=LOG_BACKUP_COUNT,
+            encoding="utf-8",
+        )
+    else:
+        handler = RotatingFileHandler(
+            LOG_FILE,
+            maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUP_COUNT,
+            encoding="utf-8",
+        )
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+# 业务代码把日志放进队列，写文件和输出控制台在后台线程完成；
+# 消息本身（record.getMessage）在调用方线程拼接，ContextFilter 截断和 QueueHandler.prepare 都要用到
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(
+    logging.Formatter("%(message)s")
+)  # 入队前拼接消息和异常堆栈，时间、位置等完整格式由后台线程生成
+queue_handler.addFilter(
+    ContextFilter(LOG_MAX_MESSAGE_LENGTH)
+)
+
+console_handler = logging.StreamHandler()  # 输出到控制台
+console_handler.setFormatter(
+    logging.Formatter(CONSOLE_FORMAT, datefmt=DATE_FORMAT)
+)
+
+listener = QueueListener(
+    log_queue,
+    build_file_handler(),  # 输出到文件
+    console_handler,
+    respect_handler_level=True,
+)
+listener.start()
+atexit.register(listener.stop)
 
 logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(filename)s:%(lineno)d - %(funcName)s() - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.FileHandler("./EasyFinance.log"),  # 输出到文件
-        logging.StreamHandler(),  # 输出到控制台
-    ],
+    level=LOG_LEVEL,
+    handlers=[queue_handler],
 )
 
 
@@ -0,0 +1,348 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Iterator
+
+from .tracing import span
+
+# 直方图默认分桶，单位秒，覆盖本地文件操作到百度接口慢请求的范围
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            key,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"'),
+        )
+        for key, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """所有指标的基类，按标签值保存子指标
+
+    Args:
+        name: 指标名
+        documentation: 指标说明，输出为 # HELP
+        label_names: 标签名
+    """
+
+    metric_type: str = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._children: dict[tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def labels(self, **labels: str) -> Any:
+        key = tuple(
+            str(labels.get(name, ""))
+            for name in self.label_names
+        )
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._new_child()
+                self._children[key] = child
+        return child
+
+    def _label_dict(
+        self, key: tuple[str, ...]
+    ) -> dict[str, str]:
+        return dict(zip(self.label_names, key))
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(
+                f"{name}{_format_labels(labels)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class _Value:
+    def __init__(self) -> None:
+        self.value: float = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = value
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    metric_type = "counter"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            children = list(self._children.items())
+        return [
+            (self.name, self._label_dict(key), child.value)
+            for key, child in children
+        ]
+
+
+class Gauge(Metric):
+    """可增可减的瞬时值，用于记录进行中的请求数和排队数"""
+
+    metric_type = "gauge"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            children = list(self._children.items())
+        return [
+            (self.name, self._label_dict(key), child.value)
+            for key, child in children
+        ]
+
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum: float = 0
+        self.count: int = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+
+class Histogram(Metric):
+    """耗时分布，输出累计分桶，可以在 Prometheus 里用 histogram_quantile 计算 p95"""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            children = list(self._children.items())
+        result = []
+        for key, child in children:
+            labels = self._label_dict(key)
+            with child._lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(
+                self.buckets, counts
+            ):
+                cumulative += bucket_count
+                result.append(
+                    (
+                        f"{self.name}_bucket",
+                        {
+                            **labels,
+                            "le": _format_value(bound),
+                        },
+                        cumulative,
+                    )
+                )
+            result.append(
+                (
+                    f"{self.name}_bucket",
+                    {**labels, "le": "+Inf"},
+                    count,
+                )
+            )
+            result.append(
+                (f"{self.name}_sum", labels, total)
+            )
+            result.append(
+                (f"{self.name}_count", labels, count)
+            )
+        return result
+
+
+class Registry:
+    """保存所有指标，输出 Prometheus 文本格式"""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return (
+            "\n".join(
+                metric.render()
+                for metric in self._metrics.values()
+            )
+            + "\n"
+        )
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram(
+    "easy_office_stage_seconds",
+    "各处理阶段耗时（秒）",
+    ("stage", "endpoint", "outcome"),
+)
+STAGE_TOTAL = Counter(
+    "easy_office_stage_total",
+    "各处理阶段执行次数",
+    ("stage", "endpoint", "outcome"),
+)
+IN_FLIGHT = Gauge(
+    "easy_office_in_flight_requests",
+    "正在进行中的外部接口请求数",
+    ("endpoint",),
+)
+QUEUE_DEPTH = Gauge(
+    "easy_office_queue_depth",
+    "已提交但尚未处理完成的文件数",
+    ("endpoint",),
+)
+
+
+@contextmanager
+def track_stage(
+    stage: str, endpoint: str = "", **attributes: Any
+) -> Iterator[None]:
+    """记录一个处理阶段的耗时和结果，抛出异常时 outcome 记为 error
+    同时开启一个同名的 span，挂在当前 trace 下面
+
+    Args:
+        stage: 阶段名，例如 save_file、pdf_split、ocr_request
+        endpoint: 接口或页面名，例如 bank_receipt_new、vat_invoice
+        attributes: 只写入 span 的附加属性，例如 task_id
+    """
+    outcome = "success"
+    start = time.perf_counter()
+    try:
+        with span(stage, endpoint=endpoint, **attributes):
+            yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(
+            stage=stage, endpoint=endpoint, outcome=outcome
+        ).observe(elapsed)
+        STAGE_TOTAL.labels(
+            stage=stage, endpoint=endpoint, outcome=outcome
+        ).inc()
+
+
+@contextmanager
+def track_in_flight(endpoint: str) -> Iterator[None]:
+    """记录正在进行中的外部接口请求数"""
+    gauge = IN_FLIGHT.labels(endpoint=endpoint)
+    gauge.inc()
+    try:
+        yield
+    finally:
+        gauge.dec()
+
+
+async def gather_with_queue_depth(
+    endpoint: str, tasks: list[Awaitable]
+) -> list:
+    """和 asyncio.gather 一样并发执行，同时用 QUEUE_DEPTH 记录未完成的文件数
+
+    Args:
+        endpoint: 接口或页面名
+        tasks: 每个文件对应的协程
+
+    Returns:
+        list: 按 tasks 顺序排列的结果
+    """
+    gauge = QUEUE_DEPTH.labels(endpoint=endpoint)
+    gauge.inc(len(tasks))
+
+    async def _run(task: Awaitable):
+        try:
+            return await task
+        finally:
+            gauge.dec()
+
+    return await asyncio.gather(
+        *(_run(task) for task in tasks)
+    )
+
+
+def render_metrics() -> str:
+    """输出 Prometheus 文本格式的全部指标"""
+    return REGISTRY.render()
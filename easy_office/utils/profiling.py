@@ -0,0 +1,315 @@
+import cProfile
+import functools
+import inspect
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+from .log import logger
+
+PROFILE_DIR: Path = Path(
+    os.getenv("PROFILE_DIR", "./profiles")
+)
+PROFILE_SAMPLE_INTERVAL: float = float(
+    os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005")
+)  # 采样间隔，单位秒
+
+# 所有被 @profiled 装饰过、可以开启分析的事件处理函数
+PROFILABLE: set[str] = set()
+
+
+@dataclass
+class ProfileRequest:
+    """管理员开启的一次分析任务
+
+    Args:
+        calls: 还需要分析的调用次数
+        mode: cprofile 为确定性分析；sampling 为采样分析
+        memory: 是否同时用 tracemalloc 记录内存分配
+    """
+
+    calls: int
+    mode: str = "sampling"
+    memory: bool = False
+
+
+# 事件处理函数名 → 分析任务，为空时装饰器只多一次字典查询
+_armed: dict[str, ProfileRequest] = {}
+_armed_lock = threading.Lock()
+# cProfile 和 tracemalloc 都是进程级别的，同一时间只允许一个分析在跑
+_active_lock = threading.Lock()
+
+
+def arm(
+    name: str,
+    calls: int,
+    mode: str = "sampling",
+    memory: bool = False,
+) -> None:
+    """为某个事件处理函数开启接下来 calls 次调用的分析"""
+    if name not in PROFILABLE:
+        raise KeyError(f"{name} 不是可分析的事件处理函数")
+    if mode not in ("sampling", "cprofile"):
+        raise ValueError(f"不支持的分析模式：{mode}")
+    with _armed_lock:
+        if calls > 0:
+            _armed[name] = ProfileRequest(
+                calls, mode, memory
+            )
+        else:
+            _armed.pop(name, None)
+
+
+def armed() -> dict[str, ProfileRequest]:
+    with _armed_lock:
+        return dict(_armed)
+
+
+def _take(name: str) -> ProfileRequest | None:
+    """取出一次分析机会，次数用完后自动关闭"""
+    with _armed_lock:
+        request = _armed.get(name)
+        if request is None:
+            return None
+        request.calls -= 1
+        if request.calls <= 0:
+            del _armed[name]
+        return request
+
+
+class StackSampler:
+    """后台线程定时采样目标线程的调用栈，输出 flamegraph.pl / speedscope 可读的折叠栈格式"""
+
+    def __init__(
+        self, thread_id: int, interval: float
+    ) -> None:
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="stack-sampler",
+            daemon=True,
+        )
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(
+                self.thread_id
+            )
+            stack: list[str] = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_qualname} ({Path(code.co_filename).name}:{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "\n".join(
+            f"{stack} {count}"
+            for stack, count in self.stacks.most_common()
+        )
+
+
+class ProfileSession:
+    """一次调用的分析过程，结束时把结果写入 PROFILE_DIR"""
+
+    def __init__(
+        self, name: str, request: ProfileRequest
+    ) -> None:
+        self.name = name
+        self.request = request
+        self.profiler: cProfile.Profile | None = None
+        self.sampler: StackSampler | None = None
+        self.snapshot: tracemalloc.Snapshot | None = None
+        self.started_tracemalloc = False
+        self.start_time = 0.0
+
+    def start(self) -> None:
+        if self.request.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                self.started_tracemalloc = True
+            self.snapshot = tracemalloc.take_snapshot()
+
+        if self.request.mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.sampler = StackSampler(
+                threading.get_ident(),
+                PROFILE_SAMPLE_INTERVAL,
+            )
+            self.sampler.start()
+        self.start_time = time.perf_counter()
+
+    def stop(self) -> None:
+        elapsed = time.perf_counter() - self.start_time
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        stem = PROFILE_DIR / (
+            f"{self.name}-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        )
+        outputs: list[Path] = []
+
+        if self.profiler is not None:
+            # .prof 可以用 snakeviz 查看，也可以用 flameprof 转成火焰图
+            self.profiler.dump_stats(f"{stem}.prof")
+            with open(f"{stem}.txt", "w") as f:
+                pstats.Stats(
+                    self.profiler, stream=f
+                ).sort_stats("cumulative").print_stats(50)
+            outputs += [
+                Path(f"{stem}.prof"),
+                Path(f"{stem}.txt"),
+            ]
+
+        if self.sampler is not None:
+            Path(f"{stem}.collapsed").write_text(
+                self.sampler.collapsed()
+            )
+            outputs.append(Path(f"{stem}.collapsed"))
+
+        if self.snapshot is not None:
+            after = tracemalloc.take_snapshot()
+            after.dump(f"{stem}.tracemalloc")
+            diff = after.compare_to(self.snapshot, "lineno")
+            Path(f"{stem}.memory.txt").write_text(
+                "\n".join(str(stat) for stat in diff[:50])
+            )
+            outputs += [
+                Path(f"{stem}.tracemalloc"),
+                Path(f"{stem}.memory.txt"),
+            ]
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+        logger.info(
+            f"{self.name} 分析完成，耗时 {elapsed:.3f}s，输出：{[str(p) for p in outputs]}"
+        )
+
+
+def _begin(name: str) -> ProfileSession | None:
+    if not _armed or name not in _armed:
+        return None
+    if not _active_lock.acquire(blocking=False):
+        return None  # 已经有别的调用在分析，这次不分析，也不消耗次数
+    request = _take(name)
+    if request is None:
+        _active_lock.release()
+        return None
+    session = ProfileSession(name, request)
+    session.start()
+    return session
+
+
+def _end(session: ProfileSession) -> None:
+    try:
+        session.stop()
+    except Exception as e:
+        logger.error(
+            f"{session.name} 写入分析结果失败：{e}"
+        )
+    finally:
+        _active_lock.release()
+
+
+def _wraps(fn: Callable) -> Callable[[Callable], Callable]:
+    """functools.wraps，同时复制参数签名
+
+    Reflex 用 inspect.getfullargspec 取事件处理函数的参数名，
+    它不会顺着 __wrapped__ 找原函数，只认 __signature__，
+    没有签名时事件参数会被丢掉
+    """
+
+    def decorator(wrapper: Callable) -> Callable:
+        wrapper = functools.wraps(fn)(wrapper)
+        wrapper.__signature__ = inspect.signature(fn)  # type:ignore
+        return wrapper
+
+    return decorator
+
+
+def profiled(fn: Callable) -> Callable:
+    """让事件处理函数可以被管理员按需分析
+
+    关闭时只多一次字典查询；开启后接下来的若干次调用会被分析，
+    支持普通函数、协程、生成器和异步生成器，保持原函数的类型不变，
+    Reflex 依赖函数类型来决定如何执行事件处理函数
+    """
+    name = fn.__qualname__
+    PROFILABLE.add(name)
+
+    if inspect.isasyncgenfunction(fn):
+
+        @_wraps(fn)
+        async def async_gen_wrapper(*args, **kwargs):
+            session = _begin(name)
+            try:
+                async for item in fn(*args, **kwargs):
+                    yield item
+            finally:
+                if session is not None:
+                    _end(session)
+
+        return async_gen_wrapper
+
+    if inspect.iscoroutinefunction(fn):
+
+        @_wraps(fn)
+        async def coroutine_wrapper(*args, **kwargs):
+            session = _begin(name)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                if session is not None:
+                    _end(session)
+
+        return coroutine_wrapper
+
+    if inspect.isgeneratorfunction(fn):
+
+        @_wraps(fn)
+        def gen_wrapper(*args, **kwargs):
+            session = _begin(name)
+            try:
+                return (yield from fn(*args, **kwargs))
+            finally:
+                if session is not None:
+                    _end(session)
+
+        return gen_wrapper
+
+    @_wraps(fn)
+    def wrapper(*args, **kwargs):
+        session = _begin(name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if session is not None:
+                _end(session)
+
+    return wrapper
@@ -0,0 +1,273 @@
+import asyncio
+import heapq
+import itertools
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import IntEnum
+from types import TracebackType
+from typing import Iterator
+
+import redis
+
+from .executor import run_io
+from .log import logger
+from .metrics import Gauge, Histogram
+from .shared_store import SharedStore, shared_store
+
+BAIDU_OCR_QPS: float = float(
+    os.getenv("BAIDU_OCR_QPS", "5")
+)  # 百度 OCR 接口所有进程、所有机器合计每秒最多请求数，0 表示不限制
+BAIDU_OCR_BURST: float = float(
+    os.getenv("BAIDU_OCR_BURST", "0")
+)  # 空闲之后最多可以连续发出的请求数，0 表示和 BAIDU_OCR_QPS 相同
+FEISHU_WRITE_QPS: float = float(
+    os.getenv("FEISHU_WRITE_QPS", "50")
+)  # 飞书多维表格新增记录合计每秒最多请求数，0 表示不限制
+FEISHU_WRITE_BURST: float = float(
+    os.getenv("FEISHU_WRITE_BURST", "0")
+)  # 空闲之后最多可以连续发出的请求数，0 表示和 FEISHU_WRITE_QPS 相同
+RATE_LIMIT_RESERVE: float = float(
+    os.getenv("RATE_LIMIT_RESERVE", "0.5")
+)  # 批量任务要给网页上的用户留下令牌桶容量的这个比例，批量任务占满配额时用户的请求也不用排队
+
+RATE_LIMIT_WAIT = Histogram(
+    "easy_office_rate_limit_wait_seconds",
+    "调用外部接口前等待配额的时间（秒）",
+    ("limiter", "priority"),
+)
+RATE_LIMIT_WAITING = Gauge(
+    "easy_office_rate_limit_waiting",
+    "本进程里正在等待配额的请求数",
+    ("limiter", "priority"),
+)
+
+
+class Priority(IntEnum):
+    """请求的优先级，数值越小越先拿到配额"""
+
+    # 网页上的用户正在等结果
+    INTERACTIVE = 0
+    # 后台执行、没有人在等的任务，没有指定时的默认值
+    BACKGROUND = 1
+    # 命令行批量处理
+    BULK = 2
+
+
+@dataclass(frozen=True)
+class Schedule:
+    """当前请求的调度信息
+
+    Args:
+        priority: 优先级
+        session: 会话标识，同一优先级里各会话公平分配配额
+        weight: 会话的权重，权重为 2 的会话分到的配额是权重为 1 的两倍
+    """
+
+    priority: Priority = Priority.BACKGROUND
+    session: str = ""
+    weight: float = 1
+
+
+_current_schedule: ContextVar[Schedule] = ContextVar(
+    "rate_limit_schedule", default=Schedule()
+)
+
+
+@contextmanager
+def scheduling(
+    priority: Priority, session: str = "", weight: float = 1
+) -> Iterator[None]:
+    """with 里的外部接口请求按这个优先级和会话排队
+
+    asyncio.gather 创建的任务会继承调度信息，只需要在一批文件的入口设置一次
+    """
+    token = _current_schedule.set(
+        Schedule(priority, session, weight)
+    )
+    try:
+        yield
+    finally:
+        _current_schedule.reset(token)
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    finish: float
+    seq: int
+    start: float = field(compare=False)
+    wake: asyncio.Event = field(
+        compare=False, default_factory=asyncio.Event
+    )
+
+
+class RateLimiter:
+    """所有后端进程共用的令牌桶限流，按优先级和会话排队
+
+    令牌桶保存在共享存储里，配置了 Redis 时多台机器合计限流，
+    否则同一台机器上的后端进程和命令行脚本合计限流。
+
+    优先级在两层生效：进程内排队的请求先按优先级，同一优先级里按会话做加权公平排队
+    （start-time fair queuing），一个会话上传两千个文件也不会挡住只传了三个文件的会话；
+    只有排在最前面的请求去共享存储取令牌。跨进程时，网页请求直接预定令牌，
+    令牌不够就记为欠账排在后面；后台和批量请求只在桶里还剩足够令牌时才取，
+    批量请求还要留下 RATE_LIMIT_RESERVE 的容量，网页上的请求到来时桶里总有令牌
+
+    Args:
+        name: 令牌桶的名字，限制同一个外部接口的限流器用同一个名字
+        rate: 每秒请求数，0 表示不限制
+        burst: 空闲之后最多可以连续发出的请求数，0 表示和 rate 相同
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: float = 0,
+        store: SharedStore = shared_store,
+    ) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst or rate
+        self.store = store
+        self._waiters: list[_Waiter] = []
+        self._seq = itertools.count()
+        # 虚拟时间，等于最近放行的请求的开始标签
+        self._virtual = 0.0
+        # (优先级, 会话) → 这个会话最后一个请求的结束标签
+        self._finish: dict[tuple[int, str], float] = {}
+
+    def _floor(self, priority: Priority) -> float | None:
+        """取令牌后桶里至少要剩下的令牌数，None 表示可以预定"""
+        if priority == Priority.INTERACTIVE:
+            return None
+        if priority == Priority.BACKGROUND:
+            return 0.0
+        return max(
+            0.0,
+            min(
+                self.burst * RATE_LIMIT_RESERVE,
+                self.burst - 1,
+            ),
+        )
+
+    def _enqueue(self, schedule: Schedule) -> _Waiter:
+        key = (schedule.priority, schedule.session)
+        start = max(
+            self._virtual, self._finish.get(key, 0.0)
+        )
+        finish = start + 1 / schedule.weight
+        self._finish[key] = finish
+        waiter = _Waiter(
+            schedule.priority,
+            finish,
+            next(self._seq),
+            start,
+        )
+        head = self._waiters[0] if self._waiters else None
+        heapq.heappush(self._waiters, waiter)
+        if head is not None and self._waiters[0] is waiter:
+            # 插到了最前面，原来排第一的请求不要再去取令牌
+            head.wake.set()
+        return waiter
+
+    def _remove(self, waiter: _Waiter) -> None:
+        was_head = self._waiters[0] is waiter
+        self._waiters.remove(waiter)
+        heapq.heapify(self._waiters)
+        if not self._waiters:
+            # 没有排队的请求，重新开始计算标签，会话表不会一直变大
+            self._virtual = 0.0
+            self._finish.clear()
+        elif was_head:
+            self._waiters[0].wake.set()
+
+    async def acquire(self) -> None:
+        """等到可以发出一次请求"""
+        if self.rate <= 0:
+            return
+        schedule = _current_schedule.get()
+        priority = schedule.priority.name.lower()
+        gauge = RATE_LIMIT_WAITING.labels(
+            limiter=self.name, priority=priority
+        )
+        start = time.perf_counter()
+        waiter = self._enqueue(schedule)
+        gauge.inc()
+        try:
+            await self._wait_turn(
+                waiter, self._floor(schedule.priority)
+            )
+        finally:
+            gauge.dec()
+            if waiter in self._waiters:
+                self._remove(waiter)
+        RATE_LIMIT_WAIT.labels(
+            limiter=self.name, priority=priority
+        ).observe(time.perf_counter() - start)
+
+    async def _wait_turn(
+        self, waiter: _Waiter, floor: float | None
+    ) -> None:
+        """排到最前面后取到令牌为止"""
+        while True:
+            if self._waiters[0] is not waiter:
+                waiter.wake.clear()
+                await waiter.wake.wait()
+                continue
+            # 在取令牌之前清除，取令牌期间收到的唤醒不会丢失
+            waiter.wake.clear()
+            try:
+                wait = await run_io(
+                    self.store.take_token,
+                    self.name,
+                    self.rate,
+                    self.burst,
+                    floor,
+                )
+            except (redis.RedisError, sqlite3.Error) as e:
+                # 共享存储不可用时不拦住业务请求，超出配额时由外部接口返回错误
+                logger.warning(
+                    "限流器 %s 无法访问共享存储，本次不限流：%s",
+                    self.name,
+                    e,
+                )
+                return
+            if floor is None or wait == 0:
+                if wait > 0:
+                    # 预定的令牌到期之前一直排在最前面，后面的请求到时候再按公平顺序预定，
+                    # 不会一次把欠账都预定给先到的会话
+                    await asyncio.sleep(wait)
+                self._virtual = waiter.start
+                self._remove(waiter)
+                return
+            # 令牌还不够，等到够了再取；期间有更优先的请求插到前面时会被唤醒
+            try:
+                await asyncio.wait_for(
+                    waiter.wake.wait(), timeout=wait
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        return None
+
+
+baidu_ocr_limiter = RateLimiter(
+    "baidu_ocr", BAIDU_OCR_QPS, BAIDU_OCR_BURST
+)
+feishu_write_limiter = RateLimiter(
+    "feishu_write", FEISHU_WRITE_QPS, FEISHU_WRITE_BURST
+)
@@ -1,24 +1,40 @@
 import asyncio
 import base64
+import hashlib
+import json
 import os
 import re
 import time
 from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
 from datetime import date, datetime, timedelta
 from pathlib import Path
+from typing import AsyncIterator, Iterator
 
 import httpx
 
+from .blob_store import blob_store, blob_url
+from .executor import run_io
 from .file_process import (
     generate_random_string,
 )
+from .hedging import hedged
 from .log import logger
+from .metrics import track_in_flight, track_stage
+from .rate_limit import (
+    baidu_ocr_limiter,
+    feishu_write_limiter,
+)
+from .shared_store import shared_store
+from .tracing import span
 
 # 从环境变量中获取密钥和参数
 BAIDU_API_KEY: str | None = os.getenv("BAIDU_API_KEY")
 BAIDU_SECRET_KEY: str | None = os.getenv("BAIDU_SECRET_KEY")
-BACK_END: str | None = os.getenv("BACK_END")
 DATE_TO_REMOVE = "-/\\.:：年月日时秒分 "
+DATE_TRANS_TABLE: dict[int, None] = str.maketrans(
+    "", "", DATE_TO_REMOVE
+)  # 只需要生成一次，不必每次解析都重建
 AMOUNT_PATTERN: re.Pattern[str] = re.compile(r"[^\d.]")
 FEISHU_APP_ID: str | None = os.getenv("FEISHU_APP_ID")
 FEISHU_APP_SECRET: str | None = os.getenv(
@@ -31,37 +47,140 @@ FEISHU_FINANCE_TABLE_ID: str | None = os.getenv(
 
 IMG_SUFFIX: list[str] = [".jpeg", ".jpg", ".png", ".bmp"]
 
+# 上传给百度 OCR 时每次读取的字节数
+OCR_CHUNK_SIZE: int = int(
+    os.getenv("OCR_CHUNK_SIZE", "196608")
+)
+# base64 结果里需要做表单转义的字符
+FORM_ESCAPES: tuple[tuple[bytes, bytes], ...] = (
+    (b"+", b"%2B"),
+    (b"/", b"%2F"),
+    (b"=", b"%3D"),
+)
+
+# 接口地址，压测时可以指向本地的模拟服务
+BAIDU_API_BASE: str = os.getenv(
+    "BAIDU_API_BASE", "https://aip.baidubce.com"
+)
+FEISHU_API_BASE: str = os.getenv(
+    "FEISHU_API_BASE", "https://open.feishu.cn"
+)
+
+
+# 等待其他进程刷新 token 的最长时间，单位秒
+TOKEN_REFRESH_TIMEOUT = 30
+
+# 每次新建 AsyncClient 都要加载一遍 CA 证书，在事件循环里要几十毫秒，
+# 所有请求共用同一个 SSL 上下文
+SSL_CONTEXT = httpx.create_ssl_context()
+
 
 class Token(ABC):
+    """接口的访问 token，保存在 shared_store 里，所有后端进程共用，重启后仍然有效
+
+    每个进程先用自己内存里的副本；过期时读取共享的 token，
+    共享的也过期了才在锁里刷新，同一时间只有一个进程去请求新的 token
+    """
+
     token_duration: timedelta
+    url: str
+    endpoint: str = ""  # 用于记录指标
     _token: str = ""
     _token_gen_datetime: datetime = datetime(
         year=2000,
         month=1,
         day=1,
     )  # 这个初始值没有意义，就是随便写一个以免报错
+    _refresh_lock: asyncio.Lock | None = None
 
     @abstractmethod
     def gen_token(self) -> None:
         raise NotImplementedError
 
     @property
-    def token(self) -> str:
+    def store_key(self) -> str:
+        """共享存储里的 key，带上接口地址和凭证的哈希，
+        换了账号或者压测时指向模拟服务，都不会读到别的 token"""
+        identity = json.dumps(
+            [self.url, getattr(self, "body", None)],
+            default=str,
+        )
+        digest = hashlib.sha256(
+            identity.encode()
+        ).hexdigest()
+        return f"token:{self.endpoint}:{digest[:16]}"
+
+    def is_fresh(self) -> bool:
         now = datetime.now()
-        is_fresh = (
-            (now - self._token_gen_datetime)
+        return (
+            bool(self._token)
+            and (now - self._token_gen_datetime)
             < self.token_duration
         )  # 结果为真则有效期没过，结果未假则有效期过了
 
-        if self._token and is_fresh:
-            return self._token
-        else:
-            self.gen_token()
+    def _load(self) -> bool:
+        """读取共享的 token，返回是否有效"""
+        data = shared_store.get(self.store_key)
+        if data is not None:
+            saved = json.loads(data)
+            self._token = saved["token"]
+            self._token_gen_datetime = (
+                datetime.fromisoformat(
+                    saved["generated_at"]
+                )
+            )
+        return self.is_fresh()
+
+    def refresh(self) -> None:
+        """使用其他进程刷新的 token，都过期时才自己刷新，在线程池里执行"""
+        if self._load():
+            return
+        with shared_store.lock(
+            self.store_key, TOKEN_REFRESH_TIMEOUT
+        ):
+            # 等锁期间可能已经有别的进程刷新好了
+            if self._load():
+                return
+            with track_stage(
+                "token_refresh", endpoint=self.endpoint
+            ):
+                self.gen_token()
+            shared_store.set(
+                self.store_key,
+                json.dumps(
+                    {
+                        "token": self._token,
+                        "generated_at": self._token_gen_datetime.isoformat(),
+                    }
+                ).encode(),
+                ttl=self.token_duration.total_seconds(),
+            )
+
+    @property
+    def token(self) -> str:
+        if not self.is_fresh():
+            self.refresh()
+        return self._token
+
+    async def atoken(self) -> str:
+        """在异步函数里获取 token，读取共享存储和刷新 token 都放到线程池里执行
+
+        token 过期时同时识别的文件只有一个去刷新，其他的等它刷新完直接使用，
+        不会各占一个线程去排共享锁
+        """
+        if self.is_fresh():
             return self._token
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            if not self.is_fresh():
+                await run_io(self.refresh)
+        return self._token
 
 
 class BaiduToken(Token):
     token_duration: timedelta = timedelta(days=25)
+    endpoint: str = "baidu"
 
     def __init__(
         self,
@@ -86,7 +205,7 @@ class BaiduToken(Token):
 
 
 get_baidu_token = BaiduToken(
-    url=f"https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id={BAIDU_API_KEY}&client_secret={BAIDU_SECRET_KEY}",
+    url=f"{BAIDU_API_BASE}/oauth/2.0/token?grant_type=client_credentials&client_id={BAIDU_API_KEY}&client_secret={BAIDU_SECRET_KEY}",
     headers={
         "Content-Type": "application/json",
         "Accept": "application/json",
@@ -96,6 +215,7 @@ get_baidu_token = BaiduToken(
 
 class FeishuToken(Token):
     token_duration: timedelta = timedelta(hours=1)
+    endpoint: str = "feishu"
 
     def __init__(
         self,
@@ -119,7 +239,7 @@ class FeishuToken(Token):
 
 
 get_feishu_token = FeishuToken(
-    url="https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal",
+    url=f"{FEISHU_API_BASE}/open-apis/auth/v3/tenant_access_token/internal",
     headers={
         "Content-Type": "application/json;charset=utf-8",
     },
@@ -144,8 +264,7 @@ def parse_date(date_string: str) -> date:
         date : 如果能解析就解析，不能解析就输出当天日期
     """
     try:
-        trans_table = str.maketrans("", "", DATE_TO_REMOVE)
-        date_num = date_string.translate(trans_table)
+        date_num = date_string.translate(DATE_TRANS_TABLE)
         result = date.fromisoformat(date_num)
         return result
     except (ValueError, TypeError):
@@ -181,6 +300,76 @@ def extract_amount(amount_str: str) -> str:
         return result
 
 
+def encode_form_chunk(chunk: bytes | memoryview) -> bytes:
+    """把一段文件内容转成 base64，再按 application/x-www-form-urlencoded 转义
+
+    base64 字符里只有 + / = 需要转义，结果和 httpx 用 data= 编码的完全一致
+    """
+    encoded = base64.b64encode(chunk)
+    for char, escaped in FORM_ESCAPES:
+        encoded = encoded.replace(char, escaped)
+    return encoded
+
+
+class OcrFormBody:
+    """百度 OCR 接口的表单请求体，按块读取文件、编码并发送
+
+    不再同时持有原始文件、base64 字符串和完整请求体三份数据，
+    每个请求占用的内存只和块大小有关，和文件大小无关
+
+    Args:
+        file: 要识别的文件
+        chunk_size: 每次读取的字节数，会向下取 3 的倍数
+    """
+
+    def __init__(
+        self, file: Path, chunk_size: int = OCR_CHUNK_SIZE
+    ) -> None:
+        self.file = file
+        self.chunk_size = max(
+            3, chunk_size // 3 * 3
+        )  # 取 3 的倍数，每块的 base64 才能直接拼接
+        self.field = (
+            "image"
+            if file.suffix in IMG_SUFFIX
+            else "pdf_file"
+        )
+
+    def _chunks(self) -> Iterator[bytes]:
+        """同步地逐块读取和编码，复用同一个缓冲区"""
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        with self.file.open("rb") as f:
+            while size := f.readinto(buffer):
+                yield encode_form_chunk(view[:size])
+
+    def content_length(self) -> int:
+        """预先编码一遍计算请求体长度，这样可以发送 Content-Length 而不是分块传输"""
+        return (
+            len(self.field)
+            + 1
+            + sum(map(len, self._chunks()))
+        )
+
+    async def headers(self) -> dict[str, str]:
+        return {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Content-Length": str(
+                await run_io(self.content_length)
+            ),
+        }
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield f"{self.field}=".encode()
+        chunks = self._chunks()
+        try:
+            # 读文件和编码都在线程池里执行，不阻塞事件循环
+            while chunk := await run_io(next, chunks, b""):
+                yield chunk
+        finally:
+            chunks.close()
+
+
 def process_bank_slip(words_result: dict) -> dict:
     trade_date = parse_date(
         words_result["交易日期"][0]["word"]
@@ -204,159 +393,224 @@ class Request_Baidu_OCR:
         self.file = file
 
     async def bank_slip(self) -> dict:
-        token = get_baidu_token.token
-        async with httpx.AsyncClient() as client:
-            # ---------获取token-----------
-            task_id = (
-                generate_random_string()
-            )  # 用于记录运行日志
-
-            logger.info(
-                f"开始执行任务，task_id：{task_id},任务类型:银行回单识别"
-            )
+        task_id = (
+            generate_random_string()
+        )  # 用于记录运行日志
+        with span(
+            "ocr",
+            endpoint="bank_receipt_new",
+            task_id=task_id,
+            blob=self.file.name,
+        ):
+            return await self._bank_slip(task_id)
+
+    async def _send_ocr(
+        self,
+        endpoint: str,
+        url: str,
+        headers: dict[str, str],
+    ) -> dict:
+        """发送一次 OCR 请求
+
+        每次都新建请求体，对冲请求和原请求各自从头读取文件；
+        各自使用自己的连接，输掉的请求可以在后台跑完
+
+        百度出错时同样返回 HTTP 200，错误码在 error_code 里，例如 18 是超出 QPS 限制；
+        这里抛出异常，对冲时这次请求算作失败，用另一个请求的结果
+        """
+        async with httpx.AsyncClient(
+            verify=SSL_CONTEXT
+        ) as client:
+            with (
+                track_stage(
+                    "ocr_request", endpoint=endpoint
+                ),
+                track_in_flight(endpoint),
+            ):
+                response = await client.post(
+                    url=url,
+                    headers=headers,
+                    content=OcrFormBody(self.file),
+                )
+                result = response.json()
+                if "error_code" in result:
+                    raise Exception(
+                        f"百度 OCR 返回错误 {result['error_code']}：{result.get('error_msg', '')}"
+                    )
+                return result
+
+    async def _post_ocr(
+        self,
+        endpoint: str,
+        url: str,
+        headers: dict[str, str],
+    ) -> dict:
+        """排队拿到限流配额后发送 OCR 请求，打开 OCR_HEDGE 时慢请求会发送对冲请求"""
+        # 百度按账号限制 QPS，所有进程合计排队
+        with track_stage("rate_limit", endpoint=endpoint):
+            await baidu_ocr_limiter.acquire()
+        return await hedged(
+            endpoint,
+            lambda: self._send_ocr(endpoint, url, headers),
+            # 对冲请求同样计费，也要排队拿配额
+            acquire=baidu_ocr_limiter.acquire,
+            keep=self._keep_file,
+        )
 
-            # ----处理文件-------
-
-            # 输出文件的 base64 字符串
-            file_b64 = base64.b64encode(
-                self.file.read_bytes()
-            ).decode("utf-8")
-
-            # 请求api的参数
-            request_headers = {
-                "Content-Type": "application/x-www-form-urlencoded"
-            }
-            request_payload = (
-                {"image": file_b64}
-                if self.file.suffix in IMG_SUFFIX
-                else {"pdf_file": file_b64}
-            )
+    @asynccontextmanager
+    async def _keep_file(self) -> AsyncIterator[None]:
+        """给要识别的文件加一次引用
+
+        输掉的对冲请求在后台还在读文件，调用方拿到结果后就会 release_files，
+        多一次引用保证文件在它读完之前不会被删除
+        """
+        retained = await run_io(
+            blob_store.retain, self.file
+        )
+        try:
+            yield
+        finally:
+            if retained:
+                await run_io(blob_store.release, self.file)
+
+    async def _bank_slip(self, task_id: str) -> dict:
+        # ---------获取token-----------
+        token = await get_baidu_token.atoken()
+        logger.info(
+            f"开始执行任务，task_id：{task_id},任务类型:银行回单识别"
+        )
 
-            print(request_payload.keys())
+        # ----处理文件-------
 
-            # ----------银行回单请求-------
+        # 请求体边读文件边编码，发送时才生成
+        with track_stage(
+            "base64", endpoint="bank_receipt_new"
+        ):
+            request_headers = await OcrFormBody(
+                self.file
+            ).headers()
 
-            bank_slip_url = f"https://aip.baidubce.com/rest/2.0/ocr/v1/bank_receipt_new?access_token={token}"
+        # ----------银行回单请求-------
 
-            bank_slip_res = await client.post(
-                url=bank_slip_url,
-                headers=request_headers,
-                data=request_payload,
-            )
+        bank_slip_url = f"{BAIDU_API_BASE}/rest/2.0/ocr/v1/bank_receipt_new?access_token={token}"
 
-            bank_slip_result = bank_slip_res.json()
+        bank_slip_result = await self._post_ocr(
+            "bank_receipt_new",
+            bank_slip_url,
+            request_headers,
+        )
 
-            logger.info(
-                f"task-id:{task_id};API返回的银行回单信息：{bank_slip_result}"
-            )
+        # 完整的返回内容很大，只在 DEBUG 级别输出；用 % 参数，没有打开 DEBUG 时不会格式化
+        logger.debug(
+            "task-id:%s;API返回的银行回单信息：%s",
+            task_id,
+            bank_slip_result,
+        )
 
+        with track_stage(
+            "parse", endpoint="bank_receipt_new"
+        ):
             words_result: dict = bank_slip_result[
                 "words_result"
             ]
 
             result = process_bank_slip(words_result)
 
-            result["bank_slip_url"] = (
-                f"{BACK_END}/_upload/{self.file.name}"
-            )
+        # 内容相同的回单指向同一个文件
+        result["bank_slip_url"] = blob_url(self.file)
 
-            result["task_id"] = task_id
+        result["task_id"] = task_id
 
-            logger.info(result)
+        logger.info(result)
 
-            return result
+        return result
 
     async def vat_invoice(self) -> dict:
-        token = get_baidu_token.token
-        async with httpx.AsyncClient() as client:
-            task_id = (
-                generate_random_string()
-            )  # 用于记录运行日志
-
-            logger.info(
-                f"开始执行任务，task_id：{task_id},任务类型:发票识别"
-            )
-
-            vat_invoice_url = f"https://aip.baidubce.com/rest/2.0/ocr/v1/vat_invoice?access_token={token}"
-
-            request_headers = {
-                "Content-Type": "application/x-www-form-urlencoded"
-            }
-
-            upload_data = self.file.read_bytes()
+        task_id = (
+            generate_random_string()
+        )  # 用于记录运行日志
+        with span(
+            "ocr",
+            endpoint="vat_invoice",
+            task_id=task_id,
+            blob=self.file.name,
+        ):
+            return await self._vat_invoice(task_id)
+
+    async def _vat_invoice(self, task_id: str) -> dict:
+        token = await get_baidu_token.atoken()
+        logger.info(
+            f"开始执行任务，task_id：{task_id},任务类型:发票识别"
+        )
 
-            file_b64 = base64.b64encode(upload_data).decode(
-                "utf-8"
-            )
+        vat_invoice_url = f"{BAIDU_API_BASE}/rest/2.0/ocr/v1/vat_invoice?access_token={token}"
 
-            request_payload = (
-                {"image": file_b64}
-                if self.file.suffix in IMG_SUFFIX
-                else {"pdf_file": file_b64}
-            )
-            vat_invoice_res = await client.post(
-                url=vat_invoice_url,
-                headers=request_headers,
-                data=request_payload,
-            )
+        with track_stage("base64", endpoint="vat_invoice"):
+            request_headers = await OcrFormBody(
+                self.file
+            ).headers()
 
-            vat_invoice_result = vat_invoice_res.json()
+        vat_invoice_result = await self._post_ocr(
+            "vat_invoice", vat_invoice_url, request_headers
+        )
 
-            words_result: dict = vat_invoice_result[
-                "words_result"
-            ]
+        words_result: dict = vat_invoice_result[
+            "words_result"
+        ]
+
+        result = {
+            # "file_name": self.file.name,  # 文件名 -
+            "invoice_date": words_result[
+                "InvoiceDate"
+            ],  # 开票日期 -
+            "invoice_num": words_result[
+                "InvoiceNum"
+            ],  # 发票号码 -
+            "invoice_type": words_result[
+                "InvoiceType"
+            ],  # 发票种类 -
+            "purchaser_name": words_result[
+                "PurchaserName"
+            ],  # 购买方姓名 -
+            "purchaser_register_num": words_result[
+                "PurchaserRegisterNum"
+            ],  # 购买方税号 -
+            "seller_name": words_result[
+                "SellerName"
+            ],  # 销售方姓名 -
+            "seller_register_num": words_result[
+                "SellerRegisterNum"
+            ],  # 销售方纳税人识别号 -
+            # "total_amount": words_result[
+            #     "TotalAmount"
+            # ],  # 合计金额
+            # "total_tax": words_result[
+            #     "TotalTax"
+            # ],  # 合计税额
+            "amount_in_figures": words_result[
+                "AmountInFiguers"
+            ],  # 价税合计(小写)
+            # "amount_in_words": words_result[
+            #     "AmountInWords"
+            # ],  # 价税合计(大写)
+        }
 
-            result = {
-                # "file_name": self.file.name,  # 文件名 -
-                "invoice_date": words_result[
-                    "InvoiceDate"
-                ],  # 开票日期 -
-                "invoice_num": words_result[
-                    "InvoiceNum"
-                ],  # 发票号码 -
-                "invoice_type": words_result[
-                    "InvoiceType"
-                ],  # 发票种类 -
-                "purchaser_name": words_result[
-                    "PurchaserName"
-                ],  # 购买方姓名 -
-                "purchaser_register_num": words_result[
-                    "PurchaserRegisterNum"
-                ],  # 购买方税号 -
-                "seller_name": words_result[
-                    "SellerName"
-                ],  # 销售方姓名 -
-                "seller_register_num": words_result[
-                    "SellerRegisterNum"
-                ],  # 销售方纳税人识别号 -
-                # "total_amount": words_result[
-                #     "TotalAmount"
-                # ],  # 合计金额
-                # "total_tax": words_result[
-                #     "TotalTax"
-                # ],  # 合计税额
-                "amount_in_figures": words_result[
-                    "AmountInFiguers"
-                ],  # 价税合计(小写)
-                # "amount_in_words": words_result[
-                #     "AmountInWords"
-                # ],  # 价税合计(大写)
-            }
-
-            return result
+        return result
 
 
 # ================== 请求飞书多为表格 api =====================
 
 
 async def create_new_record(record: dict):
-    token = get_feishu_token.token
-    async with httpx.AsyncClient() as client:
+    token = await get_feishu_token.atoken()
+    async with httpx.AsyncClient(
+        verify=SSL_CONTEXT
+    ) as client:
         task_id = record.get("task_id", "")
 
         # --------新增记录---------
 
-        create_record_url = f"https://open.feishu.cn/open-apis/bitable/v1/apps/{FEISHU_APP_TOKEN}/tables/{FEISHU_FINANCE_TABLE_ID}/records"
+        create_record_url = f"{FEISHU_API_BASE}/open-apis/bitable/v1/apps/{FEISHU_APP_TOKEN}/tables/{FEISHU_FINANCE_TABLE_ID}/records"
 
         create_record_header = {
             "Authorization": f"Bearer {token}",
@@ -364,7 +618,10 @@ async def create_new_record(record: dict):
         }
 
         try:
-            trade_date: date = record["trade_date"]
+            trade_date: str | date = record["trade_date"]
+            # 表格里保存的是 YYYY-MM-DD，共享存储里读出来的也是字符串
+            if isinstance(trade_date, str):
+                trade_date = date.fromisoformat(trade_date)
             # 飞书要求日期字段是毫秒级精度的 Unix 时间戳
             timestamp = int(
                 time.mktime(trade_date.timetuple()) * 1000
@@ -394,29 +651,42 @@ async def create_new_record(record: dict):
             f"task_id:{task_id};准备发送到飞书文档的数据:{create_record_body}"
         )
 
-        create_record_resp = await client.post(
-            url=create_record_url,
-            headers=create_record_header,
-            json=create_record_body,
-        )
+        with track_stage(
+            "rate_limit", endpoint="bitable_records"
+        ):
+            await feishu_write_limiter.acquire()
+
+        with (
+            track_stage(
+                "feishu_write",
+                endpoint="bitable_records",
+                task_id=task_id,
+            ),
+            track_in_flight("bitable_records"),
+        ):
+            create_record_resp = await client.post(
+                url=create_record_url,
+                headers=create_record_header,
+                json=create_record_body,
+            )
 
-        create_record_resp = create_record_resp.json()
+            create_record_resp = create_record_resp.json()
 
-        code = create_record_resp.get("code")
+            code = create_record_resp.get("code")
 
-        match code:
-            case 0:
-                logger.info(
-                    f"task_id:{task_id};成功上传到飞书文档。"
-                )
+            match code:
+                case 0:
+                    logger.info(
+                        f"task_id:{task_id};成功上传到飞书文档。"
+                    )
 
-            case _:
-                logger.error(
-                    f"task_id:{task_id};未能成功上传数据到飞书文档，发生错误：{create_record_resp}"
-                )
-                raise Exception(
-                    f"task_id:{task_id};未能成功上传数据到飞书文档，发生错误：{create_record_resp}"
-                )
+                case _:
+                    logger.error(
+                        f"task_id:{task_id};未能成功上传数据到飞书文档，发生错误：{create_record_resp}"
+                    )
+                    raise Exception(
+                        f"task_id:{task_id};未能成功上传数据到飞书文档，发生错误：{create_record_resp}"
+                    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+import fcntl
+import json
+import os
+import re
+import secrets
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import AsyncIterator
+
+from .executor import run_io
+from .metrics import Counter
+from .storage import upload_dir
+
+UPLOAD_MAX_BYTES: int = int(
+    os.getenv("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024))
+)  # 分块上传的单个 PDF 大小上限，PDF 分割成单页后再识别
+UPLOAD_IMAGE_MAX_BYTES: int = int(
+    os.getenv("UPLOAD_IMAGE_MAX_BYTES", "5000000")
+)  # 分块上传的单个图片大小上限，图片整张发给百度识别，不能超过百度 api 的限制
+UPLOAD_CHUNK_BYTES: int = int(
+    os.getenv("UPLOAD_CHUNK_BYTES", str(4 * 1024 * 1024))
+)  # 浏览器每次上传的分块大小，断线后最多重传一个分块
+UPLOAD_EXPIRE_HOURS: float = float(
+    os.getenv("UPLOAD_EXPIRE_HOURS", "24")
+)  # 没有上传完的文件保留多久，过期后需要重新上传
+
+# 上传中的文件保存在上传目录下的这个子目录里
+UPLOAD_PREFIX = "partial"
+# secrets.token_urlsafe(16) 生成的 ID，路径里不可能出现 .. 之类的跳转
+UPLOAD_ID = re.compile(r"[A-Za-z0-9_-]{22}")
+
+UPLOAD_BYTES = Counter(
+    "easy_office_resumable_upload_bytes_total",
+    "分块上传收到的字节数",
+)
+UPLOADS = Counter(
+    "easy_office_resumable_uploads_total",
+    "分块上传的文件数，event 为 created、resumed（断点续传）或 completed",
+    ("event",),
+)
+
+
+class UploadError(Exception):
+    """分块上传的请求不合法
+
+    Args:
+        status: 返回给浏览器的 HTTP 状态码
+    """
+
+    def __init__(
+        self, message: str, status: int = 400
+    ) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class ResumableUpload:
+    """一个分块上传的文件
+
+    Args:
+        id: 上传 ID，也是文件名，随机生成，无法猜测
+        owner: 创建上传的会话，其他会话不能续传或使用这个文件
+        filename: 用户上传时的文件名
+        size: 文件总大小
+        created_at: 创建时间戳
+    """
+
+    id: str
+    owner: str
+    filename: str
+    size: int
+    created_at: float
+
+    @property
+    def path(self) -> Path:
+        return (
+            upload_dir() / UPLOAD_PREFIX / f"{self.id}.part"
+        )
+
+    @property
+    def offset(self) -> int:
+        """已经收到的字节数，以磁盘上的文件为准"""
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def complete(self) -> bool:
+        return self.offset == self.size
+
+
+def size_limit(filename: str) -> int:
+    """文件的大小上限，PDF 按页识别，可以比图片大得多"""
+    if filename.lower().endswith(".pdf"):
+        return UPLOAD_MAX_BYTES
+    return UPLOAD_IMAGE_MAX_BYTES
+
+
+class ResumableUploads:
+    """tus 风格的分块上传，支持断点续传
+
+    每个上传在磁盘上是一个 .part 文件和一个记录文件名、大小的 .json 文件，
+    多个后端进程共用上传目录时也能续传。上传完成后文件留在原地，
+    由识别流程按页读取，用完后调用 remove 删除
+    """
+
+    def _meta_path(self, upload_id: str) -> Path:
+        return (
+            upload_dir()
+            / UPLOAD_PREFIX
+            / f"{upload_id}.json"
+        )
+
+    def create(
+        self, owner: str, filename: str, size: int
+    ) -> ResumableUpload:
+        """登记一个新的上传，在线程池里执行"""
+        if not owner:
+            raise UploadError("缺少会话标识", status=401)
+        if size <= 0:
+            raise UploadError("文件为空")
+        limit = size_limit(filename)
+        if size > limit:
+            raise UploadError(
+                f"{filename} 超过 {limit / 1024 / 1024:.0f}MB",
+                status=413,
+            )
+        self.expire()
+        upload = ResumableUpload(
+            id=secrets.token_urlsafe(16),
+            owner=owner,
+            filename=filename,
+            size=size,
+            created_at=time.time(),
+        )
+        upload.path.parent.mkdir(
+            parents=True, exist_ok=True
+        )
+        upload.path.touch()
+        self._meta_path(upload.id).write_text(
+            json.dumps(asdict(upload), ensure_ascii=False)
+        )
+        UPLOADS.labels(event="created").inc()
+        return upload
+
+    def get(
+        self, upload_id: str, owner: str
+    ) -> ResumableUpload:
+        """读取上传信息，在线程池里执行
+
+        Raises:
+            UploadError: 上传不存在、已经过期或者属于其他会话
+        """
+        if not UPLOAD_ID.fullmatch(upload_id):
+            raise UploadError(
+                "上传不存在或已过期", status=404
+            )
+        try:
+            meta = json.loads(
+                self._meta_path(upload_id).read_text()
+            )
+        except (FileNotFoundError, ValueError, OSError):
+            raise UploadError(
+                "上传不存在或已过期", status=404
+            ) from None
+        upload = ResumableUpload(**meta)
+        if not owner or upload.owner != owner:
+            raise UploadError(
+                "上传不存在或已过期", status=404
+            )
+        return upload
+
+    def get_complete(
+        self, upload_id: str, owner: str
+    ) -> ResumableUpload:
+        """读取已经上传完整的文件，在线程池里执行
+
+        上传 ID 来自浏览器，浏览器说传完了也要以磁盘上的文件为准
+
+        Raises:
+            UploadError: 上传不存在、已经过期、属于其他会话或者还没有传完
+        """
+        upload = self.get(upload_id, owner)
+        if not upload.complete:
+            raise UploadError(
+                f"{upload.filename} 没有上传完整，请重新上传",
+                status=409,
+            )
+        return upload
+
+    async def append(
+        self,
+        upload: ResumableUpload,
+        offset: int,
+        chunks: AsyncIterator[bytes],
+    ) -> int:
+        """从 offset 开始写入一个分块，返回新的偏移
+
+        边收边写，不在内存里攒整个分块；连接中途断开时已经写入的部分保留，
+        浏览器查询偏移后从断开的位置续传
+
+        Raises:
+            UploadError: offset 和已经收到的字节数不一致，或者超出文件大小
+        """
+        with upload.path.open("r+b") as f:
+            try:
+                # 同一个上传同时只能有一个请求在写
+                fcntl.flock(
+                    f, fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+            except BlockingIOError:
+                raise UploadError(
+                    "这个文件正在上传", status=409
+                ) from None
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                raise UploadError(
+                    f"偏移不一致，服务端已收到 {current} 字节",
+                    status=409,
+                )
+            if offset > 0:
+                UPLOADS.labels(event="resumed").inc()
+            f.seek(offset)
+            try:
+                async for chunk in chunks:
+                    if f.tell() + len(chunk) > upload.size:
+                        await run_io(f.truncate, offset)
+                        raise UploadError(
+                            "上传的内容超出文件大小"
+                        )
+                    # 磁盘慢的时候写入也会阻塞，不能在事件循环里写
+                    await run_io(f.write, chunk)
+                    UPLOAD_BYTES.labels().inc(len(chunk))
+            finally:
+                await run_io(f.flush)
+            offset = f.tell()
+        if offset == upload.size:
+            UPLOADS.labels(event="completed").inc()
+        return offset
+
+    def remove(self, upload: ResumableUpload) -> None:
+        """删除上传的文件，在线程池里执行"""
+        upload.path.unlink(missing_ok=True)
+        self._meta_path(upload.id).unlink(missing_ok=True)
+
+    def expire(self) -> None:
+        """删除超过 UPLOAD_EXPIRE_HOURS 没有收到数据的上传"""
+        deadline = time.time() - UPLOAD_EXPIRE_HOURS * 3600
+        for path in (upload_dir() / UPLOAD_PREFIX).glob(
+            "*.json"
+        ):
+            part = path.with_suffix(".part")
+            try:
+                mtime = (
+                    (part if part.exists() else path)
+                    .stat()
+                    .st_mtime
+                )
+            except FileNotFoundError:
+                continue
+            if mtime < deadline:
+                part.unlink(missing_ok=True)
+                path.unlink(missing_ok=True)
+
+
+resumable_uploads = ResumableUploads()
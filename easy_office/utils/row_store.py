@@ -0,0 +1,603 @@
+import contextlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Iterable, Iterator
+
+from reflex_ag_grid.handlers import handle_filter_model
+
+from .shared_store import (
+    SHARED_STORE_URL,
+    SharedStore,
+    shared_store,
+)
+
+ROW_STORE_MAX_BATCHES: int = int(
+    os.getenv("ROW_STORE_MAX_BATCHES", "500")
+)  # 最多保存的批次数，超出时淘汰最久没有访问的批次
+ROW_STORE_TTL: float = float(
+    os.getenv("ROW_STORE_TTL", str(24 * 3600))
+)  # 批次多久没有访问就被清理，单位秒
+ROW_STORE_CHUNK_ROWS: int = int(
+    os.getenv("ROW_STORE_CHUNK_ROWS", "500")
+)  # 逐行读取时每次加锁复制的行数
+ROW_STORE_SHARED: bool = (
+    os.getenv(
+        "ROW_STORE_SHARED", "1" if SHARED_STORE_URL else "0"
+    )
+    == "1"
+)  # 批次是否保存到 shared_store，多个后端进程时打开；配置了 Redis 时默认打开
+# 等待其他进程修改同一个批次的最长时间，单位秒
+ROW_STORE_LOCK_TIMEOUT = 10
+# 共享时每次修改只写一条修改记录，攒够这么多条再写一次完整的快照
+ROW_STORE_SNAPSHOT_EVERY = 100
+
+# 每种批次的列，行数据按这个顺序保存，导出时也按这个顺序输出
+COLUMNS: dict[str, tuple[str, ...]] = {
+    "bank_slip": (
+        "trade_date",
+        "description",
+        "additional_info",
+        "amount",
+        "category",
+        "payer",
+        "receiver",
+        "bank_slip_url",
+        "task_id",
+    ),
+    "vat_invoice": (
+        "file_name",
+        "invoice_date",
+        "invoice_num",
+        "invoice_type",
+        "purchaser_name",
+        "purchaser_register_num",
+        "seller_name",
+        "seller_register_num",
+        "amount_in_figures",
+    ),
+}
+
+
+def _cell(value: Any) -> Any:
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+
+class Batch:
+    """一个批次的识别结果
+
+    每行是按 columns 顺序排列的值列表，不为每一行保存一份字段名。
+    base 和 saved_at 是共享存储里最近一次快照的版本号和写入时间
+
+    Args:
+        kind: 批次类型，bank_slip 或 vat_invoice
+        owner: 创建批次的会话，表格接口只给这个会话返回数据
+    """
+
+    __slots__ = (
+        "kind",
+        "owner",
+        "columns",
+        "index",
+        "rows",
+        "version",
+        "base",
+        "saved_at",
+        "accessed",
+        "_view_key",
+        "_view",
+    )
+
+    def __init__(self, kind: str, owner: str) -> None:
+        self.kind = kind
+        self.owner = owner
+        self.columns = COLUMNS[kind]
+        self.index = {
+            name: i for i, name in enumerate(self.columns)
+        }
+        self.rows: list[list[Any]] = []
+        self.version = 0
+        self.base = 0
+        self.saved_at = time.time()
+        self.accessed = time.monotonic()
+        # 最近一次排序、筛选的结果，翻页时不必每一块都重新排序
+        self._view_key: tuple = ()
+        self._view: list[int] = []
+
+    def to_row(self, record: dict) -> list[Any]:
+        """按列顺序取出记录的值
+
+        识别结果里的日期转换成 YYYY-MM-DD，和表格里编辑后保存的格式一致，
+        行数据可以直接序列化成 JSON
+        """
+        return [
+            _cell(record.get(name, ""))
+            for name in self.columns
+        ]
+
+    def to_dict(self, row: list[Any]) -> dict:
+        return dict(zip(self.columns, row))
+
+    def dumps(self) -> bytes:
+        return json.dumps(
+            {
+                "kind": self.kind,
+                "owner": self.owner,
+                "rows": self.rows,
+                "version": self.version,
+                "saved_at": self.saved_at,
+            },
+            ensure_ascii=False,
+        ).encode()
+
+    @classmethod
+    def loads(cls, data: bytes) -> "Batch":
+        saved = json.loads(data)
+        batch = cls(saved["kind"], saved["owner"])
+        batch.rows = saved["rows"]
+        batch.version = batch.base = saved["version"]
+        batch.saved_at = saved["saved_at"]
+        return batch
+
+    def apply(self, change: dict) -> None:
+        """应用一条修改记录：{"rows": {行号: 整行}, "append": [追加的行]}"""
+        for row, values in change["rows"].items():
+            self.rows[int(row)] = values
+        self.rows.extend(change["append"])
+
+    def view(
+        self, sort_model: list[dict], filter_model: dict
+    ) -> list[int]:
+        """按 AG Grid 的排序、筛选条件返回行号列表"""
+        key = (
+            self.version,
+            json.dumps(sort_model, sort_keys=True),
+            json.dumps(filter_model, sort_keys=True),
+        )
+        if key == self._view_key:
+            return self._view
+
+        view = list(range(len(self.rows)))
+        if filter_model:
+            view = [
+                i
+                for i in view
+                if handle_filter_model(
+                    {
+                        name: str(value)
+                        for name, value in zip(
+                            self.columns, self.rows[i]
+                        )
+                    },
+                    filter_model,
+                )
+            ]
+        # 多列排序：从优先级最低的列开始，利用排序的稳定性
+        for spec in reversed(sort_model):
+            column = self.index.get(spec.get("colId", ""))
+            if column is None:
+                continue
+            view.sort(
+                key=lambda i: _sort_key(
+                    self.rows[i][column]
+                ),
+                reverse=spec.get("sort") == "desc",
+            )
+
+        self._view_key, self._view = key, view
+        return view
+
+
+def _sort_key(value: Any) -> tuple:
+    """能转成数字的按数字排序（例如金额），其余按字符串排序"""
+    try:
+        return (0, float(value), "")
+    except (TypeError, ValueError):
+        return (1, 0.0, str(value))
+
+
+class RowStore:
+    """保存在服务端的表格数据，会话状态里只保存批次 ID 和版本号
+
+    Reflex 每次事件都会序列化会话状态，行数据放在这里可以避免每次编辑都传输整个表格。
+    表格通过 /grid 接口按块读取，每个会话每种类型只有一个当前批次。
+    不传 shared 时只保存在当前进程的内存里，后端重启后批次会丢失；
+    传入时每次修改都写入共享存储，负载均衡把请求分到哪个进程都能读到，
+    内存里的批次只是缓存，版本号落后时补上缺少的修改。
+    共享存储里是一份快照加上之后每个版本的修改记录，修改记录只有改动的行，
+    编辑一个单元格不用重写整个批次；修改记录攒够 ROW_STORE_SNAPSHOT_EVERY 条，
+    或者快照过了一半有效期时重写快照。
+    共享时读写都要访问共享存储，在事件循环里调用时放到线程池里执行
+
+    Args:
+        max_batches: 内存里最多保存的批次数
+        ttl: 批次多久没有访问就被清理，单位秒
+        shared: 多个后端进程共用的存储
+    """
+
+    def __init__(
+        self,
+        max_batches: int,
+        ttl: float,
+        shared: SharedStore | None = None,
+    ) -> None:
+        self.max_batches = max_batches
+        self.ttl = ttl
+        self.shared = shared
+        self._batches: OrderedDict[str, Batch] = (
+            OrderedDict()
+        )
+        # (会话, 批次类型) → 当前批次 ID
+        self._owners: dict[tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._batches:
+            batch_id, batch = next(
+                iter(self._batches.items())
+            )
+            if (
+                len(self._batches) <= self.max_batches
+                and now - batch.accessed < self.ttl
+            ):
+                break
+            self._remove(batch_id)
+
+    def _remove(self, batch_id: str) -> None:
+        batch = self._batches.pop(batch_id, None)
+        if batch is None:
+            return
+        key = (batch.owner, batch.kind)
+        if self._owners.get(key) == batch_id:
+            del self._owners[key]
+
+    def _get(self, batch_id: str) -> Batch | None:
+        """在锁里调用；共享存储里的版本比内存里的新时补上缺少的修改"""
+        batch = self._batches.get(batch_id)
+        if self.shared is not None:
+            version = self.shared.get(
+                f"row_store:{batch_id}:version"
+            )
+            if version is None:
+                self._remove(batch_id)
+                return None
+            if batch is None or not self._catch_up(
+                batch_id, batch, int(version)
+            ):
+                batch = self._load(batch_id, int(version))
+                if batch is None:
+                    self._remove(batch_id)
+                    return None
+                self._batches[batch_id] = batch
+                self._evict()
+        if batch is not None:
+            batch.accessed = time.monotonic()
+            self._batches.move_to_end(batch_id)
+        return batch
+
+    def _load(
+        self, batch_id: str, version: int
+    ) -> Batch | None:
+        """读取快照，再应用快照之后的修改记录"""
+        assert self.shared is not None
+        data = self.shared.get(f"row_store:{batch_id}")
+        if data is None:
+            return None
+        batch = Batch.loads(data)
+        if not self._catch_up(batch_id, batch, version):
+            return None
+        return batch
+
+    def _catch_up(
+        self, batch_id: str, batch: Batch, version: int
+    ) -> bool:
+        """按顺序应用 batch 的版本之后到 version 为止的修改记录，缺少记录时返回 False"""
+        assert self.shared is not None
+        if batch.version > version:
+            # 内存里的版本比共享存储里的还新，说明写入失败过，只能重新读取
+            return False
+        changes = self.shared.get_many(
+            [
+                f"row_store:{batch_id}:change:{v}"
+                for v in range(
+                    batch.version + 1, version + 1
+                )
+            ]
+        )
+        if None in changes:
+            return False
+        for change in changes:
+            batch.apply(json.loads(change))  # type:ignore
+        batch.version = version
+        return True
+
+    def _save(
+        self, batch_id: str, batch: Batch, change: dict
+    ) -> None:
+        """修改后写入共享存储
+
+        先写修改记录（需要时还有快照）再写版本号，读到新版本号时一定能读到这次修改
+        """
+        if self.shared is None:
+            return
+        self.shared.set(
+            f"row_store:{batch_id}:change:{batch.version}",
+            json.dumps(change, ensure_ascii=False).encode(),
+            self.ttl,
+        )
+        if (
+            batch.version - batch.base
+            >= ROW_STORE_SNAPSHOT_EVERY
+            # 快照之后的修改记录和快照一样会过期，快照不能比它们旧太多
+            or time.time() - batch.saved_at > self.ttl / 2
+        ):
+            batch.base, batch.saved_at = (
+                batch.version,
+                time.time(),
+            )
+            self.shared.set(
+                f"row_store:{batch_id}",
+                batch.dumps(),
+                self.ttl,
+            )
+        else:
+            self.shared.expire(
+                f"row_store:{batch_id}", self.ttl
+            )
+        self.shared.set(
+            f"row_store:{batch_id}:version",
+            str(batch.version).encode(),
+            self.ttl,
+        )
+
+    @contextlib.contextmanager
+    def _editing(
+        self, batch_id: str
+    ) -> Iterator[tuple[Batch, set[int]]]:
+        """修改批次，修改完版本号加一；共享时在跨进程的锁里读取最新版本再修改
+
+        调用方把改过的行号加到返回的集合里，追加的行不用加，
+        共享时只把这些行写进修改记录
+
+        Raises:
+            KeyError: 批次不存在或已过期
+            TimeoutError: 等待其他进程修改同一个批次超时
+        """
+        with (
+            self.shared.lock(
+                f"row_store:{batch_id}",
+                ROW_STORE_LOCK_TIMEOUT,
+            )
+            if self.shared is not None
+            else contextlib.nullcontext()
+        ):
+            with self._lock:
+                batch = self._get(batch_id)
+                if batch is None:
+                    raise KeyError(
+                        f"批次 {batch_id} 不存在或已过期"
+                    )
+                count = len(batch.rows)
+                changed: set[int] = set()
+                yield batch, changed
+                batch.version += 1
+                try:
+                    self._save(
+                        batch_id,
+                        batch,
+                        {
+                            "rows": {
+                                str(row): batch.rows[row]
+                                for row in changed
+                            },
+                            "append": batch.rows[count:],
+                        },
+                    )
+                except BaseException:
+                    # 内存里已经改了，共享存储里没有，丢掉缓存，下次重新读取
+                    self._batches.pop(batch_id, None)
+                    raise
+
+    def create(self, kind: str, owner: str) -> str:
+        """新建一个空批次，作为这个会话这种类型的当前批次，返回批次 ID
+
+        批次 ID 同时是下载链接里的凭证，所以用 secrets 生成，不能被猜到
+        """
+        batch_id = secrets.token_urlsafe(16)
+        batch = Batch(kind, owner)
+        with self._lock:
+            self._batches[batch_id] = batch
+            self._owners[(owner, kind)] = batch_id
+            self._evict()
+            if self.shared is not None:
+                # 版本 0 的快照，之后的修改都记在修改记录里
+                self.shared.set(
+                    f"row_store:{batch_id}",
+                    batch.dumps(),
+                    self.ttl,
+                )
+                self.shared.set(
+                    f"row_store:{batch_id}:version",
+                    b"0",
+                    self.ttl,
+                )
+                self.shared.set(
+                    f"row_store:owner:{owner}:{kind}",
+                    batch_id.encode(),
+                    self.ttl,
+                )
+        return batch_id
+
+    def find(self, owner: str, kind: str) -> str | None:
+        """返回会话当前的批次 ID"""
+        if self.shared is not None:
+            batch_id = self.shared.get(
+                f"row_store:owner:{owner}:{kind}"
+            )
+            return batch_id.decode() if batch_id else None
+        with self._lock:
+            return self._owners.get((owner, kind))
+
+    def extend(
+        self, batch_id: str, records: Iterable[dict]
+    ) -> int:
+        """追加记录，返回新的版本号"""
+        with self._editing(batch_id) as (batch, _):
+            batch.rows.extend(map(batch.to_row, records))
+        return batch.version
+
+    def update_cells(
+        self,
+        batch_id: str,
+        edits: Iterable[tuple[int, str, Any]],
+    ) -> int:
+        """一次修改多个单元格，返回新的版本号
+
+        先检查全部编辑，有一条不合法就一条都不修改
+
+        Args:
+            edits: (行号, 字段, 新值) 的列表
+        """
+        with self._editing(batch_id) as (batch, changed):
+            cells = [
+                (
+                    row,
+                    batch.rows[row],
+                    batch.index[field],
+                    value,
+                )
+                for row, field, value in edits
+            ]
+            for row, values, column, value in cells:
+                values[column] = value
+                changed.add(row)
+        return batch.version
+
+    def fill_down(
+        self, batch_id: str, rows: list[int], field: str
+    ) -> int:
+        """把 rows 里第一行的 field 填到其余各行，返回新的版本号"""
+        with self._editing(batch_id) as (batch, changed):
+            column = batch.index[field]
+            targets = [batch.rows[row] for row in rows]
+            if targets:
+                value = targets[0][column]
+                for row in targets[1:]:
+                    row[column] = value
+                changed.update(rows[1:])
+        return batch.version
+
+    def kind(self, batch_id: str) -> str | None:
+        """返回批次类型，批次不存在时返回 None"""
+        with self._lock:
+            batch = self._get(batch_id)
+            return batch.kind if batch is not None else None
+
+    def iter_rows(
+        self,
+        batch_id: str,
+        chunk_rows: int = ROW_STORE_CHUNK_ROWS,
+    ) -> Iterator[list[Any]]:
+        """按 COLUMNS 的顺序逐行返回批次的记录，用于导出
+
+        每次只在锁里复制 chunk_rows 行，导出大批次时不会长时间占着锁，
+        也不会复制整个批次；开始之后追加的行不会导出
+        """
+        with self._lock:
+            batch = self._get(batch_id)
+            if batch is None:
+                return
+            total = len(batch.rows)
+        for start in range(0, total, chunk_rows):
+            with self._lock:
+                chunk = [
+                    list(row)
+                    for row in batch.rows[
+                        start : start + chunk_rows
+                    ]
+                ]
+            yield from chunk
+
+    def delete(self, batch_id: str) -> None:
+        with self._lock:
+            batch = self._get(batch_id)
+            self._remove(batch_id)
+            if self.shared is not None:
+                self.shared.delete(
+                    f"row_store:{batch_id}:version"
+                )
+                self.shared.delete(f"row_store:{batch_id}")
+                # 修改记录没有版本号就读不到了，留给它们自己过期
+                if (
+                    batch is not None
+                    and self.find(batch.owner, batch.kind)
+                    == batch_id
+                ):
+                    self.shared.delete(
+                        f"row_store:owner:{batch.owner}:{batch.kind}"
+                    )
+
+    def count(self, batch_id: str) -> int:
+        with self._lock:
+            batch = self._get(batch_id)
+            return (
+                len(batch.rows) if batch is not None else 0
+            )
+
+    def records(self, batch_id: str) -> list[dict]:
+        """以字典列表的形式返回批次的全部记录，批次不存在时返回空列表"""
+        with self._lock:
+            batch = self._get(batch_id)
+            if batch is None:
+                return []
+            return [
+                batch.to_dict(row) for row in batch.rows
+            ]
+
+    def page(
+        self,
+        batch_id: str,
+        start: int,
+        end: int,
+        sort_model: list[dict] | None = None,
+        filter_model: dict | None = None,
+    ) -> tuple[list[dict], int]:
+        """按块读取排序、筛选之后的记录
+
+        没有排序和筛选时直接切片，耗时只和块大小有关
+
+        Returns:
+            tuple[list[dict], int]: 第 start 到 end 行，每行带上 row_id，即行在批次里的位置（字符串，AG Grid 要求行 ID 是字符串）；
+            以及排序、筛选之后的总行数
+        """
+        with self._lock:
+            batch = self._get(batch_id)
+            if batch is None:
+                return [], 0
+            if sort_model or filter_model:
+                view = batch.view(
+                    sort_model or [], filter_model or {}
+                )
+            else:
+                view = range(len(batch.rows))
+            return [
+                {
+                    "row_id": str(i),
+                    **batch.to_dict(batch.rows[i]),
+                }
+                for i in view[start:end]
+            ], len(view)
+
+
+row_store = RowStore(
+    ROW_STORE_MAX_BATCHES,
+    ROW_STORE_TTL,
+    shared_store if ROW_STORE_SHARED else None,
+)
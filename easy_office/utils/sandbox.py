@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import resource
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Any, Callable
+
+from .log import logger
+from .metrics import Counter
+
+CPU_TASK_TIMEOUT: float = float(
+    os.getenv("CPU_TASK_TIMEOUT", "60")
+)  # 单个任务的墙钟时间上限，单位秒
+CPU_TASK_CPU_SECONDS: int = int(
+    os.getenv("CPU_TASK_CPU_SECONDS", "30")
+)  # 单个任务的 CPU 时间上限，单位秒
+CPU_TASK_MEMORY_MB: int = int(
+    os.getenv("CPU_TASK_MEMORY_MB", "1024")
+)  # 工作进程在 fork 之后最多还能再申请的内存，单位 MB
+
+WORKER_FAILURES = Counter(
+    "easy_office_cpu_worker_failures_total",
+    "工作进程因超时、超出资源限制或崩溃被回收的次数",
+    ("reason",),
+)
+
+
+class WorkerError(Exception):
+    """任务没有正常结束：超时、超出资源限制或者工作进程崩溃"""
+
+    reason: str = "crashed"
+
+
+class WorkerTimeout(WorkerError):
+    reason = "timeout"
+
+
+class WorkerCPULimit(WorkerError):
+    reason = "cpu_limit"
+
+
+class WorkerMemoryLimit(WorkerError):
+    reason = "memory_limit"
+
+
+def _vm_size() -> int:
+    """当前进程已经占用的虚拟内存，单位字节"""
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[0])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def _worker_main(
+    conn: Connection, cpu_seconds: int, memory_bytes: int
+) -> None:
+    """工作进程的主循环：接收任务，执行，把结果或者异常发回去"""
+    # Ctrl+C 交给父进程处理，工作进程随父进程一起退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # fork 出来的日志队列没有线程消费，工作进程里不输出日志
+    logging.disable(logging.CRITICAL)
+
+    if memory_bytes > 0:
+        try:
+            # fork 之后的虚拟内存已经包含父进程的全部映射，上限在此基础上再加
+            limit = _vm_size() + memory_bytes
+            resource.setrlimit(
+                resource.RLIMIT_AS, (limit, limit)
+            )
+        except (OSError, ValueError):
+            pass  # 不支持的系统上只保留超时限制
+
+    while True:
+        try:
+            func, args, kwargs = conn.recv()
+        except EOFError:
+            return
+
+        if cpu_seconds > 0:
+            # RLIMIT_CPU 是整个进程累计的，每个任务开始前在已用时间上加上限
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = int(usage.ru_utime + usage.ru_stime)
+            _, hard = resource.getrlimit(
+                resource.RLIMIT_CPU
+            )
+            resource.setrlimit(
+                resource.RLIMIT_CPU,
+                (used + cpu_seconds, hard),
+            )
+
+        try:
+            conn.send((True, func(*args, **kwargs)))
+        except MemoryError:
+            conn.send(
+                (False, WorkerMemoryLimit("内存超限"))
+            )
+            return  # 内存可能已经碎片化，退出后由父进程重新创建
+        except Exception as e:
+            try:
+                conn.send((False, e))
+            except Exception:
+                # 异常本身无法 pickle 时只发送描述
+                conn.send((False, RuntimeError(repr(e))))
+
+
+class SandboxWorker:
+    """一个带资源限制的工作进程，同一时间只执行一个任务"""
+
+    def __init__(self) -> None:
+        # 使用 fork：子进程直接继承已经导入的模块，不必重新导入整个 Reflex 应用
+        context = multiprocessing.get_context("fork")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(
+                child_conn,
+                CPU_TASK_CPU_SECONDS,
+                CPU_TASK_MEMORY_MB * 1024 * 1024,
+            ),
+            name="cpu-worker",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def run(
+        self,
+        func: Callable[..., Any],
+        args: tuple,
+        kwargs: dict,
+        timeout: float,
+    ) -> Any:
+        self.conn.send((func, args, kwargs))
+        if not self.conn.poll(timeout):
+            raise WorkerTimeout(
+                f"处理超时（超过 {timeout:g} 秒）"
+            )
+        try:
+            ok, payload = self.conn.recv()
+        except EOFError:
+            self.process.join(timeout=1)
+            if self.process.exitcode == -signal.SIGXCPU:
+                raise WorkerCPULimit(
+                    f"CPU 时间超限（超过 {CPU_TASK_CPU_SECONDS} 秒）"
+                ) from None
+            raise WorkerError(
+                f"工作进程异常退出，退出码：{self.process.exitcode}"
+            ) from None
+        if ok:
+            return payload
+        raise payload
+
+    def kill(self) -> None:
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=1)
+
+
+class SandboxPool:
+    """带资源限制的进程池
+
+    每个调度线程独占一个工作进程，任务超时、超出资源限制或者崩溃时，
+    只回收出问题的那个工作进程，下一次调用时重新创建，不影响其他任务
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        self._threads = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="cpu",
+        )
+        self._local = threading.local()
+        self._workers: set[SandboxWorker] = set()
+        self._lock = threading.Lock()
+
+    def _worker(self) -> SandboxWorker:
+        worker: SandboxWorker | None = getattr(
+            self._local, "worker", None
+        )
+        if worker is None or not worker.is_alive():
+            if worker is not None:
+                self._discard(worker)
+            worker = SandboxWorker()
+            self._local.worker = worker
+            with self._lock:
+                self._workers.add(worker)
+        return worker
+
+    def _discard(self, worker: SandboxWorker) -> None:
+        worker.kill()
+        with self._lock:
+            self._workers.discard(worker)
+        self._local.worker = None
+
+    def call(
+        self,
+        func: Callable[..., Any],
+        args: tuple,
+        kwargs: dict,
+        timeout: float = CPU_TASK_TIMEOUT,
+    ) -> Any:
+        """在调度线程里执行，阻塞到任务结束"""
+        worker = self._worker()
+        start = time.perf_counter()
+        try:
+            return worker.run(func, args, kwargs, timeout)
+        except WorkerError as e:
+            WORKER_FAILURES.labels(reason=e.reason).inc()
+            logger.error(
+                f"{func.__name__} 执行失败，{time.perf_counter() - start:.1f}s 后回收工作进程：{e}"
+            )
+            self._discard(worker)
+            raise
+
+    async def run(
+        self,
+        func: Callable[..., Any],
+        *args: Any,
+        **kwargs: Any,
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._threads, self.call, func, args, kwargs
+        )
+
+    def shutdown(self) -> None:
+        self._threads.shutdown(
+            wait=False, cancel_futures=True
+        )
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.kill()
@@ -0,0 +1,292 @@
+import os
+import re
+import sqlite3
+import threading
+from datetime import date, datetime
+
+from .executor import run_io
+from .log import logger
+from .request_api import parse_date
+
+SEARCH_INDEX_DB: str = os.getenv(
+    "SEARCH_INDEX_DB", "./EasyFinance.db"
+)
+
+# 中日韩文字没有空格分词，FTS5 的 unicode61 会把一整串汉字当成一个词
+# 所以入库和查询前都在每个汉字之间插入空格，按字建索引，再用短语查询
+CJK_PATTERN: re.Pattern[str] = re.compile(
+    r"([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef])"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_records (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    trade_date TEXT,
+    amount REAL,
+    payer TEXT,
+    receiver TEXT,
+    description TEXT,
+    additional_info TEXT,
+    category TEXT,
+    file_url TEXT,
+    task_id TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ocr_records_trade_date
+    ON ocr_records (trade_date);
+CREATE VIRTUAL TABLE IF NOT EXISTS ocr_records_fts USING fts5(
+    payer,
+    receiver,
+    description,
+    additional_info,
+    category,
+    content='',
+    tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+FTS_COLUMNS: list[str] = [
+    "payer",
+    "receiver",
+    "description",
+    "additional_info",
+    "category",
+]
+
+
+def tokenize(text: str) -> str:
+    """在每个汉字两侧插入空格，让 FTS5 按字建立索引"""
+    return CJK_PATTERN.sub(r" \1 ", text or "")
+
+
+def build_match_query(query: str) -> str:
+    """把用户输入的关键字转换为 FTS5 的 MATCH 表达式
+
+    每个以空格分隔的关键字转成一个短语，多个关键字之间是 AND 关系
+
+    Args:
+        query: 用户输入的关键字
+
+    Returns:
+        str: FTS5 MATCH 表达式，没有有效关键字时返回空字符串
+    """
+    phrases = []
+    for term in query.split():
+        tokens = tokenize(term.replace('"', " ")).split()
+        if tokens:
+            phrases.append('"' + " ".join(tokens) + '"')
+    return " AND ".join(phrases)
+
+
+def _to_float(value) -> float | None:
+    try:
+        return float(str(value).replace(",", ""))
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_date_str(value) -> str:
+    if isinstance(value, (date, datetime)):
+        return value.strftime("%Y-%m-%d")
+    return str(value or "")
+
+
+class SearchIndex:
+    """基于 SQLite FTS5 的历史识别结果索引
+
+    ocr_records 保存原始字段，ocr_records_fts 是无内容（contentless）的全文索引，
+    两张表通过 rowid 关联
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.db_path, check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def add(self, kind: str, record: dict) -> int:
+        """写入一条记录
+
+        Args:
+            kind: 记录类型，bank_slip 或 vat_invoice
+            record: 标准化之后的记录，字段同 ocr_records 表
+
+        Returns:
+            int: 新记录的 id
+        """
+        row = {
+            "kind": kind,
+            "trade_date": _to_date_str(
+                record.get("trade_date")
+            ),
+            "amount": _to_float(record.get("amount")),
+            "payer": record.get("payer", ""),
+            "receiver": record.get("receiver", ""),
+            "description": record.get("description", ""),
+            "additional_info": record.get(
+                "additional_info", ""
+            ),
+            "category": record.get("category", ""),
+            "file_url": record.get("file_url", ""),
+            "task_id": record.get("task_id", ""),
+            "created_at": datetime.now().isoformat(
+                timespec="seconds"
+            ),
+        }
+        with self._lock, self.conn as conn:
+            cursor = conn.execute(
+                f"INSERT INTO ocr_records ({', '.join(row)}) "
+                f"VALUES ({', '.join('?' for _ in row)})",
+                list(row.values()),
+            )
+            rowid = cursor.lastrowid
+            conn.execute(
+                f"INSERT INTO ocr_records_fts (rowid, {', '.join(FTS_COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' for _ in FTS_COLUMNS)})",
+                [rowid]
+                + [
+                    tokenize(str(row[col] or ""))
+                    for col in FTS_COLUMNS
+                ],
+            )
+        return rowid  # type:ignore
+
+    def search(
+        self,
+        query: str,
+        start_date: str = "",
+        end_date: str = "",
+        limit: int = 100,
+    ) -> list[dict]:
+        """按关键字和日期范围查询记录，结果按相关度排序
+
+        Args:
+            query: 关键字，多个关键字用空格分隔
+            start_date: 起始日期，格式 YYYY-MM-DD，可以为空
+            end_date: 截止日期，格式 YYYY-MM-DD，可以为空
+            limit: 最多返回的条数
+
+        Returns:
+            list[dict]: 查询结果
+        """
+        match = build_match_query(query)
+        conditions: list[str] = []
+        params: list = []
+
+        if match:
+            sql = (
+                "SELECT r.* FROM ocr_records_fts f "
+                "JOIN ocr_records r ON r.id = f.rowid "
+                "WHERE ocr_records_fts MATCH ?"
+            )
+            params.append(match)
+            order = "ORDER BY bm25(ocr_records_fts), r.trade_date DESC"
+        else:
+            sql = "SELECT r.* FROM ocr_records r WHERE 1"
+            order = "ORDER BY r.trade_date DESC, r.id DESC"
+
+        if start_date:
+            conditions.append("r.trade_date >= ?")
+            params.append(start_date)
+        if end_date:
+            conditions.append("r.trade_date <= ?")
+            params.append(end_date)
+
+        for condition in conditions:
+            sql += f" AND {condition}"
+
+        sql += f" {order} LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [dict(row) for row in rows]
+
+
+search_index = SearchIndex(SEARCH_INDEX_DB)
+
+
+def bank_slip_to_index_record(record: dict) -> dict:
+    """把发送到飞书的银行回单记录转为索引记录"""
+    return {
+        "trade_date": record.get("trade_date"),
+        "amount": record.get("amount"),
+        "payer": record.get("payer", ""),
+        "receiver": record.get("receiver", ""),
+        "description": record.get("description", ""),
+        "additional_info": record.get(
+            "additional_info", ""
+        ),
+        "category": record.get("category", ""),
+        "file_url": record.get("bank_slip_url", ""),
+        "task_id": record.get("task_id", ""),
+    }
+
+
+def vat_invoice_to_index_record(record: dict) -> dict:
+    """把发票识别结果转为索引记录，购买方记为付款方，销售方记为收款方"""
+    return {
+        "trade_date": parse_date(
+            record.get("invoice_date", "")
+        ),
+        "amount": record.get("amount_in_figures"),
+        "payer": record.get("purchaser_name", ""),
+        "receiver": record.get("seller_name", ""),
+        "description": " ".join(
+            filter(
+                None,
+                [
+                    record.get("invoice_type", ""),
+                    record.get("invoice_num", ""),
+                ],
+            )
+        ),
+        "additional_info": " ".join(
+            filter(
+                None,
+                [
+                    record.get("file_name", ""),
+                    record.get(
+                        "purchaser_register_num", ""
+                    ),
+                    record.get("seller_register_num", ""),
+                ],
+            )
+        ),
+        "category": "发票",
+        "file_url": record.get("file_url", ""),
+        "task_id": record.get("task_id", ""),
+    }
+
+
+async def index_records(
+    kind: str, records: list[dict]
+) -> None:
+    """在线程池里把记录写入索引，写入失败只记录日志，不影响主流程
+
+    Args:
+        kind: 记录类型，bank_slip 或 vat_invoice
+        records: 标准化之后的记录
+    """
+
+    def _write() -> None:
+        for record in records:
+            search_index.add(kind, record)
+
+    try:
+        await run_io(_write)
+    except sqlite3.Error as e:
+        logger.error(f"写入搜索索引失败：{e}")
@@ -0,0 +1,387 @@
+import contextlib
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Iterator
+
+import redis
+
+SHARED_STORE_URL: str = os.getenv(
+    "SHARED_STORE_URL", os.getenv("REDIS_URL", "")
+)  # redis://...，多台机器部署时使用；不设置时用本机的 SQLite，Reflex 的 REDIS_URL 也会被使用
+SHARED_STORE_DB: str = os.getenv(
+    "SHARED_STORE_DB", "./EasyFinance.db"
+)  # 没有 Redis 时保存共享数据的 SQLite 文件，同一台机器上的进程共用
+# 本机的锁分成这么多段，不同名字落在同一段时只是多等一会儿
+LOCK_STRIPES = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_store (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# 令牌桶：按经过的时间补充令牌，再预定一个，令牌不够时记为欠账，返回需要等待的秒数；
+# 传了 floor 时只在取走后还剩 floor 个以上才取，否则不预定，返回要等多久才够。
+# 用 Redis 服务器的时间，各台机器的时钟不一致也没关系
+TAKE_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local floor = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+if floor and tokens - 1 < floor then
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    return tostring((floor + 1 - tokens) / rate)
+end
+tokens = tokens - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return tostring(math.max(0, -tokens / rate))
+"""
+
+
+class SharedStore(ABC):
+    """多个后端进程共用的键值存储和锁
+
+    保存 token、表格批次等需要在进程之间共享、重启后还在的数据。
+    方法都是同步的，在事件循环里调用时放到线程池里执行
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> bytes | None:
+        """读取 key 的值，不存在或已过期时返回 None"""
+
+    @abstractmethod
+    def set(
+        self,
+        key: str,
+        value: bytes,
+        ttl: float | None = None,
+    ) -> None:
+        """保存 key 的值，ttl 秒后过期，None 表示不过期"""
+
+    @abstractmethod
+    def get_many(
+        self, keys: list[str]
+    ) -> list[bytes | None]:
+        """一次读取多个 key，顺序和 keys 相同，不存在或已过期的为 None"""
+
+    @abstractmethod
+    def expire(self, key: str, ttl: float) -> None:
+        """把 key 的过期时间重新设为 ttl 秒之后，不存在时什么也不做"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None: ...
+
+    @abstractmethod
+    def lock(
+        self, name: str, timeout: float
+    ) -> contextlib.AbstractContextManager:
+        """所有进程之间的互斥锁
+
+        Args:
+            name: 锁的名字
+            timeout: 最多等待的秒数，超时抛出 TimeoutError；
+                Redis 的锁同时在这么多秒后自动释放，持有锁的进程崩溃也不会一直锁住
+        """
+
+    @abstractmethod
+    def take_token(
+        self,
+        key: str,
+        rate: float,
+        burst: float,
+        floor: float | None = None,
+    ) -> float:
+        """从所有进程共用的令牌桶里预定一个令牌，返回还要等待的秒数
+
+        令牌不够时也会预定，之后的调用者排在后面，等待时间依次变长
+
+        Args:
+            key: 令牌桶的名字
+            rate: 每秒补充的令牌数
+            burst: 桶的容量，空闲之后最多可以连续发出的请求数
+            floor: 传入时取走后至少要剩下这么多令牌，留给优先级更高的请求；
+                不够时不预定，返回 0 表示已经取到，大于 0 表示过这么久再来取
+        """
+
+
+class RedisStore(SharedStore):
+    """保存在 Redis 里，多台机器上的进程共用"""
+
+    def __init__(self, url: str) -> None:
+        self.client = redis.Redis.from_url(url)
+        self._take_token = self.client.register_script(
+            TAKE_TOKEN_SCRIPT
+        )
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(key)  # type:ignore
+
+    def set(
+        self,
+        key: str,
+        value: bytes,
+        ttl: float | None = None,
+    ) -> None:
+        self.client.set(
+            key,
+            value,
+            px=int(ttl * 1000) if ttl is not None else None,
+        )
+
+    def get_many(
+        self, keys: list[str]
+    ) -> list[bytes | None]:
+        if not keys:
+            return []
+        return self.client.mget(keys)  # type:ignore
+
+    def expire(self, key: str, ttl: float) -> None:
+        self.client.pexpire(key, int(ttl * 1000))
+
+    def delete(self, key: str) -> None:
+        self.client.delete(key)
+
+    @contextlib.contextmanager
+    def lock(
+        self, name: str, timeout: float
+    ) -> Iterator[None]:
+        lock = self.client.lock(
+            f"lock:{name}",
+            timeout=timeout,
+            blocking_timeout=timeout,
+        )
+        if not lock.acquire():
+            raise TimeoutError(f"等待锁 {name} 超时")
+        try:
+            yield
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                # 持有时间超过 timeout，锁已经自动释放
+                pass
+
+    def take_token(
+        self,
+        key: str,
+        rate: float,
+        burst: float,
+        floor: float | None = None,
+    ) -> float:
+        return float(
+            self._take_token(
+                keys=[f"rate:{key}"],
+                args=[
+                    rate,
+                    burst,
+                    "" if floor is None else floor,
+                ],
+            )
+        )
+
+
+class SqliteStore(SharedStore):
+    """保存在本机的 SQLite 里，同一台机器上的进程共用
+
+    锁用 fcntl 的字节范围锁实现，进程退出时自动释放。fcntl 的锁属于整个进程，
+    同一进程的线程之间再用线程锁互斥
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._stripes = [
+            threading.Lock() for _ in range(LOCK_STRIPES)
+        ]
+        self._lock_file: int | None = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.db_path, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # 其他进程正在写入时等待，而不是直接报错
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM shared_store"
+                " WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set(
+        self,
+        key: str,
+        value: bytes,
+        ttl: float | None = None,
+    ) -> None:
+        expires_at = (
+            time.time() + ttl if ttl is not None else None
+        )
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO shared_store (key, value, expires_at)"
+                " VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+            # 顺便清理过期的数据，不需要单独的定时任务
+            self.conn.execute(
+                "DELETE FROM shared_store WHERE expires_at < ?",
+                (time.time(),),
+            )
+
+    def get_many(
+        self, keys: list[str]
+    ) -> list[bytes | None]:
+        values: dict[str, bytes] = {}
+        with self._lock:
+            # SQLite 一条语句最多绑定 999 个参数，分批查询
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                values.update(
+                    self.conn.execute(
+                        "SELECT key, value FROM shared_store"
+                        f" WHERE key IN ({', '.join('?' * len(batch))})"
+                        " AND (expires_at IS NULL OR expires_at > ?)",
+                        (*batch, time.time()),
+                    ).fetchall()
+                )
+        return [values.get(key) for key in keys]
+
+    def expire(self, key: str, ttl: float) -> None:
+        now = time.time()
+        with self._lock, self.conn:
+            # 已经过期、还没有清理的不能续期
+            self.conn.execute(
+                "UPDATE shared_store SET expires_at = ?"
+                " WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (now + ttl, key, now),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM shared_store WHERE key = ?",
+                (key,),
+            )
+
+    def take_token(
+        self,
+        key: str,
+        rate: float,
+        burst: float,
+        floor: float | None = None,
+    ) -> float:
+        with self._lock:
+            # IMMEDIATE 事务一开始就拿到写锁，其他进程的读改写排在后面
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self.conn.execute(
+                    "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                tokens = burst if row is None else row[0]
+                elapsed = 0 if row is None else now - row[1]
+                tokens = min(
+                    burst, tokens + max(elapsed, 0) * rate
+                )
+                if floor is not None and tokens - 1 < floor:
+                    wait = (floor + 1 - tokens) / rate
+                else:
+                    tokens -= 1
+                    wait = max(0.0, -tokens / rate)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at)"
+                    " VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return wait
+
+    @contextlib.contextmanager
+    def lock(
+        self, name: str, timeout: float
+    ) -> Iterator[None]:
+        stripe = zlib.crc32(name.encode()) % LOCK_STRIPES
+        thread_lock = self._stripes[stripe]
+        if not thread_lock.acquire(timeout=timeout):
+            raise TimeoutError(f"等待锁 {name} 超时")
+        try:
+            with self._lock:
+                if self._lock_file is None:
+                    self._lock_file = os.open(
+                        Path(self.db_path).with_suffix(
+                            ".lock"
+                        ),
+                        os.O_RDWR | os.O_CREAT,
+                    )
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.lockf(
+                        self._lock_file,
+                        fcntl.LOCK_EX | fcntl.LOCK_NB,
+                        1,
+                        stripe,
+                    )
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(
+                            f"等待锁 {name} 超时"
+                        ) from None
+                    time.sleep(0.05)
+            try:
+                yield
+            finally:
+                fcntl.lockf(
+                    self._lock_file,
+                    fcntl.LOCK_UN,
+                    1,
+                    stripe,
+                )
+        finally:
+            thread_lock.release()
+
+
+def create_shared_store() -> SharedStore:
+    """按 SHARED_STORE_URL 创建共享存储"""
+    if SHARED_STORE_URL:
+        return RedisStore(SHARED_STORE_URL)
+    return SqliteStore(SHARED_STORE_DB)
+
+
+shared_store = create_shared_store()
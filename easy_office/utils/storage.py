@@ -0,0 +1,419 @@
+import hashlib
+import hmac
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from functools import cache
+from pathlib import Path
+from urllib.parse import quote, urlsplit
+
+import httpx
+import reflex as rx
+
+STORAGE_BACKEND: str = os.getenv(
+    "STORAGE_BACKEND", "local"
+)  # local：保存在 Reflex 的上传目录；s3：保存到 S3 兼容的对象存储
+BACK_END: str | None = os.getenv("BACK_END")
+
+S3_ENDPOINT: str = os.getenv("S3_ENDPOINT", "")
+S3_BUCKET: str = os.getenv("S3_BUCKET", "")
+S3_ACCESS_KEY: str = os.getenv("S3_ACCESS_KEY", "")
+S3_SECRET_KEY: str = os.getenv("S3_SECRET_KEY", "")
+S3_REGION: str = os.getenv("S3_REGION", "us-east-1")
+# 设置后直接用这个地址拼接下载链接（公开读的存储桶或 CDN），
+# 不设置时下载链接指向后端的 /files 接口，打开时再跳转到新生成的预签名链接
+S3_PUBLIC_URL: str = os.getenv("S3_PUBLIC_URL", "")
+S3_PRESIGN_EXPIRES: int = int(
+    os.getenv("S3_PRESIGN_EXPIRES", "3600")
+)  # /files 跳转用的预签名链接的有效期，单位秒，S3 最长允许 7 天
+S3_MULTIPART_THRESHOLD: int = int(
+    os.getenv(
+        "S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)
+    )
+)  # 超过这个大小的文件分片上传，单位字节
+S3_PART_SIZE: int = int(
+    os.getenv("S3_PART_SIZE", str(8 * 1024 * 1024))
+)  # 分片大小，S3 要求除最后一片外不小于 5MB
+S3_TIMEOUT: float = float(os.getenv("S3_TIMEOUT", "30"))
+
+CONTENT_TYPES = {
+    ".pdf": "application/pdf",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".bmp": "image/bmp",
+}
+
+
+class StorageError(Exception):
+    """对象存储返回错误"""
+
+
+@cache
+def upload_dir() -> Path:
+    """上传目录，rx.get_upload_dir() 每次都要重新读取配置，这里只读取一次"""
+    return rx.get_upload_dir()
+
+
+class Storage(ABC):
+    """上传文件的长期存储，按 key 保存，key 是形如 blobs/ab/cd/<哈希>.pdf 的相对路径
+
+    识别时读取的是本地上传目录里的工作副本，这里只负责需要长期访问的文件：
+    保存一份，并给出可以写进飞书的下载链接
+    """
+
+    @abstractmethod
+    def save(self, key: str, path: Path) -> None:
+        """把本地文件 path 保存为 key，在线程池里执行"""
+
+    @abstractmethod
+    def read(self, key: str) -> bytes:
+        """读取 key 的内容，不存在时抛出 FileNotFoundError，在线程池里执行"""
+
+    @abstractmethod
+    def url(self, key: str) -> str:
+        """key 的下载链接，会写进飞书，必须一直有效"""
+
+    def redirect_url(self, key: str) -> str | None:
+        """/files 接口在本地没有这个文件时跳转到的临时链接，None 表示不跳转"""
+        return None
+
+    @property
+    def keeps_local_copy(self) -> bool:
+        """本地工作副本是否就是保存的文件，是的话识别完成后不能删除"""
+        return False
+
+
+class LocalStorage(Storage):
+    """保存在上传目录里，由后端的 /files 接口提供下载，只能单机部署"""
+
+    def save(self, key: str, path: Path) -> None:
+        # 工作副本本身就在上传目录里
+        target = upload_dir() / key
+        if target != path and not target.exists():
+            write_atomic(target, path.read_bytes())
+
+    def read(self, key: str) -> bytes:
+        return (upload_dir() / key).read_bytes()
+
+    def url(self, key: str) -> str:
+        return f"{BACK_END}/files/{key}"
+
+    @property
+    def keeps_local_copy(self) -> bool:
+        return True
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """先写临时文件再改名，其他请求不会读到写了一半的文件"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(
+        dir=path.parent, suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(
+        key, msg.encode(), hashlib.sha256
+    ).digest()
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class S3Storage(Storage):
+    """S3 兼容的对象存储（AWS S3、MinIO、阿里云 OSS 等），使用路径形式的地址
+
+    直接用 httpx 发请求并计算 AWS Signature V4，不依赖 boto3。
+    大文件分片上传。下载链接是 S3_PUBLIC_URL 下的公开链接；没有设置时是后端的
+    /files 链接，打开时跳转到新生成的预签名链接。预签名链接最多 7 天有效，
+    不能直接写进飞书。跳转不依赖本地文件，可以多机部署
+
+    Args:
+        endpoint: 服务地址，例如 http://127.0.0.1:9000
+        bucket: 存储桶
+        access_key: Access Key
+        secret_key: Secret Key
+        region: 区域，MinIO 默认为 us-east-1
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        bucket: str,
+        access_key: str,
+        secret_key: str,
+        region: str = "us-east-1",
+    ) -> None:
+        self.endpoint = endpoint.rstrip("/")
+        self.host = urlsplit(self.endpoint).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.client = httpx.Client(timeout=S3_TIMEOUT)
+
+    def _path(self, key: str) -> str:
+        return quote(f"/{self.bucket}/{key}", safe="/~")
+
+    def _signature(
+        self,
+        method: str,
+        path: str,
+        query: dict[str, str],
+        headers: dict[str, str],
+        payload_hash: str,
+        amz_date: str,
+    ) -> tuple[str, str]:
+        """返回 (签名的请求头列表, 签名)"""
+        scope = (
+            f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+        )
+        canonical_query = "&".join(
+            f"{quote(k, safe='~')}={quote(v, safe='~')}"
+            for k, v in sorted(query.items())
+        )
+        names = sorted(headers)
+        signed_headers = ";".join(names)
+        canonical_request = "\n".join(
+            [
+                method,
+                path,
+                canonical_query,
+                "".join(
+                    f"{name}:{headers[name]}\n"
+                    for name in names
+                ),
+                signed_headers,
+                payload_hash,
+            ]
+        )
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                _sha256(canonical_request.encode()),
+            ]
+        )
+        key = _hmac(
+            ("AWS4" + self.secret_key).encode(),
+            amz_date[:8],
+        )
+        for part in (self.region, "s3", "aws4_request"):
+            key = _hmac(key, part)
+        return signed_headers, hmac.new(
+            key, string_to_sign.encode(), hashlib.sha256
+        ).hexdigest()
+
+    def _request(
+        self,
+        method: str,
+        key: str,
+        query: dict[str, str] | None = None,
+        body: bytes = b"",
+        headers: dict[str, str] | None = None,
+    ) -> httpx.Response:
+        query = query or {}
+        path = self._path(key)
+        amz_date = datetime.now(timezone.utc).strftime(
+            "%Y%m%dT%H%M%SZ"
+        )
+        payload_hash = _sha256(body)
+        signed = {
+            "host": self.host,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date,
+            **{
+                k.lower(): v
+                for k, v in (headers or {}).items()
+            },
+        }
+        signed_headers, signature = self._signature(
+            method,
+            path,
+            query,
+            signed,
+            payload_hash,
+            amz_date,
+        )
+        scope = (
+            f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+        )
+        signed["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+        del signed["host"]
+        response = self.client.request(
+            method,
+            self.endpoint + path,
+            params=query,
+            content=body,
+            headers=signed,
+        )
+        if response.status_code == 404 and method == "GET":
+            raise FileNotFoundError(key)
+        if response.status_code >= 300:
+            raise StorageError(
+                f"{method} {key} 失败：{response.status_code} {response.text[:200]}"
+            )
+        return response
+
+    def save(self, key: str, path: Path) -> None:
+        content_type = CONTENT_TYPES.get(
+            path.suffix.lower(), "application/octet-stream"
+        )
+        if path.stat().st_size <= S3_MULTIPART_THRESHOLD:
+            self._request(
+                "PUT",
+                key,
+                body=path.read_bytes(),
+                headers={"Content-Type": content_type},
+            )
+        else:
+            self._save_multipart(key, path, content_type)
+
+    def _save_multipart(
+        self, key: str, path: Path, content_type: str
+    ) -> None:
+        """分片上传，每次只读一片到内存，失败时取消上传，不留下残缺的分片"""
+        response = self._request(
+            "POST",
+            key,
+            query={"uploads": ""},
+            headers={"Content-Type": content_type},
+        )
+        upload_id = _xml_text(response.content, "UploadId")
+        parts: list[tuple[int, str]] = []
+        try:
+            with path.open("rb") as f:
+                number = 1
+                while chunk := f.read(S3_PART_SIZE):
+                    response = self._request(
+                        "PUT",
+                        key,
+                        query={
+                            "partNumber": str(number),
+                            "uploadId": upload_id,
+                        },
+                        body=chunk,
+                    )
+                    parts.append(
+                        (number, response.headers["ETag"])
+                    )
+                    number += 1
+            self._request(
+                "POST",
+                key,
+                query={"uploadId": upload_id},
+                body=_complete_body(parts),
+                headers={"Content-Type": "application/xml"},
+            )
+        except BaseException:
+            try:
+                self._request(
+                    "DELETE",
+                    key,
+                    query={"uploadId": upload_id},
+                )
+            except (StorageError, httpx.HTTPError):
+                pass
+            raise
+
+    def read(self, key: str) -> bytes:
+        return self._request("GET", key).content
+
+    def url(self, key: str) -> str:
+        if S3_PUBLIC_URL:
+            return f"{S3_PUBLIC_URL.rstrip('/')}/{quote(key, safe='/~')}"
+        return f"{BACK_END}/files/{key}"
+
+    def redirect_url(self, key: str) -> str | None:
+        return self.presign(key, S3_PRESIGN_EXPIRES)
+
+    def presign(self, key: str, expires: int) -> str:
+        """生成 GET 预签名链接，有效期 expires 秒"""
+        path = self._path(key)
+        amz_date = datetime.now(timezone.utc).strftime(
+            "%Y%m%dT%H%M%SZ"
+        )
+        scope = (
+            f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+        )
+        query = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{self.access_key}/{scope}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(
+                min(expires, 7 * 24 * 3600)
+            ),
+            "X-Amz-SignedHeaders": "host",
+        }
+        _, signature = self._signature(
+            "GET",
+            path,
+            query,
+            {"host": self.host},
+            "UNSIGNED-PAYLOAD",
+            amz_date,
+        )
+        query["X-Amz-Signature"] = signature
+        return (
+            self.endpoint
+            + path
+            + "?"
+            + "&".join(
+                f"{quote(k, safe='~')}={quote(v, safe='~')}"
+                for k, v in query.items()
+            )
+        )
+
+
+def _xml_text(content: bytes, tag: str) -> str:
+    """取出 S3 返回的 XML 里第一个 tag 的内容，忽略命名空间"""
+    for element in ET.fromstring(content).iter():
+        if element.tag.rsplit("}", 1)[-1] == tag:
+            return element.text or ""
+    raise StorageError(f"返回内容里没有 {tag}")
+
+
+def _complete_body(parts: list[tuple[int, str]]) -> bytes:
+    return (
+        "<CompleteMultipartUpload>"
+        + "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+            for number, etag in parts
+        )
+        + "</CompleteMultipartUpload>"
+    ).encode()
+
+
+def create_storage() -> Storage:
+    """按 STORAGE_BACKEND 创建存储"""
+    if STORAGE_BACKEND == "local":
+        return LocalStorage()
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(
+            S3_ENDPOINT,
+            S3_BUCKET,
+            S3_ACCESS_KEY,
+            S3_SECRET_KEY,
+            S3_REGION,
+        )
+    raise ValueError(
+        f"不支持的 STORAGE_BACKEND：{STORAGE_BACKEND}"
+    )
+
+
+storage = create_storage()
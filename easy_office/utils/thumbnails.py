@@ -0,0 +1,235 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+
+from pypdf import PdfReader
+
+from .executor import run_cpu, run_io
+from .metrics import Counter, track_stage
+from .blob_store import blob_store
+from .storage import upload_dir, write_atomic
+
+# 缩略图目录，默认在上传目录下的 thumbs
+THUMBNAIL_DIR: str = os.getenv("THUMBNAIL_DIR", "")
+THUMBNAIL_MAX_BYTES: int = int(
+    os.getenv("THUMBNAIL_MAX_BYTES", str(200 * 1024 * 1024))
+)  # 缩略图最多占用的磁盘空间，超出时删除最久没有访问的
+THUMBNAIL_SIZE: int = int(
+    os.getenv("THUMBNAIL_SIZE", "320")
+)  # 缩略图的最长边，单位像素
+THUMBNAIL_QUALITY: int = int(
+    os.getenv("THUMBNAIL_QUALITY", "70")
+)  # JPEG 质量
+
+THUMBNAIL_REQUESTS = Counter(
+    "easy_office_thumbnail_requests_total",
+    "缩略图请求次数，result 为 hit（命中缓存）、miss（新生成）或 error",
+    ("result",),
+)
+
+
+class ThumbnailError(Exception):
+    """文件无法生成缩略图，例如 PDF 页面里没有图片"""
+
+
+def render_thumbnail(
+    data: bytes, ext: str, size: int, quality: int
+) -> bytes:
+    """生成 JPEG 缩略图，在进程池里执行
+
+    图片直接缩小；PDF 取第一页里最大的一张图片，扫描件的回单就是这张图片。
+    PDF 只按图片处理，不渲染文字和矢量内容
+
+    Args:
+        data: 文件内容
+        ext: 扩展名，例如 .pdf
+        size: 最长边，单位像素
+        quality: JPEG 质量
+    """
+    # Pillow 只在工作进程里导入，不占用主进程的内存
+    from PIL import Image
+
+    if ext == ".pdf":
+        pages = PdfReader(BytesIO(data)).pages
+        if not pages:
+            raise ThumbnailError("PDF 没有页面")
+        page = pages[0]
+        images = [item.image for item in page.images]
+        if not images:
+            raise ThumbnailError("PDF 第一页没有图片")
+        image = max(
+            images, key=lambda im: im.width * im.height
+        )
+    else:
+        image = Image.open(BytesIO(data))
+        # JPEG 解码时直接按比例缩小，大图也不用完整解码
+        image.draft("RGB", (size, size))
+
+    image.thumbnail((size, size))
+    output = BytesIO()
+    image.convert("RGB").save(
+        output, "JPEG", quality=quality, optimize=True
+    )
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """保存在磁盘上的缩略图，总大小超过 max_bytes 时删除最久没有访问的
+
+    访问顺序记录在当前进程里，命中时更新文件的修改时间，启动时按修改时间恢复；
+    多个进程共用一个目录时，各自淘汰的文件被别的进程访问到时会重新生成
+
+    Args:
+        root: 缓存目录，None 表示上传目录下的 thumbs
+        max_bytes: 最多占用的字节数
+    """
+
+    def __init__(
+        self, root: Path | None, max_bytes: int
+    ) -> None:
+        self._root = root
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, int] | None = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def root(self) -> Path:
+        if self._root is None:
+            self._root = upload_dir() / "thumbs"
+        return self._root
+
+    def path(self, name: str) -> Path:
+        return self.root / name[:2] / name
+
+    def _load(self) -> OrderedDict[str, int]:
+        if self._entries is None:
+            stats = sorted(
+                (
+                    (path.stat(), path.name)
+                    for path in self.root.glob("*/*.jpg")
+                ),
+                key=lambda item: item[0].st_mtime,
+            )
+            self._entries = OrderedDict(
+                (name, stat.st_size) for stat, name in stats
+            )
+            self._size = sum(self._entries.values())
+        return self._entries
+
+    def get(self, name: str) -> Path | None:
+        """缓存里的缩略图，没有时返回 None，在线程池里执行"""
+        with self._lock:
+            entries = self._load()
+            if name not in entries:
+                return None
+            entries.move_to_end(name)
+        path = self.path(name)
+        try:
+            # 更新修改时间，重启后仍然按访问顺序淘汰
+            path.touch()
+        except FileNotFoundError:  # 被别的进程淘汰了
+            with self._lock:
+                self._size -= entries.pop(name, 0)
+            return None
+        return path
+
+    def put(self, name: str, data: bytes) -> Path:
+        """保存缩略图并淘汰超出大小的部分，在线程池里执行"""
+        path = self.path(name)
+        write_atomic(path, data)
+        with self._lock:
+            entries = self._load()
+            self._size += len(data) - entries.pop(name, 0)
+            entries[name] = len(data)
+            while (
+                self._size > self.max_bytes
+                and len(entries) > 1
+            ):
+                old, size = entries.popitem(last=False)
+                self._size -= size
+                self.path(old).unlink(missing_ok=True)
+        return path
+
+
+class Thumbnails:
+    """按需生成缩略图，第一次请求时生成，之后直接读取缓存
+
+    同一个文件同时有多个请求时只生成一次
+    """
+
+    def __init__(self, cache: ThumbnailCache) -> None:
+        self.cache = cache
+        self._pending: dict[str, asyncio.Future[Path]] = {}
+
+    async def get(self, key: str) -> Path:
+        """返回文件 key 的缩略图路径
+
+        Raises:
+            ThumbnailError: 文件不存在或者无法生成缩略图
+        """
+        name = f"{Path(key).stem}-{THUMBNAIL_SIZE}.jpg"
+        path = await run_io(self.cache.get, name)
+        if path is not None:
+            THUMBNAIL_REQUESTS.labels(result="hit").inc()
+            return path
+
+        pending = self._pending.get(name)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[name] = future
+        try:
+            path = await self._render(key, name)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            THUMBNAIL_REQUESTS.labels(result="error").inc()
+            future.set_exception(e)
+            # 没有其他人在等时也要取走异常，避免 asyncio 报告未处理的异常
+            future.exception()
+            raise
+        else:
+            THUMBNAIL_REQUESTS.labels(result="miss").inc()
+            future.set_result(path)
+            return path
+        finally:
+            del self._pending[name]
+
+    async def _render(self, key: str, name: str) -> Path:
+        with track_stage("thumbnail", endpoint="files"):
+            try:
+                data = await run_io(blob_store.read, key)
+            except FileNotFoundError as e:
+                raise ThumbnailError("文件不存在") from e
+            try:
+                thumbnail = await run_cpu(
+                    render_thumbnail,
+                    data,
+                    Path(key).suffix,
+                    THUMBNAIL_SIZE,
+                    THUMBNAIL_QUALITY,
+                )
+            except Exception as e:
+                # 工作进程里的异常都说明这个文件生成不了缩略图：损坏的 PDF、
+                # 不支持的图片编码（NotImplementedError）、超大图片
+                # （DecompressionBombError）等，以及超时、崩溃的 WorkerError
+                raise ThumbnailError(
+                    str(e) or type(e).__name__
+                ) from e
+            return await run_io(
+                self.cache.put, name, thumbnail
+            )
+
+
+thumbnails = Thumbnails(
+    ThumbnailCache(
+        Path(THUMBNAIL_DIR) if THUMBNAIL_DIR else None,
+        THUMBNAIL_MAX_BYTES,
+    )
+)
@@ -0,0 +1,256 @@
+import argparse
+import atexit
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+# span 输出文件，例如 ./traces.jsonl；默认关闭，文件不会轮转，排查问题时再打开
+TRACE_FILE: str = os.getenv("TRACE_FILE", "")
+
+
+class Span:
+    """一次操作的耗时记录，通过 parent_id 串成 批次 → 文件 → 识别 → 写入飞书 的调用树"""
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "attributes",
+        "start_time",
+        "duration_ms",
+        "status",
+        "task_id",
+        "_start",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: str,
+        attributes: dict[str, Any],
+        task_id: str = "",
+    ) -> None:
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.duration_ms: float = 0
+        self.status = "ok"
+        self.task_id = task_id  # 子 span 继承父 span 的 task_id，方便日志关联
+        self._start = time.perf_counter()
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self) -> None:
+        self.duration_ms = round(
+            (time.perf_counter() - self._start) * 1000, 3
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class JsonlExporter:
+    """在后台线程里把结束的 span 追加写入 JSONL 文件，不阻塞事件循环"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._queue: queue.SimpleQueue[dict | None] = (
+            queue.SimpleQueue()
+        )
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="trace-exporter",
+                    daemon=True,
+                )
+                self._thread.start()
+                atexit.register(self.shutdown)
+
+    def export(self, span: Span) -> None:
+        self._ensure_started()
+        self._queue.put(span.to_dict())
+
+    def _run(self) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                f.write(
+                    json.dumps(
+                        item,
+                        ensure_ascii=False,
+                        default=str,
+                    )
+                    + "\n"
+                )
+                if self._queue.empty():
+                    f.flush()
+
+    def shutdown(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+
+exporter: JsonlExporter | None = (
+    JsonlExporter(TRACE_FILE) if TRACE_FILE else None
+)
+
+_current_span: ContextVar[Span | None] = ContextVar(
+    "current_span", default=None
+)
+
+
+def current_span() -> Span | None:
+    """当前上下文中的 span，asyncio.gather 创建的任务会继承父任务的 span"""
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """开启一个 span，退出时记录耗时并导出
+
+    Args:
+        name: span 名称，例如 batch、file、ocr、feishu_write
+        attributes: 附加属性，例如 task_id、file_name
+    """
+    parent = _current_span.get()
+    new_span = Span(
+        name=name,
+        trace_id=parent.trace_id
+        if parent
+        else secrets.token_hex(16),
+        parent_id=parent.span_id if parent else "",
+        attributes=attributes,
+        task_id=str(attributes.get("task_id", ""))
+        or (parent.task_id if parent else ""),
+    )
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.status = "error"
+        new_span.set_attribute("error", repr(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+        if exporter is not None:
+            exporter.export(new_span)
+
+
+# ================== 命令行查看某个 task_id 的时间线 =====================
+
+
+def load_traces(
+    path: str, key: str
+) -> dict[str, list[dict]]:
+    """读取 trace_id 或 task_id 相关的全部 span，按 trace_id 分组"""
+    spans: list[dict] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+    trace_ids = {
+        s["trace_id"]
+        for s in spans
+        if s["trace_id"] == key
+        or s["attributes"].get("task_id") == key
+        or s["attributes"].get("batch_id") == key
+    }
+
+    traces: dict[str, list[dict]] = {}
+    for s in spans:
+        if s["trace_id"] in trace_ids:
+            traces.setdefault(s["trace_id"], []).append(s)
+    return traces
+
+
+def format_trace(spans: list[dict]) -> str:
+    """把一条 trace 格式化为按开始时间排序的缩进树"""
+    children: dict[str, list[dict]] = {}
+    for s in spans:
+        children.setdefault(s["parent_id"], []).append(s)
+    for items in children.values():
+        items.sort(key=lambda s: s["start_time"])
+
+    span_ids = {s["span_id"] for s in spans}
+    roots = [
+        s
+        for s in spans
+        if not s["parent_id"]
+        or s["parent_id"] not in span_ids
+    ]
+    roots.sort(key=lambda s: s["start_time"])
+    origin = roots[0]["start_time"] if roots else 0
+
+    lines: list[str] = []
+
+    def walk(s: dict, depth: int) -> None:
+        offset = (s["start_time"] - origin) * 1000
+        attrs = " ".join(
+            f"{k}={v}" for k, v in s["attributes"].items()
+        )
+        flag = " [ERROR]" if s["status"] != "ok" else ""
+        lines.append(
+            f"{'  ' * depth}{s['name']:<16} +{offset:>9.1f}ms "
+            f"{s['duration_ms']:>9.1f}ms{flag} {attrs}"
+        )
+        for child in children.get(s["span_id"], []):
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="查看某个 trace_id / task_id / batch_id 的完整时间线"
+    )
+    parser.add_argument(
+        "key", help="trace_id、task_id 或 batch_id"
+    )
+    parser.add_argument(
+        "--file", default=TRACE_FILE or "./traces.jsonl"
+    )
+    args = parser.parse_args()
+
+    for trace_id, trace_spans in load_traces(
+        args.file, args.key
+    ).items():
+        print(f"trace_id: {trace_id}")
+        print(format_trace(trace_spans))
+        print()
@@ -5,12 +5,18 @@ import os
 from pathlib import Path
 
 import httpx
-from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 
+from easy_office.utils.rate_limit import (
+    Priority,
+    baidu_ocr_limiter,
+    scheduling,
+)
+
 load_dotenv()
 
-rate_limit = AsyncLimiter(5, 1)
+# 和后端共用百度 OCR 的限流，需要在项目根目录用 python -m easy_office.utils.发票识别脚本 运行
+rate_limit = baidu_ocr_limiter
 
 
 API_KEY = os.getenv("BAIDU_API_KEY")
@@ -115,7 +121,9 @@ if __name__ == "__main__":
             request_invoice_api(pdf) for pdf in pdf_list
         ]
 
-        data = await asyncio.gather(*tasks)
+        # 批量处理优先级最低，网页上的用户识别时让出配额
+        with scheduling(Priority.BULK):
+            data = await asyncio.gather(*tasks)
 
         with open(
             file=pdf_dir / "测试",
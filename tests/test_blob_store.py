@@ -0,0 +1,69 @@
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from easy_office.utils import blob_store as module
+from easy_office.utils.blob_store import BlobStore
+
+
+class PutTest(unittest.TestCase):
+    """多个进程各自打开索引，同时保存同样的内容"""
+
+    def setUp(self) -> None:
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = Path(root.name)
+        patcher = mock.patch.object(
+            module, "upload_dir", return_value=self.root
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _put_together(
+        self, stores: list[BlobStore], data: bytes
+    ) -> list[sqlite3.Error]:
+        barrier = threading.Barrier(len(stores))
+        errors: list[sqlite3.Error] = []
+
+        def put(store: BlobStore) -> None:
+            barrier.wait()
+            try:
+                store.put(data, ".pdf", keep=False)
+            except sqlite3.Error as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=put, args=(store,))
+            for store in stores
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_processes(self) -> None:
+        # 每个 BlobStore 有自己的连接和锁，和不同进程一样
+        db = str(self.root / "blobs.db")
+        stores = [BlobStore(db) for _ in range(4)]
+        for i in range(20):
+            data = f"content {i}".encode()
+            self.assertEqual(
+                self._put_together(stores, data), []
+            )
+            row = stores[0].get(
+                hashlib.sha256(data).hexdigest()
+            )
+            assert row is not None
+            self.assertEqual(row["refs"], len(stores))
+            self.assertEqual(
+                row["upload_count"], len(stores)
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
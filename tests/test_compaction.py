@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import tempfile
+import unittest
+from contextlib import ExitStack
+from pathlib import Path
+from unittest import mock
+
+from easy_office.utils import blob_store as blob_module
+from easy_office.utils import compaction
+from easy_office.utils import storage as storage_module
+from easy_office.utils.blob_store import BlobStore
+from easy_office.utils.storage import LocalStorage
+
+
+class CompactTest(unittest.TestCase):
+    """归档后从归档包读到的内容和原文件逐字节相同"""
+
+    def setUp(self) -> None:
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = Path(root.name)
+        self.store = BlobStore(str(self.root / "blobs.db"))
+        local = LocalStorage()
+        with ExitStack() as stack:
+            for module in (
+                blob_module,
+                compaction,
+                storage_module,
+            ):
+                stack.enter_context(
+                    mock.patch.object(
+                        module,
+                        "upload_dir",
+                        return_value=self.root,
+                    )
+                )
+            for module in (blob_module, compaction):
+                stack.enter_context(
+                    mock.patch.object(
+                        module, "storage", local
+                    )
+                )
+            stack.enter_context(
+                mock.patch.object(
+                    compaction, "blob_store", self.store
+                )
+            )
+            self.addCleanup(stack.pop_all().close)
+
+    def _save(self, data: bytes, ext: str) -> Path:
+        blob = self.store.put(data, ext)
+        self.store.release(blob.path)
+        return blob.path
+
+    def _packed(self, path: Path) -> dict:
+        with self.store._lock:
+            row = self.store.conn.execute(
+                "SELECT * FROM packed WHERE digest = ?",
+                (path.stem,),
+            ).fetchone()
+        return dict(row)
+
+    def test_compact(self) -> None:
+        # 重复的内容 zlib 能压缩，.jpg 照样原样保存，说明没有尝试压缩
+        jpeg = hashlib.sha256(b"jpeg").digest() * 1000
+        bmp = b"BM" + b"\0" * 32000
+        jpeg_path = self._save(jpeg, ".jpg")
+        bmp_path = self._save(bmp, ".bmp")
+
+        report = asyncio.run(compaction.compact(-1))
+
+        self.assertEqual(sum(report.files.values()), 2)
+        self.assertFalse(jpeg_path.exists())
+        self.assertFalse(bmp_path.exists())
+        self.assertFalse(
+            self._packed(jpeg_path)["compressed"]
+        )
+        self.assertTrue(
+            self._packed(bmp_path)["compressed"]
+        )
+        self.assertLess(
+            self._packed(bmp_path)["length"], len(bmp) // 10
+        )
+        self.assertEqual(
+            self.store.read_packed(jpeg_path.stem), jpeg
+        )
+        self.assertEqual(
+            self.store.read_packed(bmp_path.stem), bmp
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import asyncio
+import re
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from pathlib import Path
+from unittest import mock
+
+import reflex as rx
+from pypdf import PdfWriter
+
+from easy_office.utils import file_process as module
+from easy_office.utils import resumable_upload
+from easy_office.utils.file_process import (
+    save_file_list,
+    working_set,
+)
+from easy_office.utils.resumable_upload import (
+    UPLOAD_IMAGE_MAX_BYTES,
+    ResumableUpload,
+)
+
+
+def _pdf(pages: int) -> bytes:
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(100, 100)
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def _broken_pdf() -> bytes:
+    """页面树损坏的 PDF，pypdf 解析时抛出 TypeError 而不是 PyPdfError"""
+    return re.sub(rb"/Kids \[[^\]]*\]", b"/Kids 7", _pdf(2))
+
+
+class SaveFileListTest(unittest.TestCase):
+    """损坏的 PDF 只算这一个文件失败，同一批的其他文件照常保存"""
+
+    def setUp(self) -> None:
+        self.saved: list[str] = []
+
+        async def save_bytes(
+            data: bytes,
+            ext: str,
+            original_name: str = "",
+            keep: bool = True,
+        ) -> Path:
+            self.saved.append(original_name)
+            return Path(original_name)
+
+        patcher = mock.patch.object(
+            module, "save_bytes", save_bytes
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _save(self, files: list) -> dict[str, str]:
+        failed: dict[str, str] = {}
+        asyncio.run(save_file_list(files, failed))
+        return failed
+
+    def test_upload_files(self) -> None:
+        failed = self._save(
+            [
+                rx.UploadFile(
+                    BytesIO(_broken_pdf()),
+                    filename="bad.pdf",
+                ),
+                rx.UploadFile(
+                    BytesIO(_pdf(2)), filename="good.pdf"
+                ),
+            ]
+        )
+        self.assertEqual(list(failed), ["bad.pdf"])
+        self.assertEqual(
+            self.saved, ["good.pdf#1", "good.pdf#2"]
+        )
+
+    def test_resumable_uploads(self) -> None:
+        with (
+            tempfile.TemporaryDirectory() as root,
+            mock.patch.object(
+                resumable_upload,
+                "upload_dir",
+                return_value=Path(root),
+            ),
+        ):
+            uploads = []
+            for name, data in [
+                ("bad.pdf", _broken_pdf()),
+                ("good.pdf", _pdf(2)),
+            ]:
+                upload = ResumableUpload(
+                    name,
+                    "session",
+                    name,
+                    len(data),
+                    time.time(),
+                )
+                upload.path.parent.mkdir(
+                    parents=True, exist_ok=True
+                )
+                upload.path.write_bytes(data)
+                uploads.append(upload)
+            failed = self._save(uploads)
+        self.assertEqual(list(failed), ["bad.pdf"])
+        self.assertEqual(
+            self.saved, ["good.pdf#1", "good.pdf#2"]
+        )
+
+
+class WorkingSetTest(unittest.TestCase):
+    """分块上传的 PDF 逐页处理，不按整个文件的大小占用内存预算"""
+
+    def _upload(
+        self, name: str, size: int
+    ) -> ResumableUpload:
+        return ResumableUpload(
+            "id", "session", name, size, time.time()
+        )
+
+    def test_resumable_pdf(self) -> None:
+        self.assertEqual(
+            working_set(
+                self._upload("scan.PDF", 100 * 1024 * 1024)
+            ),
+            UPLOAD_IMAGE_MAX_BYTES,
+        )
+        self.assertEqual(
+            working_set(self._upload("scan.pdf", 1000)),
+            1000,
+        )
+
+    def test_whole_files(self) -> None:
+        self.assertEqual(
+            working_set(self._upload("slip.png", 4000000)),
+            4000000,
+        )
+        pdf = rx.UploadFile(
+            BytesIO(b""),
+            size=100 * 1024 * 1024,
+            filename="a.pdf",
+        )
+        self.assertEqual(
+            working_set(pdf), 100 * 1024 * 1024
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from unittest import mock
+
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from easy_office.routes import grid
+from easy_office.utils.request_api import process_bank_slip
+from easy_office.utils.row_store import RowStore
+
+
+def bank_slip_words() -> dict:
+    """百度银行回单识别返回的 words_result"""
+    return {
+        "交易日期": [{"word": "2024年01月02日"}],
+        "小写金额": [{"word": "￥1,234.50"}],
+        "付款人户名": [{"word": "付款公司"}],
+        "收款人户名": [{"word": "收款公司"}],
+    }
+
+
+class RowsEndpointTest(unittest.TestCase):
+    """刚识别出来的回单要能通过表格接口序列化成 JSON"""
+
+    def setUp(self) -> None:
+        self.store = RowStore(10, 3600)
+        patcher = mock.patch.object(
+            grid, "row_store", self.store
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(
+            Starlette(
+                routes=[
+                    Route(
+                        "/grid/{kind}", grid.rows_endpoint
+                    )
+                ]
+            )
+        )
+
+    def test_bank_slip(self) -> None:
+        batch_id = self.store.create("bank_slip", "session")
+        self.store.extend(
+            batch_id,
+            [
+                {
+                    **process_bank_slip(bank_slip_words()),
+                    "bank_slip_url": "http://x/files/a.pdf",
+                    "task_id": "task",
+                }
+            ],
+        )
+        response = self.client.get(
+            "/grid/bank_slip",
+            params={"start": 0, "end": 100},
+            headers={"X-Reflex-Client-Token": "session"},
+        )
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["row_count"], 1)
+        row = body["rows"][0]
+        self.assertEqual(row["trade_date"], "2024-01-02")
+        self.assertEqual(row["payer"], "付款公司")
+
+
+if __name__ == "__main__":
+    unittest.main()
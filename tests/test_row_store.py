@@ -0,0 +1,105 @@
+import asyncio
+import json
+import tempfile
+import time
+import unittest
+from datetime import date
+from pathlib import Path
+from unittest import mock
+
+import httpx
+
+from easy_office.utils import request_api
+from easy_office.utils.request_api import (
+    create_new_record,
+    process_bank_slip,
+)
+from easy_office.utils.row_store import RowStore
+from easy_office.utils.shared_store import SqliteStore
+
+
+class SharedRowStoreTest(unittest.TestCase):
+    """共享存储里的批次经过 JSON，另一个进程读出来的回单还能发送到飞书"""
+
+    def setUp(self) -> None:
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.shared = SqliteStore(
+            str(Path(root.name) / "shared.db")
+        )
+
+    def _store(self) -> RowStore:
+        # 每个 RowStore 有自己的内存缓存，和不同的后端进程一样
+        return RowStore(10, 3600, self.shared)
+
+    def _send(self, record: dict) -> dict:
+        sent: list[dict] = []
+
+        def handler(
+            request: httpx.Request,
+        ) -> httpx.Response:
+            sent.append(json.loads(request.content))
+            return httpx.Response(200, json={"code": 0})
+
+        client = httpx.AsyncClient
+        with (
+            mock.patch.object(
+                request_api.get_feishu_token,
+                "atoken",
+                mock.AsyncMock(return_value="token"),
+            ),
+            mock.patch.object(
+                request_api.feishu_write_limiter,
+                "acquire",
+                mock.AsyncMock(),
+            ),
+            mock.patch.object(
+                request_api.httpx,
+                "AsyncClient",
+                lambda **kwargs: client(
+                    transport=httpx.MockTransport(handler)
+                ),
+            ),
+        ):
+            asyncio.run(create_new_record(record))
+        return sent[0]["fields"]
+
+    def test_bank_slip(self) -> None:
+        writer = self._store()
+        batch_id = writer.create("bank_slip", "session")
+        writer.extend(
+            batch_id,
+            [
+                process_bank_slip(
+                    {
+                        "交易日期": [
+                            {"word": "2024年01月02日"}
+                        ],
+                        "小写金额": [{"word": "1,234.50"}],
+                        "付款人户名": [
+                            {"word": "付款公司"}
+                        ],
+                        "收款人户名": [
+                            {"word": "收款公司"}
+                        ],
+                    }
+                )
+            ],
+        )
+
+        (record,) = self._store().records(batch_id)
+        self.assertEqual(record["trade_date"], "2024-01-02")
+
+        fields = self._send(record)
+        self.assertEqual(
+            fields["交易日期"],
+            int(
+                time.mktime(date(2024, 1, 2).timetuple())
+                * 1000
+            ),
+        )
+        self.assertEqual(fields["付款方"], "付款公司")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import asyncio
+import tempfile
+import unittest
+from io import BytesIO
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+from pypdf import PdfWriter
+
+from easy_office.utils import thumbnails as module
+from easy_office.utils.thumbnails import (
+    ThumbnailCache,
+    ThumbnailError,
+    Thumbnails,
+    render_thumbnail,
+)
+
+
+def _image(width: int, height: int) -> Image.Image:
+    """左右两种颜色的图片，缩小之后还能看出方向"""
+    image = Image.new("RGB", (width, height), "red")
+    image.paste("blue", (width // 2, 0, width, height))
+    return image
+
+
+def _encode(image: Image.Image, fmt: str) -> bytes:
+    output = BytesIO()
+    image.save(output, fmt)
+    return output.getvalue()
+
+
+class RenderThumbnailTest(unittest.TestCase):
+    def _open(self, data: bytes) -> Image.Image:
+        thumbnail = Image.open(BytesIO(data))
+        self.assertEqual(thumbnail.format, "JPEG")
+        return thumbnail
+
+    def test_jpeg(self) -> None:
+        data = _encode(_image(1600, 1000), "JPEG")
+        thumbnail = self._open(
+            render_thumbnail(data, ".jpg", 320, 70)
+        )
+        self.assertEqual(thumbnail.size, (320, 200))
+        red, _, blue = thumbnail.getpixel((10, 100))
+        self.assertGreater(red, blue)
+
+    def test_image_pdf(self) -> None:
+        # 扫描件的 PDF：一页里只有一张图片
+        data = _encode(_image(1000, 1600), "PDF")
+        thumbnail = self._open(
+            render_thumbnail(data, ".pdf", 320, 70)
+        )
+        self.assertEqual(thumbnail.size, (200, 320))
+        red, _, blue = thumbnail.getpixel((190, 160))
+        self.assertGreater(blue, red)
+
+    def test_pdf_without_pages(self) -> None:
+        output = BytesIO()
+        PdfWriter().write(output)
+        with self.assertRaises(ThumbnailError):
+            render_thumbnail(
+                output.getvalue(), ".pdf", 320, 70
+            )
+
+
+class ThumbnailsTest(unittest.TestCase):
+    """工作进程里的任何异常都转换成 ThumbnailError，接口返回 404 而不是 500"""
+
+    def _get(self, data: bytes, key: str) -> Path:
+        with tempfile.TemporaryDirectory() as root:
+            thumbnails = Thumbnails(
+                ThumbnailCache(Path(root), 1024 * 1024)
+            )
+            with mock.patch.object(
+                module.blob_store, "read", return_value=data
+            ):
+                return asyncio.run(thumbnails.get(key))
+
+    def test_unreadable_files(self) -> None:
+        empty = BytesIO()
+        PdfWriter().write(empty)
+        for data, ext in [
+            (empty.getvalue(), ".pdf"),
+            (b"not a pdf", ".pdf"),
+            (b"not an image", ".png"),
+        ]:
+            with (
+                self.subTest(ext=ext, data=data[:12]),
+                self.assertRaises(ThumbnailError),
+            ):
+                self._get(
+                    data, f"blobs/00/00/{'0' * 64}{ext}"
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()